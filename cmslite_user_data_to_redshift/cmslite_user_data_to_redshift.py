@@ -18,6 +18,7 @@ from botocore.exceptions import ClientError
 import pandas as pd  # data processing
 import pandas.errors
 import re  # regular expressions
+import io
 from io import StringIO
 import os  # to read environment variables
 import json  # to read json config files
@@ -29,14 +30,18 @@ if branch_root not in sys.path:
 import lib.logs as log
 from lib.redshift import RedShift
 import os.path  # file handling
-import shutil
 import logging
-from shutil import unpack_archive
+import tarfile
 from datetime import datetime
 from tzlocal import get_localzone
 from pytz import timezone
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 import boto3  # s3 access
+import psycopg2
+
+# The number of batch files written to S3 at the same time
+UPLOAD_WORKERS = 4
 
 local_tz = get_localzone()
 yvr_tz = timezone('America/Vancouver')
@@ -105,23 +110,60 @@ IGNOREHEADER AS 1 MAXERROR AS 0 DELIMITER '|' NULL AS '-' ESCAPE;\n
     return query
 
 
-def download_object(file_object):
-    '''downloads object to a tmp directory'''
-    dl_name = file_object.replace(prefix, '')
-    try:
-        my_bucket.download_file(file_object, './tmp/{0}'.format(dl_name))
-    except ClientError as e:
-        logger.exception(f'Download {object_summary.key} from S3 failed')
-        report_stats['failed'] += 1
-        report(report_stats)
-        clean_exit(1,f'Bad file {object_summary.key} in objects to process, '
-                   'no further processing.')
+# Constructs a single transaction loading every table read from an archive
+def load_query(tables, log):
+    query = "BEGIN;\n"
+    # tables loaded incrementally, or all tables when truncate is not set,
+    # have their batch files copied directly into the table
+    for table in tables:
+        if table['append'] or not truncate:
+            query += copy_query(table['dbtable'], table['batchfile'], log)
+    if not truncate:
+        return query + "COMMIT;\n"
+
+    # stage each remaining table's new data in a scratch table
+    swapped = [table for table in tables if not table['append']]
+    for table in swapped:
+        dbtable = table['dbtable']
+        query += """
+-- Clean up from last run if necessary
+DROP TABLE IF EXISTS {0}_scratch;
+DROP TABLE IF EXISTS {0}_old;
+-- Create scratch table to copy new data into
+CREATE TABLE {0}_scratch (LIKE {0});
+ALTER TABLE {0}_scratch OWNER TO microservice;
+-- Grant access to Looker and to Snowplow pipeline users
+GRANT SELECT ON {0}_scratch TO looker;\n
+GRANT SELECT ON {0}_scratch TO datamodeling;\n
+""".format(dbtable)
+        query += copy_query(dbtable + "_scratch", table['batchfile'], log)
+
+    # then replace all of the main tables with their scratch tables at once
+    for table in swapped:
+        query += """
+-- Replace main table with scratch table, clean up the old table
+ALTER TABLE {0} RENAME TO {1}_old;
+ALTER TABLE {0}_scratch RENAME TO {1};
+DROP TABLE {0}_old;
+""".format(table['dbtable'], table['table_name'])
+    return query + "COMMIT;\n"
+
 
+# Returns the latest value of field already loaded into dbtable, or None if
+# the table is empty
+def last_loaded(dbtable, field):
+    with spdb.connection as conn:
+        with conn.cursor() as curs:
+            curs.execute(f"SELECT MAX({field}) FROM {dbtable};")
+            return curs.fetchone()[0]
 
-# delete tmp directory and all its contents.  
-def delete_tmp():
-    if os.path.exists('./tmp'):
-        shutil.rmtree('./tmp')
+
+# Writes a dataframe to a "|" delimited batch file on S3
+def to_batch(batchfile, df):
+    csv_buffer = StringIO()
+    df.to_csv(csv_buffer, header=True, index=False, sep="|")
+    client.put_object(Bucket=bucket_name, Key=batchfile,
+                      Body=csv_buffer.getvalue())
 
 
 # Check to see if the file has been processed already
@@ -223,12 +265,8 @@ if truncate and len(objects_to_process) == 1:
             objects_to_process[0].key, objects_to_process[0].last_modified))
 
 # Process the objects that were found during the earlier directory pass.
-# Download the tgz file, unpack it to a temp directory in the local working
-# directory, process the files, and then shift the data to redshift. Finally,
-# delete the temp directory.
-
-if not os.path.exists('./tmp'):
-    os.makedirs('./tmp')
+# Stream the tgz file from S3, read each file in the archive as it is
+# decompressed, and then shift the data to redshift.
 
 # Reporting variables. Accumulates as the the loop below is traversed
 report_stats = {
@@ -248,26 +286,62 @@ report_stats = {
 report_stats['objects'] = len(objects_to_process)
 report_stats['incomplete_list'] = objects_to_process.copy()
 
+# nothing to load, so do not open a connection to Redshift
+if not objects_to_process:
+    clean_exit(0, 'Finished all processing cleanly.')
+
+# Open one connection to Redshift that is shared by every archive in this run
+spdb = RedShift.snowplow(objects_to_process[0].key)
+
+# Tables configured with an incremental_field are append only; fetch the
+# latest value already loaded for each of them once, so that only newer rows
+# are copied from each archive
+latest = {}
+for file_config in data['files'].values():
+    if 'incremental_field' in file_config:
+        dbtable = data['schema'] + '.' + file_config['dbtable']
+        try:
+            latest[dbtable] = last_loaded(
+                dbtable, file_config['incremental_field'])
+        except psycopg2.Error:
+            logger.exception('Reading the latest %s from %s failed',
+                             file_config['incremental_field'], dbtable)
+            spdb.close_connection()
+            clean_exit(1, 'Could not read the last loaded value of an '
+                          'incremental table, no further processing.')
+        logger.info('%s last loaded up to %s = %s', dbtable,
+                    file_config['incremental_field'], latest[dbtable])
+
 # process the objects that were found during the earlier directory pass
 for object_summary in objects_to_process:
 
-    # Download and unpack to a temporary folder: ./tmp
-    download_object(object_summary.key)
-
     # Get the filename from the full path in the object summary key
     filename = re.search("(cms-analytics-csv)(.)*tgz$",
                          object_summary.key).group()
 
-    # Unpack the object in the tmp directory
-    unpack_archive('./tmp/' + filename, './tmp/' + filename.rstrip('.tgz'))
-
+    # Stream the object from S3 and read each file in the archive as it is
+    # decompressed, without writing the archive or its files to disk
+    try:
+        obj = client.get_object(Bucket=bucket, Key=object_summary.key)
+        archive = tarfile.open(fileobj=obj['Body'], mode='r|gz')
+    except (ClientError, tarfile.TarError):
+        logger.exception(f'Reading {object_summary.key} from S3 failed')
+        report_stats['failed'] += 1
+        report(report_stats)
+        spdb.close_connection()
+        clean_exit(1,f'Bad file {object_summary.key} in objects to process, '
+                   'no further processing.')
 
-    for file in os.listdir('./tmp/' + filename.rstrip('.tgz')):
-        if file.startswith("._"):
-            os.remove('./tmp/' + filename.rstrip('.tgz') + '/' + file)
+    # the tables parsed from this archive, with their batch files, in the
+    # order they were read
+    tables = []
+    for member in archive:
+        file = os.path.basename(member.name)
+        # skip directories and the "._" resource fork files
+        if not member.isfile() or file.startswith("._"):
+            continue
 
-    # process files for upload to batch folder on S3
-    for file in os.listdir('./tmp/' + filename.rstrip('.tgz')):
+        # process files for upload to batch folder on S3
         batchfile = destination + "/batch/client/" + directory + '/' + file
         goodfile = destination + "/good/client/" + directory + '/' + file
         badfile = destination + "/bad/client/" + directory + '/' + file
@@ -277,9 +351,8 @@ for object_summary in objects_to_process:
         dbtable = data['schema'] + '.' + file_config['dbtable']
         table_name = file_config['dbtable']
 
-        file_obj = open('./tmp/' + filename.rstrip('.tgz') + '/' + file,
-                        "r",
-                        encoding="utf-8")
+        file_obj = io.TextIOWrapper(archive.extractfile(member),
+                                    encoding="utf-8")
 
         # Read the file and build the parsed version
         try:
@@ -309,6 +382,7 @@ for object_summary in objects_to_process:
             except ClientError:
                 logger.exception("S3 transfer failed")
             report(report_stats)
+            spdb.close_connection()
             clean_exit(1, f'Bad file {object_summary.key} in objects to '
                            'process,no further processing.')
         except ValueError:
@@ -327,6 +401,7 @@ for object_summary in objects_to_process:
             except ClientError:
                 logger.exception("S3 transfer failed")
             report(report_stats)
+            spdb.close_connection()
             clean_exit(1, f'Bad file {object_summary.key} in objects to '
                            'process,no further processing.')
 
@@ -347,75 +422,66 @@ for object_summary in objects_to_process:
         if file_config['dbtable'] == 'user_activity':
             group_name = df.memo.str.split(' - ').str[1]
             df['group_name'] = group_name
-        
-        # Put the full data set into a buffer and write it
-        # to a "|" delimited file in the batch directory
-        csv_buffer = StringIO()
-        df.to_csv(csv_buffer, header=True, index=False, sep="|")
-        resource.Bucket(bucket_name).put_object(Key=batchfile,
-                                                Body=csv_buffer.getvalue())
-        # prep database call to pull the batch file into redshift
-        query = copy_query(dbtable, batchfile, log=False)
-        logquery = copy_query(dbtable, batchfile, log=True)
-
-        # if truncate is set to true, perform a transaction that will
-        # replace the existing table data with the new data in one commit
-        # if truncate is not true then the query remains as just the copy command
-        if (truncate):
-            scratch_start = """
-BEGIN;
--- Clean up from last run if necessary
-DROP TABLE IF EXISTS {0}_scratch;
-DROP TABLE IF EXISTS {0}_old;
--- Create scratch table to copy new data into
-CREATE TABLE {0}_scratch (LIKE {0});
-ALTER TABLE {0}_scratch OWNER TO microservice;
--- Grant access to Looker and to Snowplow pipeline users
-GRANT SELECT ON {0}_scratch TO looker;\n
-GRANT SELECT ON {0}_scratch TO datamodeling;\n
-""".format(dbtable)
-
-            scratch_copy = copy_query(
-                dbtable + "_scratch", batchfile, log=False)
-            scratch_copy_log = copy_query(
-                dbtable + "_scratch", batchfile, log=True)
 
-            scratch_cleanup = """
--- Replace main table with scratch table, clean up the old table
-ALTER TABLE {0} RENAME TO {1}_old;
-ALTER TABLE {0}_scratch RENAME TO {1};
-DROP TABLE {0}_old;
-COMMIT;
-""".format(dbtable, table_name)
-
-            query = scratch_start + scratch_copy + scratch_cleanup
-            logquery = scratch_start + scratch_copy_log + scratch_cleanup
-
-        # Execute the transaction against Redshift using local lib
-        # redshift module
-        logger.info(logquery)
-        spdb = RedShift.snowplow(batchfile)
-        if spdb.query(query):
-            outfile = destination + "/good/" + object_summary.key
-            report_stats['loaded'] += 1
-            report_stats['tables_loaded'].append(dbtable)
-        else:
-            outfile = destination + "/bad/" + object_summary.key
-            report_stats['failed'] += 1
-            report_stats['bad'] += 1
-            report_stats['bad_list'].append(object_summary)
-            report_stats['incomplete_list'].remove(object_summary)
-            report_stats['table_loads_failed'].append(dbtable)
-            try:
-                client.copy_object(Bucket=f"{bucket}",
-                                   CopySource=f"{bucket}/{object_summary.key}",
-                                   Key=f"{destination}/bad/client/{directory}/{filename}")
-            except ClientError:
-                logger.exception("S3 copy to processed folder failed")
-            report(report_stats)
-            clean_exit(1, f'Bad file {object_summary.key} in objects to process, '
-                   'no further processing.')
+        # Keep only the rows newer than those already loaded to an
+        # incremental table, and remember the new latest value for any
+        # later archive in this run
+        if 'incremental_field' in file_config:
+            field = file_config['incremental_field']
+            if latest[dbtable] is not None:
+                df = df[df[field] > pd.Timestamp(latest[dbtable])]
+            if not df.empty:
+                latest[dbtable] = df[field].max()
+            logger.info('%s new rows to load to %s', len(df), dbtable)
+
+        tables.append({
+            'dbtable': dbtable,
+            'table_name': table_name,
+            'batchfile': batchfile,
+            'df': df,
+            'append': 'incremental_field' in file_config})
+    archive.close()
+
+    # Write every table to its "|" delimited file in the batch directory
+    # concurrently; the low-level client is safe to share between threads
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+        uploads = [executor.submit(to_batch, table['batchfile'], table['df'])
+                   for table in tables]
+    try:
+        for upload in uploads:
+            upload.result()
+    except ClientError:
+        logger.exception("S3 upload to batch folder failed")
+        report_stats['failed'] += 1
+        report_stats['bad'] += 1
+        report_stats['bad_list'].append(object_summary)
+        report_stats['incomplete_list'].remove(object_summary)
+        report(report_stats)
         spdb.close_connection()
+        clean_exit(1, f'Bad file {object_summary.key} in objects to process, '
+                   'no further processing.')
+
+    # Load every table from this archive in a single transaction, so that
+    # readers only ever see the four tables from the same export.
+    # if truncate is set to true, each table is copied into a scratch table
+    # which replaces the existing table; if truncate is not true the batch
+    # files are copied directly into the tables
+    query = load_query(tables, log=False)
+    logquery = load_query(tables, log=True)
+
+    # Execute the transaction against Redshift using local lib
+    # redshift module
+    logger.info(logquery)
+    spdb.batchfile = object_summary.key
+    if spdb.query(query):
+        outfile = destination + "/good/" + object_summary.key
+        report_stats['loaded'] += len(tables)
+        report_stats['tables_loaded'].extend(
+            table['dbtable'] for table in tables)
+    else:
+        outfile = destination + "/bad/" + object_summary.key
+        report_stats['table_loads_failed'].extend(
+            table['dbtable'] for table in tables)
 
     # copy the object to the S3 outfile (processed/good/ or processed/bad/)
     try:
@@ -435,6 +501,7 @@ COMMIT;
         report_stats['bad_list'].append(object_summary)
         report_stats['incomplete_list'].remove(object_summary)
         report(report_stats)
+        spdb.close_connection()
         clean_exit(1, f'Bad file {object_summary.key} in objects to process, '
                    'no further processing.')
 
@@ -444,8 +511,7 @@ COMMIT;
     report_stats['incomplete_list'].remove(object_summary)
     logger.info("finished %s", object_summary.key)
 
-# Delete tmp files and dir once microservice has finished processing
-delete_tmp()
+spdb.close_connection()
 
 report(report_stats)
 clean_exit(0, 'Finished all processing cleanly.')
@@ -0,0 +1,94 @@
+"""Build the CMS Lite dictionary and lookup tables from the metadata, and
+the queries that load them into Redshift"""
+import pandas as pd  # data processing
+
+
+# Create a dictionary dataframe based on a column
+def to_dict(loc_df, section, nested_delim):
+    '''build a dictionary type dataframe for a column with nested \
+    delimeters'''
+    # drop any nulls and wrapping delimeters, split and flatten:
+    clean = loc_df.dropna(
+        subset=[section])[section].str[1:-1].str.split(
+            nested_delim).explode()
+    # make a dataframe of the sorted unique values
+    return pd.DataFrame({section: sorted(clean.unique())})
+
+
+# Create a lookup dataframe based on a column and its dictionary
+def to_lookup(loc_df, section, loc_dictionary, loc_columnlist, nested_delim):
+    '''build a lookup type dataframe pairing each node_id with the \
+    dictionary index of each of its nested delimited terms'''
+    # drop any nulls, wrapping delimeters and empties, then split and
+    # explode to one row per term, keeping the node and term order
+    terms = loc_df[['node_id', section]].dropna(subset=[section])
+    terms = terms.assign(**{section: terms[section].str[1:-1]})
+    terms = terms[terms[section] != '']
+    terms = terms.assign(
+        **{section: terms[section].str.split(nested_delim)}).explode(section)
+    # hash map of each dictionary term to its dictionary index
+    lookup_ids = pd.Series(loc_dictionary.index,
+                           index=loc_dictionary[section])
+    terms['lookup_id'] = terms[section].map(lookup_ids)
+    return terms[loc_columnlist].reset_index(drop=True)
+
+
+# Build the query to load a table from its scratch table
+def load_query(table, copy_query, load_mode, table_key):
+    '''return the query that replaces a table from its batch file, or in
+    diff mode, applies only the inserted, updated and deleted rows'''
+    start_query = (
+        f'DROP TABLE IF EXISTS {table}_scratch;\n'
+        f'DROP TABLE IF EXISTS {table}_old;\n'
+        f'CREATE TABLE {table}_scratch (LIKE {table});\n'
+        f'ALTER TABLE {table}_scratch OWNER TO microservice;\n'
+        f'GRANT SELECT ON {table}_scratch TO looker;\n')
+    if load_mode == 'swap':
+        end_query = (
+            f'ALTER TABLE {table} RENAME TO {table}_old;\n'
+            f'ALTER TABLE {table}_scratch RENAME TO {table};\n'
+            f'DROP TABLE {table}_old;\n')
+        return start_query + copy_query + end_query
+    # A key is changed if any of its rows were added or removed, or if its
+    # number of rows differs. Redshift has no EXCEPT ALL, so the row count
+    # catches an identical row appearing a different number of times.
+    end_query = (
+        f'CREATE TEMP TABLE {table}_changed AS\n'
+        f'SELECT {table_key} FROM (SELECT * FROM {table}_scratch '
+        f'EXCEPT SELECT * FROM {table}) AS added\n'
+        f'UNION SELECT {table_key} FROM (SELECT * FROM {table} '
+        f'EXCEPT SELECT * FROM {table}_scratch) AS removed\n'
+        f'UNION SELECT {table_key} FROM ('
+        f'SELECT {table_key}, COUNT(*) FROM {table}_scratch '
+        f'GROUP BY {table_key} '
+        f'EXCEPT SELECT {table_key}, COUNT(*) FROM {table} '
+        f'GROUP BY {table_key}) AS recounted;\n'
+        f'DELETE FROM {table} WHERE {table_key} IN '
+        f'(SELECT {table_key} FROM {table}_changed);\n'
+        f'INSERT INTO {table} SELECT * FROM {table}_scratch '
+        f'WHERE {table_key} IN (SELECT {table_key} FROM {table}_changed);\n'
+        f'DROP TABLE {table}_changed;\n'
+        f'DROP TABLE {table}_scratch;\n')
+    return start_query + copy_query + end_query
+
+
+# Reformat a column of dates
+def format_dates(loc_series, output_format, input_format=None):
+    '''parse a column of dates with input_format, or an inferred format if it
+    is not set, and return them formatted as output_format, leaving nulls
+    as blanks'''
+    try:
+        parsed = pd.to_datetime(loc_series, format=input_format)
+    except ValueError:
+        # pandas cannot hold dates with mixed UTC offsets in one column, so
+        # parse them one at a time, each keeping its own offset. A value
+        # that cannot be parsed still raises the ValueError.
+        parsed = loc_series.map(
+            lambda x: pd.to_datetime(x, format=input_format),
+            na_action='ignore')
+    if not pd.api.types.is_datetime64_any_dtype(parsed):
+        # dates with mixed UTC offsets are held as objects, which have no
+        # .dt accessor; format those one at a time, each in its own offset
+        return parsed.apply(
+            lambda x: x.strftime(output_format) if not pd.isnull(x) else '')
+    return parsed.dt.strftime(output_format).fillna('')
@@ -19,6 +19,7 @@
 
 import re  # regular expressions
 from io import StringIO
+import hashlib  # to fingerprint the snapshot and the derived tables
 import os  # to read environment variables
 import json  # to read json config files
 import sys  # to read command line parameters
@@ -26,7 +27,7 @@ here = os.path.dirname(os.path.abspath(__file__))
 branch_root = os.path.abspath(os.path.join(here, ".."))
 if branch_root not in sys.path:
     sys.path.insert(0, branch_root)
-import itertools  # functional tools for creating and using iterators
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import logging
 import warnings
@@ -34,13 +35,15 @@ import boto3  # s3 access
 from botocore.exceptions import ClientError
 import pandas as pd  # data processing
 import pandas.errors
-import numpy as np
 import psycopg2  # to connect to Redshift
 from lib.redshift import RedShift
+from cmslite_tables import to_dict, to_lookup, load_query, format_dates
 import lib.logs as log
 from tzlocal import get_localzone
 from pytz import timezone
 
+# Number of derived tables serialized and uploaded to S3 at the same time
+UPLOAD_WORKERS = 4
 
 def main():
     """Process S3 loaded CMS Lite Metadata file to Redshift"""
@@ -106,6 +109,19 @@ def main():
             dtype_dic[fieldname] = str
     delim = data['delim']
     truncate = data['truncate']
+    # skip the tables whose output is unchanged since the last load
+    if 'skip_unchanged' in data:
+        skip_unchanged = data['skip_unchanged']
+    else:
+        skip_unchanged = False
+    # "swap" replaces each changed table, "diff" applies row level changes
+    if 'load_mode' in data:
+        load_mode = data['load_mode']
+    else:
+        load_mode = 'swap'
+    if load_mode not in ('swap', 'diff'):
+        clean_exit(1, "bad configuration, load_mode must be 'swap' or 'diff'")
+    hashes_key = f'{destination}/state/{directory}/content_hashes.json'
 
     # Suppresses boto3's Python 3.9 PythonDeprecationWarning
     with warnings.catch_warnings():
@@ -132,8 +148,11 @@ def main():
     # Must be the same order as the SQL table.
     # If null (eg None in Python), will write all columns in order.
     # index = if not Null, add an index column with this label
-    def to_s3(loc_batchfile, filename, loc_df, loc_columnlist, loc_index):
-        """Funcion to write a CSV to S3"""
+    def to_s3(loc_batchfile, filename, loc_df, loc_columnlist, loc_index,
+              loc_previous_hash=None):
+        """Funcion to write a CSV to S3. Returns the content hash of the
+        CSV and whether it was written; a CSV matching loc_previous_hash is
+        not written."""
         # Put the full data set into a buffer and write it
         # to a "   " delimited file in the batch directory
         csv_buffer = StringIO()
@@ -169,25 +188,33 @@ def main():
                               index_label=loc_index,
                               encoding='utf-8')
 
+        body = csv_buffer.getvalue()
+        content_hash = hashlib.sha256(body.encode('utf-8')).hexdigest()
+        if content_hash == loc_previous_hash:
+            logger.info("%s is unchanged, not writing it", filename)
+            return content_hash, False
         logger.info("Writing " + filename + " to " + loc_batchfile)
-        resource.Bucket(bucket).put_object(Key=loc_batchfile + "/" + filename,
-                                           Body=csv_buffer.getvalue())
+        # the low-level client is used since it is safe to share across the
+        # upload threads
+        client.put_object(Bucket=bucket, Key=loc_batchfile + "/" + filename,
+                          Body=body)
+        return content_hash, True
 
         
-    # Create a dictionary dataframe based on a column
-    def to_dict(loc_df, section):
-        '''build a dictionary type dataframe for a column with nested \
-        delimeters'''
-        # drop any nulls and wrapping delimeters, split and flatten:
-        clean = loc_df.copy().dropna(
-            subset=[section])[section].str[1:-1].str.split(
-                nested_delim).values.flatten()
-        # set to exlude duplicates
-        _l = list(set(itertools.chain.from_iterable(clean)))
-        # make a dataframe of the list
-        return pd.DataFrame({section: sorted(_l)})
+    # Content hashes of the last loaded snapshot and of its derived tables
+    def read_hashes():
+        '''read the content hashes persisted by the last successful load'''
+        try:
+            obj = client.get_object(Bucket=bucket, Key=hashes_key)
+        except ClientError:
+            return {'snapshot': None, 'tables': {}}
+        return json.loads(obj['Body'].read())
+
+    def write_hashes(loc_hashes):
+        '''persist the content hashes of a successful load'''
+        client.put_object(Bucket=bucket, Key=hashes_key,
+                          Body=json.dumps(loc_hashes))
 
-    
     # Check to see if the file has been processed already
     def is_processed(loc_object_summary):
         '''check S3 for objects already processed'''
@@ -252,6 +279,9 @@ def main():
         if data['tables_loaded']:
             print('\nList of tables that were successfully loaded into Redshift:')
             [print(table) for table in data['tables_loaded']]
+        if data['tables_unchanged']:
+            print('\nList of tables that were unchanged and not reloaded:')
+            [print(table) for table in data['tables_unchanged']]
         if data['table_loads_failed']:
             print('\nList of tables that failed to load into Redshift:')
             [print(table) for table in data['table_loads_failed']]
@@ -307,12 +337,17 @@ def main():
         'bad_list':[],
         'incomplete_list':[],
         'tables_loaded':[],
+        'tables_unchanged':[],
         'table_loads_failed':[]
     }
 
     report_stats['objects'] = len(objects_to_process)
     report_stats['incomplete_list'] = objects_to_process.copy()
 
+    # the content hashes of the last load, and whether any table has changed
+    hashes = read_hashes() if skip_unchanged else {'snapshot': None, 'tables': {}}
+    tables_changed = False
+
     # process the objects that were found during the earlier directory pass
     for object_summary in objects_to_process:
         # Check to see if the file has been processed already
@@ -326,6 +361,28 @@ def main():
 
         csv_string = body.read().decode('utf-8')
 
+        # An unchanged snapshot produces unchanged tables, so nothing is loaded
+        snapshot_hash = hashlib.sha256(csv_string.encode('utf-8')).hexdigest()
+        if skip_unchanged and snapshot_hash == hashes['snapshot']:
+            logger.info('%s matches the last loaded snapshot, skipping loads.',
+                        object_summary.key)
+            try:
+                client.copy_object(
+                    Bucket=bucket,
+                    CopySource=bucket + '/' + object_summary.key,
+                    Key=goodfile)
+            except ClientError:
+                logger.exception("S3 transfer failed")
+                report(report_stats)
+                clean_exit(
+                    1,
+                    f'S3 transfer of {object_summary.key} to {goodfile} failed.')
+            report_stats['processed'] += 1
+            report_stats['good'] += 1
+            report_stats['good_list'].append(object_summary)
+            report_stats['incomplete_list'].remove(object_summary)
+            continue
+
         # XX  temporary fix while we figure out better delimiter handling
         csv_string = csv_string.replace('	', ' ')
 
@@ -399,14 +456,14 @@ def main():
                                                       thisfield['new'])
 
           # Clean up date fields, for each field listed in the dateformat array
-          # named "field" apply "format". Leaves null entries as blanks instead
-          # of NaT.
+          # named "field" apply "format". Fields are parsed with their
+          # "input_format" when set, rather than inferring one. Leaves null
+          # entries as blanks instead of NaT.
           if 'dateformat' in data:
               for thisfield in data['dateformat']:
-                  _df[thisfield['field']] = pd.to_datetime(
-                      _df[thisfield['field']]).apply(
-                          lambda x: x.strftime(
-                              thisfield['format']) if not pd.isnull(x) else '')                      
+                  _df[thisfield['field']] = format_dates(
+                      _df[thisfield['field']], thisfield['format'],
+                      thisfield.get('input_format'))
         except ValueError as _e:
           print(f'\n**An Error Occurred**\n{str(_e)}\n')
           outfile = badfile
@@ -443,6 +500,9 @@ def main():
         # and a dictionary table. These can be joined in the LookML to 
         # allow querying the parsed out values in the lookup columns.
         copy_queries = {}
+        new_hashes = {'snapshot': snapshot_hash, 'tables': {}}
+        uploads = {}
+        executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS)
         for i in range(-1, len(columns_lookup)*2):
             # the main metadata table is built on the first iteration
             if i == -1:
@@ -463,7 +523,7 @@ def main():
                 column = columns_lookup[i]
                 columnlist = [columns_lookup[i]]
                 dbtable = dbtables_dictionaries[i]
-                df_new = to_dict(_df, column)  # make dict a df of this column
+                df_new = to_dict(_df, column, nested_delim)  # make dict a df of this column
                 dictionary_dfs[columns_lookup[i]] = df_new
             # The metadata tables are built in the i - len(columns_lookup) iterations.
             # The metadata dictionary tables contain key value pairs. 
@@ -480,33 +540,24 @@ def main():
                 # retrieve the dict in mem
                 df_dictionary = dictionary_dfs[column]
 
-                # for each row in df
-                df_new = pd.DataFrame(columns=columnlist)
-                for iterrows_tuple in _df.copy().iterrows():
-                    row = iterrows_tuple[1]
-                    # iterate over the list of delimited terms
-                    if row[column] is not np.nan:
-                        # get the full string of delimited
-                        # values to be looked up
-                        entry = row[column]
-                        # remove wrapping delimeters
-                        entry = entry[1:-1]
-                        if entry:  # skip empties
-                            # split on delimiter and iterate on resultant list
-                            for lookup_entry in entry.split(nested_delim):
-                                node_id = row.node_id
-                                # its dictionary index
-                                lookup_id = df_dictionary.loc[
-                                    df_dictionary[
-                                        column] == lookup_entry].index[0]
-                                # create the data frame to concat
-                                _d = pd.DataFrame(
-                                    [[node_id, lookup_id]], columns=columnlist)
-                                df_new = pd.concat(
-                                    [df_new, _d], ignore_index=True)
-
-            # output the the dataframe as a csv
-            to_s3(batchfile, dbtable + '.csv', df_new, columnlist, key)
+                # map each node's delimited terms to their dictionary index
+                df_new = to_lookup(
+                    _df, column, df_dictionary, columnlist, nested_delim)
+
+            # output the the dataframe as a csv, unless it is unchanged. The
+            # upload runs in the pool while the next table is built.
+            uploads[dbtable] = executor.submit(
+                to_s3, batchfile, dbtable + '.csv', df_new, columnlist, key,
+                hashes['tables'].get(dbtable) if skip_unchanged else None)
+
+        # wait for the uploads, in table order, and build the copy queries
+        executor.shutdown(wait=True)
+        for dbtable, upload in uploads.items():
+            table_hash, changed = upload.result()
+            new_hashes['tables'][dbtable] = table_hash
+            if not changed:
+                report_stats['tables_unchanged'].append(dbschema + '.' + dbtable)
+                continue
 
             # append the formatted copy query to the copy_queries dictionary
             copy_queries[dbtable] = (
@@ -520,35 +571,43 @@ def main():
         # prepare the single-transaction query
         query = f'BEGIN; \nSET search_path TO {dbschema};'
         for table, copy_query in copy_queries.items():
-            start_query = (
-                f'DROP TABLE IF EXISTS {table}_scratch;\n'
-                f'DROP TABLE IF EXISTS {table}_old;\n'
-                f'CREATE TABLE {table}_scratch (LIKE {table});\n'
-                f'ALTER TABLE {table}_scratch OWNER TO microservice;\n'
-                f'GRANT SELECT ON {table}_scratch TO looker;\n')
-            end_query = (
-                f'ALTER TABLE {table} RENAME TO {table}_old;\n'
-                f'ALTER TABLE {table}_scratch RENAME TO {table};\n'
-                f'DROP TABLE {table}_old;\n')
-            query = query + start_query + copy_query + end_query
+            # dictionaries are keyed on their id; the metadata and lookup
+            # tables on node_id
+            table_key = 'id' if table in dbtables_dictionaries else 'node_id'
+            query = query + load_query(table, copy_query, load_mode, table_key)
         query = query + 'COMMIT;\n'
         logquery = (
             query.replace
             (os.environ['AWS_ACCESS_KEY_ID'], 'AWS_ACCESS_KEY_ID').replace
             (os.environ['AWS_SECRET_ACCESS_KEY'], 'AWS_SECRET_ACCESS_KEY'))
 
-        # Execute the transaction against Redshift using 
-        # local lib redshift module.
-        logger.info(logquery)
-        spdb = RedShift.snowplow(batchfile)
-        if spdb.query(query):
+        if not copy_queries:
+            # every derived table is unchanged; there is nothing to load
+            logger.info('No tables changed in %s', object_summary.key)
             outfile = goodfile
-            report_stats['loaded'] += 1
-            report_stats['tables_loaded'].append(dbschema + '.metadata')
         else:
-            outfile = badfile
-            report_stats['table_loads_failed'].append(dbschema + '.metadata')
-        spdb.close_connection()
+            # Execute the transaction against Redshift using
+            # local lib redshift module.
+            logger.info(logquery)
+            spdb = RedShift.snowplow(batchfile)
+            if spdb.query(query):
+                outfile = goodfile
+                tables_changed = True
+                report_stats['loaded'] += 1
+                report_stats['tables_loaded'].append(dbschema + '.metadata')
+            else:
+                outfile = badfile
+                report_stats['table_loads_failed'].append(dbschema + '.metadata')
+            spdb.close_connection()
+
+        # remember what was loaded, so the next run can skip unchanged tables
+        if skip_unchanged and outfile == goodfile:
+            try:
+                write_hashes(new_hashes)
+            except ClientError:
+                logger.exception("Writing the content hashes failed")
+            else:
+                hashes = new_hashes
 
         # Copies the uploaded file from client into processed/good or /bad
         try:
@@ -582,7 +641,7 @@ def main():
         query = file.read()
     query = query.format(dbschema=dbschema)
 
-    if(len(objects_to_process) > 0):
+    if(len(objects_to_process) > 0 and (tables_changed or not skip_unchanged)):
         # Execute the query using local lib redshift module and log the outcome
         logger.info('Executing query:\n%s', query)
         spdb = RedShift.snowplow(batchfile)
@@ -0,0 +1,173 @@
+"""Benchmark the CMS Lite dictionary and lookup tables on a large metadata
+snapshot, and check them against the row by row loop they replaced.
+
+The snapshot is generated in the shape of cmslite.csv: each nested column
+of cmslite_gdx.json holds 1 to 4 delimited terms, with 10% nulls and 10%
+empty '||' entries. A real snapshot can be given with --csv instead.
+
+The old loop is quadratic, so it is only run on the first --compare-nodes
+nodes, where the batch CSVs of both must be byte-identical. The vectorized
+tables are then timed on every node.
+
+Usage:
+    python tests/benchmark_lookup.py [--nodes 100000] [--compare-nodes 1500]
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import time
+from io import StringIO
+import numpy as np
+import pandas as pd
+here = os.path.dirname(os.path.abspath(__file__))
+service_root = os.path.abspath(os.path.join(here, ".."))
+if service_root not in sys.path:
+    sys.path.insert(0, service_root)
+from cmslite_tables import to_dict, to_lookup
+
+with open(os.path.join(service_root, 'cmslite_gdx.json')) as _f:
+    CONFIG = json.load(_f)
+NESTED_DELIM = CONFIG['nested_delim']
+COLUMNS = CONFIG['columns_lookup']
+LOOKUP_COLUMNS = ['node_id', 'lookup_id']
+# the number of distinct terms generated for each nested column
+TERMS = 200
+
+
+def old_to_dict(loc_df, section):
+    '''the dictionary table as built before to_dict was vectorized'''
+    clean = loc_df.copy().dropna(
+        subset=[section])[section].str[1:-1].str.split(
+            NESTED_DELIM).values.flatten()
+    _l = list(set(itertools.chain.from_iterable(clean)))
+    return pd.DataFrame({section: sorted(_l)})
+
+
+def old_to_lookup(loc_df, column, df_dictionary):
+    '''the lookup table as built by the row by row loop that to_lookup
+    replaced'''
+    df_new = pd.DataFrame(columns=LOOKUP_COLUMNS)
+    for iterrows_tuple in loc_df.copy().iterrows():
+        row = iterrows_tuple[1]
+        if row[column] is not np.nan:
+            entry = row[column]
+            entry = entry[1:-1]
+            if entry:
+                for lookup_entry in entry.split(NESTED_DELIM):
+                    node_id = row.node_id
+                    lookup_id = df_dictionary.loc[
+                        df_dictionary[column] == lookup_entry].index[0]
+                    _d = pd.DataFrame(
+                        [[node_id, lookup_id]], columns=LOOKUP_COLUMNS)
+                    df_new = pd.concat([df_new, _d], ignore_index=True)
+    return df_new
+
+
+def make_metadata(nodes, seed):
+    '''return the text of a generated metadata snapshot'''
+    rng = random.Random(seed)
+    rows = [','.join(['node_id'] + COLUMNS)]
+    for node in range(nodes):
+        row = [f'N{node:07d}']
+        for column in COLUMNS:
+            chance = rng.random()
+            if chance < 0.1:
+                row.append('')
+            elif chance < 0.2:
+                row.append(NESTED_DELIM * 2)
+            else:
+                terms = [f'{column} {rng.randrange(TERMS)}'
+                         for _ in range(rng.randint(1, 4))]
+                row.append(NESTED_DELIM + NESTED_DELIM.join(terms)
+                           + NESTED_DELIM)
+        rows.append(','.join(row))
+    return '\n'.join(rows) + '\n'
+
+
+def read_metadata(csv_text):
+    '''read a snapshot as the microservice does'''
+    return pd.read_csv(StringIO(csv_text), index_col=False, dtype=str)
+
+
+def to_csv(loc_df, loc_columnlist, loc_index):
+    '''serialize a table the way to_s3 writes it to the batch folder'''
+    csv_buffer = StringIO()
+    loc_df.to_csv(csv_buffer, header=True, index=loc_index is not None,
+                  sep="\t", columns=loc_columnlist, index_label=loc_index,
+                  encoding='utf-8')
+    return csv_buffer.getvalue()
+
+
+def build_tables(loc_df, dict_function, lookup_function):
+    '''return the batch CSV of every dictionary and lookup table'''
+    tables = {}
+    for column in COLUMNS:
+        dictionary = dict_function(loc_df, column)
+        lookup = lookup_function(loc_df, column, dictionary)
+        tables[column] = to_csv(dictionary, [column], 'key')
+        tables[f'metadata_{column}'] = to_csv(lookup, LOOKUP_COLUMNS, None)
+    return tables
+
+
+def new_tables(loc_df):
+    '''the batch CSVs built by to_dict and to_lookup'''
+    return build_tables(
+        loc_df,
+        lambda df, column: to_dict(df, column, NESTED_DELIM),
+        lambda df, column, dictionary: to_lookup(
+            df, column, dictionary, LOOKUP_COLUMNS, NESTED_DELIM))
+
+
+def old_tables(loc_df):
+    '''the batch CSVs built by the old loop'''
+    return build_tables(loc_df, old_to_dict, old_to_lookup)
+
+
+def timed(function, *args):
+    '''return the result of a call and the seconds it took'''
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--nodes', type=int, default=100000,
+                        help='the number of nodes to generate')
+    parser.add_argument('--compare-nodes', type=int, default=1500,
+                        help='the number of nodes to run the old loop on')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--csv', help='a metadata snapshot to use instead '
+                        'of a generated one; it must hold the node_id and '
+                        'nested columns of cmslite_gdx.json')
+    flags = parser.parse_args()
+
+    if flags.csv:
+        with open(flags.csv, encoding='utf-8') as _f:
+            csv_text = _f.read()
+    else:
+        csv_text = make_metadata(flags.nodes, flags.seed)
+    metadata = read_metadata(csv_text)
+
+    sample = metadata.head(flags.compare_nodes)
+    old, old_seconds = timed(old_tables, sample)
+    new, new_seconds = timed(new_tables, sample)
+    identical = old == new
+    print(f'{len(sample)} nodes: old loop {old_seconds:.2f} s, '
+          f'vectorized {new_seconds:.2f} s, '
+          f'{"identical" if identical else "DIFFERENT"} output')
+    for table in old:
+        if old[table] != new[table]:
+            print(f'  {table} differs')
+
+    _, seconds = timed(new_tables, metadata)
+    print(f'{len(metadata)} nodes: vectorized {seconds:.2f} s '
+          f'for {len(COLUMNS) * 2} tables')
+    return 0 if identical else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,130 @@
+"""Check the CMS Lite dictionary and lookup tables against fixtures, the
+queries that load them, and the reformatting of dates.
+
+The expected tables in fixtures/ were written by the row by row lookup loop
+that to_lookup replaced, so any change in their rows, order or duplicates
+shows up here.
+"""
+import os
+import re
+import sqlite3
+import sys
+from io import StringIO
+import pandas as pd
+import pytest
+here = os.path.dirname(os.path.abspath(__file__))
+service_root = os.path.abspath(os.path.join(here, ".."))
+if service_root not in sys.path:
+    sys.path.insert(0, service_root)
+from cmslite_tables import to_dict, to_lookup, load_query, format_dates
+
+FIXTURES = os.path.join(here, 'fixtures')
+NESTED_DELIM = '|'
+COLUMNS = ['content_types', 'audiences']
+
+
+def read_fixture(filename):
+    '''return the text of a fixture file'''
+    with open(os.path.join(FIXTURES, filename), encoding='utf-8') as _f:
+        return _f.read()
+
+
+def to_csv(loc_df, loc_columnlist, loc_index):
+    '''serialize a table the way to_s3 writes it to the batch folder'''
+    csv_buffer = StringIO()
+    loc_df.to_csv(csv_buffer, header=True, index=loc_index is not None,
+                  sep="\t", columns=loc_columnlist, index_label=loc_index,
+                  encoding='utf-8')
+    return csv_buffer.getvalue()
+
+
+@pytest.fixture(name='metadata')
+def fixture_metadata():
+    '''the metadata fixture, read as the microservice reads a snapshot'''
+    return pd.read_csv(os.path.join(FIXTURES, 'metadata.csv'),
+                       index_col=False, dtype=str)
+
+
+@pytest.mark.parametrize('column', COLUMNS)
+def test_to_dict(metadata, column):
+    dictionary = to_dict(metadata, column, NESTED_DELIM)
+    assert (to_csv(dictionary, [column], 'key')
+            == read_fixture(f'{column}.csv'))
+
+
+@pytest.mark.parametrize('column', COLUMNS)
+def test_to_lookup(metadata, column):
+    columnlist = ['node_id', 'lookup_id']
+    dictionary = to_dict(metadata, column, NESTED_DELIM)
+    lookup = to_lookup(metadata, column, dictionary, columnlist, NESTED_DELIM)
+    assert (to_csv(lookup, columnlist, None)
+            == read_fixture(f'metadata_{column}.csv'))
+
+
+COPY_QUERY = "COPY metadata_subjects_scratch FROM 's3://bucket/batch';\n"
+
+
+def test_load_query_swap():
+    query = load_query('metadata_subjects', COPY_QUERY, 'swap', 'node_id')
+    assert query.endswith(
+        COPY_QUERY
+        + 'ALTER TABLE metadata_subjects RENAME TO metadata_subjects_old;\n'
+        'ALTER TABLE metadata_subjects_scratch RENAME TO metadata_subjects;\n'
+        'DROP TABLE metadata_subjects_old;\n')
+
+
+def test_load_query_diff_aliases_subqueries():
+    query = load_query('metadata_subjects', COPY_QUERY, 'diff', 'node_id')
+    # Redshift rejects a subquery in FROM without an alias, so each one
+    # must be followed by AS and a name once its parentheses close
+    for match in re.finditer(r'FROM \(', query):
+        depth = 0
+        for end in range(match.end() - 1, len(query)):
+            depth += {'(': 1, ')': -1}.get(query[end], 0)
+            if depth == 0:
+                break
+        assert re.match(r'\) AS \w+', query[end:]), query[match.start():end]
+
+
+def test_load_query_diff_applies_changed_keys():
+    '''run the diff statements on sqlite, standing in for Redshift, with a
+    scratch table as the COPY would leave it'''
+    query = load_query('lookup', COPY_QUERY, 'diff', 'node_id')
+    diff_query = query[query.index(COPY_QUERY) + len(COPY_QUERY):]
+    table = [('A1', 1), ('A1', 2), ('B2', 1), ('C3', 3), ('C3', 3),
+             ('D4', 2)]
+    scratch = [('A1', 1), ('A1', 3),  # a row changed
+               ('B2', 1),  # unchanged
+               ('C3', 3),  # a duplicate row removed
+               ('E5', 1)]  # a node added, and D4 removed
+    con = sqlite3.connect(':memory:')
+    for name, rows in (('lookup', table), ('lookup_scratch', scratch)):
+        con.execute(f'CREATE TABLE {name} (node_id TEXT, lookup_id INTEGER)')
+        con.executemany(f'INSERT INTO {name} VALUES (?, ?)', rows)
+    con.executescript(diff_query)
+    assert (sorted(con.execute('SELECT * FROM lookup').fetchall())
+            == sorted(scratch))
+
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def test_format_dates_iso8601():
+    dates = pd.Series(['2021-03-04 05:06:07', None, '2021-03-05T01:02:03.5'])
+    assert (format_dates(dates, DATE_FORMAT, 'ISO8601').tolist()
+            == ['2021-03-04 05:06:07', '', '2021-03-05 01:02:03'])
+
+
+@pytest.mark.filterwarnings('ignore::FutureWarning')
+@pytest.mark.parametrize('input_format', [None, 'ISO8601'])
+def test_format_dates_mixed_offsets(input_format):
+    dates = pd.Series(
+        ['2021-01-04 05:06:07-08:00', None, '2021-06-04 05:06:07-07:00'])
+    assert (format_dates(dates, DATE_FORMAT, input_format).tolist()
+            == ['2021-01-04 05:06:07', '', '2021-06-04 05:06:07'])
+
+
+def test_format_dates_unparsable():
+    dates = pd.Series(['2021-01-04 05:06:07', 'not a date'])
+    with pytest.raises(ValueError):
+        format_dates(dates, DATE_FORMAT, 'ISO8601')
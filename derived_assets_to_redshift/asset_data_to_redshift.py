@@ -13,6 +13,12 @@
 #
 #
 # Usage         : python asset_data_to_redshift.py configfile.json
+#               :
+#               : Several config files may be passed in one invocation:
+#               : python asset_data_to_redshift.py config.d/*_assets.json
+#               : The sites are parsed concurrently in a shared worker pool,
+#               : sharing the S3 client, the Redshift connection and the
+#               : user agent and referrer parser caches.
 #
 
 # Exit codes
@@ -26,24 +32,39 @@ EX_IOERR = 74      # input/output error
 EX_NOPERM = 77     # permission denied
 EX_CONFIG = 78     # configuration error
 
+# Maximum number of sites parsed at the same time in a multi-config run
+MAX_WORKERS = 4
+# Number of distinct user agent and referrer strings to keep parsed results for
+PARSER_CACHE_SIZE = 65536
+# Default number of days of line hashes kept by the optional dedupe stage
+DEDUPE_RETENTION_DAYS = 14
+
 
 import re  # regular expressions
-from io import StringIO
+from io import StringIO, BufferedReader, TextIOWrapper
+import gzip
+import bz2
+from array import array
+import hashlib
 import os  # to read environment variables
 import json  # to read json config files
 import sys  # to read command line parameters
 import os.path  # file handling
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 here = os.path.dirname(os.path.abspath(__file__))
 branch_root = os.path.abspath(os.path.join(here, ".."))
 if branch_root not in sys.path:
     sys.path.insert(0, branch_root)
 import lib.logs as log
-from datetime import datetime
+from datetime import datetime, timedelta
 from tzlocal import get_localzone
 from pytz import timezone
 import boto3  # s3 access
 from botocore.exceptions import ClientError
+import numpy as np
 import pandas as pd  # data processing
 import pandas.errors
 from lib.redshift import RedShift
@@ -56,11 +77,13 @@ from referer_parser import Referer
 # referer_parser documentation:
 # https://github.com/snowplow-referer-parser/referer-parser
 
+try:
+    import zstandard  # only required to read .zst uploads
+except ImportError:
+    zstandard = None
+
 local_tz = get_localzone()
 yvr_tz = timezone('America/Vancouver')
-yvr_dt_start = (yvr_tz
-                .normalize(datetime.now(local_tz)
-                           .astimezone(yvr_tz)))
 
 logger = logging.getLogger(__name__)
 log.setup()
@@ -73,86 +96,117 @@ def clean_exit(code, message):
     sys.exit(code)
 
 
-# check that configuration file was passed as argument
-if (len(sys.argv) != 2):
-    print('Usage: python asset_data_to_redshift.py config.json')
+# check that at least one configuration file was passed as argument
+if (len(sys.argv) < 2):
+    print('Usage: python asset_data_to_redshift.py config.json [config.json ...]')
     clean_exit(EX_USAGE, 'Bad command use.')# Exit with EX_USAGE for command line error
-configfile = sys.argv[1]
-# confirm that the file exists
-if os.path.isfile(configfile) is False:
-    print("Invalid file name {}".format(configfile))
-    clean_exit(EX_NOINPUT, 'Bad file name.')  # Exit with EX_NOINPUT for missing input file
-# open the confifile for reading
-try:
-    with open(configfile) as f:
-        data = json.load(f)
-except json.JSONDecodeError:
-    print("Configuration file has an invalid format.")
-    clean_exit(EX_SOFTWARE, 'Configuration file format error')  # Exit with EX_SOFTWARE for config issue
-
-
-if 'empty_files_ok' in data:
-    empty_files_ok = data['empty_files_ok']
-else:
-    empty_files_ok = False
-
-# get variables from config file
-if 'bucket' not in data:
-    clean_exit(EX_CONFIG, "Missing required 'bucket' key in config.")
-else:
-    bucket = data['bucket']
-
-if 'source' not in data:
-    clean_exit(EX_CONFIG, "Missing required 'source' key in config.")
-else:
-    source = data['source']
-
-if 'destination' not in data:
-    clean_exit(EX_CONFIG, "Missing required 'destination' key in config.")
-else:
-    destination = data['destination']
-
-directory = data['directory']
-doc = data['doc']
-if 'dbschema' in data:
-    dbschema = data['dbschema']
-else:
-    dbschema = 'microservice'
-dbtable = data['dbtable']
-table_name = dbtable[dbtable.rfind(".")+1:]
-column_count = data['column_count']
-columns = data['columns']
-dtype_dic = {}
-if 'dtype_dic_strings' in data:
-    for fieldname in data['dtype_dic_strings']:
-        dtype_dic[fieldname] = str
-if 'dtype_dic_bools' in data:
-    for fieldname in data['dtype_dic_bools']:
-        dtype_dic[fieldname] = bool
-delim = data['delim']
-
-if 'truncate' in data:
-    truncate = data['truncate']
-else:
-    truncate = False
-
-if 'drop_columns' in data:
-    drop_columns = data['drop_columns']
-else:
-    drop_columns = {}
-truncate_intermediate_table = 'TRUNCATE TABLE ' + dbtable + ';'
+configfiles = sys.argv[1:]
+
+
+def load_config(configfile):
+    '''reads a config file and returns the settings for that site'''
+    # confirm that the file exists
+    if os.path.isfile(configfile) is False:
+        print("Invalid file name {}".format(configfile))
+        clean_exit(EX_NOINPUT, 'Bad file name.')  # Exit with EX_NOINPUT for missing input file
+    # open the confifile for reading
+    try:
+        with open(configfile) as f:
+            data = json.load(f)
+    except json.JSONDecodeError:
+        print("Configuration file has an invalid format.")
+        clean_exit(EX_SOFTWARE, 'Configuration file format error')  # Exit with EX_SOFTWARE for config issue
+
+    # get variables from config file
+    for required in ('bucket', 'source', 'destination'):
+        if required not in data:
+            clean_exit(EX_CONFIG, f"Missing required '{required}' key in config.")
+
+    dbtable = data['dbtable']
+    dtype_dic = {}
+    if 'dtype_dic_strings' in data:
+        for fieldname in data['dtype_dic_strings']:
+            dtype_dic[fieldname] = str
+    if 'dtype_dic_bools' in data:
+        for fieldname in data['dtype_dic_bools']:
+            dtype_dic[fieldname] = bool
+
+    # The config contains regex's that correspond to the number of columns
+    # in the log entry; compile them once per site rather than per line
+    regexs = []
+    if 'access_log_parse' in data:
+        regexs = [(re.compile(exp['pattern']), exp['replace'])
+                  for exp in data['access_log_parse']['regexs']]
+
+    return {
+        'configfile': configfile,
+        'data': data,
+        'empty_files_ok': data.get('empty_files_ok', False),
+        'bucket': data['bucket'],
+        'source': data['source'],
+        'destination': data['destination'],
+        'directory': data['directory'],
+        'doc': data['doc'],
+        'dbschema': data.get('dbschema', 'microservice'),
+        'dbtable': dbtable,
+        'table_name': dbtable[dbtable.rfind(".")+1:],
+        'column_count': data['column_count'],
+        'columns': data['columns'],
+        'dtype_dic': dtype_dic,
+        'delim': data['delim'],
+        'truncate': data.get('truncate', False),
+        'drop_columns': data.get('drop_columns', {}),
+        'truncate_intermediate_table': 'TRUNCATE TABLE ' + dbtable + ';',
+        'regexs': regexs,
+        'dedupe': data.get('dedupe'),
+        # line hashes seen per day partition, loaded lazily by the dedupe stage
+        'seen': {},
+        'seen_changed': set(),
+        # line hashes of the object being parsed, per day partition
+        'object_seen': {},
+    }
+
+
+sites = [load_config(configfile) for configfile in configfiles]
+
 # Suppresses boto3's Python 3.9 PythonDeprecationWarning
 with warnings.catch_warnings():
     warnings.filterwarnings("ignore",category=Warning)
-    # set up S3 connection
+    # set up S3 connection. The low-level client is thread safe, so a single
+    # client is shared by every site in the worker pool.
     client = boto3.client('s3')  # low-level functional API
-    resource = boto3.resource('s3')  # high-level object-oriented API
-my_bucket = resource.Bucket(bucket)  # subsitute this for your s3 bucket name.
-bucket_name = my_bucket.name
 
-
-# Constructs the database copy query string
-def copy_query(dbtable, batchfile, log):
+# A single Redshift connection is shared by every site. The sites also share
+# the intermediate table, so each site holds this lock for the whole of its
+# Redshift work; parsing and batch uploads still run concurrently.
+redshift_lock = threading.Lock()
+spdb = None
+
+
+def redshift_connection(batchfile):
+    '''returns the shared Redshift connection, opening it on first use'''
+    global spdb
+    if spdb is None:
+        spdb = RedShift.snowplow(batchfile)
+    spdb.batchfile = batchfile
+    return spdb
+
+
+@lru_cache(maxsize=1)
+def slice_count():
+    '''returns the number of slices in the Redshift cluster'''
+    with redshift_lock:
+        conn = redshift_connection('stv_slices').connection
+        with conn:
+            with conn.cursor() as curs:
+                curs.execute('SELECT COUNT(*) FROM stv_slices;')
+                return curs.fetchone()[0]
+
+
+# Constructs the database copy query string. A batchfile ending in
+# .manifest is loaded as a manifest listing the batch file parts.
+def copy_query(bucket_name, dbtable, batchfile, log):
+    manifest = ' MANIFEST' if batchfile.endswith('.manifest') else ''
     try:
         aws_key = 'AWS_ACCESS_KEY_ID' if log else os.environ['AWS_ACCESS_KEY_ID']
         aws_secret_key = 'AWS_SECRET_ACCESS_KEY' if log else os.environ['AWS_SECRET_ACCESS_KEY']
@@ -161,26 +215,25 @@ def copy_query(dbtable, batchfile, log):
     query = """
 COPY {0}\nFROM 's3://{1}/{2}'\n\
 CREDENTIALS 'aws_access_key_id={3};aws_secret_access_key={4}'\n\
-IGNOREHEADER AS 1 MAXERROR AS 0 DELIMITER '|' NULL AS '-' ESCAPE;\n
-""".format(dbtable, bucket_name, batchfile, aws_key, aws_secret_key)
+IGNOREHEADER AS 1 MAXERROR AS 0 DELIMITER '|' NULL AS '-' ESCAPE{5};\n
+""".format(dbtable, bucket_name, batchfile, aws_key, aws_secret_key, manifest)
     return query
 
 
 # Check to see if the file has been processed already
-def is_processed(object_summary):
-    key = object_summary.key
+def is_processed(site, key):
     filename = key[key.rfind('/')+1:]  # get the filename (after the last '/')
-    goodfile = destination + "/good/" + key
-    badfile = destination + "/bad/" + key
+    goodfile = site['destination'] + "/good/" + key
+    badfile = site['destination'] + "/bad/" + key
     try:
-        client.head_object(Bucket=bucket, Key=goodfile)
+        client.head_object(Bucket=site['bucket'], Key=goodfile)
     except ClientError:
         pass  # this object does not exist under the good destination path
     else:
         logger.info("{0} was processed as good already.".format(filename))
         return True
     try:
-        client.head_object(Bucket=bucket, Key=badfile)
+        client.head_object(Bucket=site['bucket'], Key=badfile)
     except ClientError:
         pass  # this object does not exist under the bad destination path
     else:
@@ -190,417 +243,335 @@ def is_processed(object_summary):
     return False
 
 
-#delete the file from processed folder in s3
-def cleanup(object_keys, path):
-   for key in object_keys: 
-        #store the filename that was processed       
-        filename = f'{destination}/{path}/{key}'
-        #deletes the processed file
+def delete_keys(bucket, keys):
+    '''deletes keys from a bucket, up to 1000 keys per request'''
+    for i in range(0, len(keys), 1000):
         try:
-            client.delete_object(Bucket=bucket, Key=filename)
+            response = client.delete_objects(
+                Bucket=bucket,
+                Delete={'Objects': [{'Key': key} for key in keys[i:i+1000]],
+                        'Quiet': True})
         except ClientError as e:
-            clean_exit(EX_IOERR, f"Failed to delete object {filename} from S3: {e}")
+            clean_exit(EX_IOERR, f"Failed to delete objects from S3: {e}")
+        for error in response.get('Errors', []):
+            clean_exit(EX_IOERR,
+                       f"Failed to delete object {error['Key']} from S3: "
+                       f"{error['Message']}")
+
+
+#delete the files from processed folder in s3
+def cleanup(site, object_keys, path):
+    delete_keys(site['bucket'],
+                [f"{site['destination']}/{path}/{key}" for key in object_keys])
 
 
-def report(data):
-    '''reports out the data from the main program loop'''
+def report(site, data):
+    '''reports out the data from a site's processing loop and returns the
+    exit code that the site's results warrant'''
     # if no objects were processed; do not print a report
     if data["objects"] == 0:
-        clean_exit(EX_NOINPUT, "No objects to process.")
+        logger.info('%s: No objects to process.', site['configfile'])
+        return EX_NOINPUT
     print(f'Report: {__file__}\n')
-    print(f'Config: {configfile}\n')
+    print(f'Config: {site["configfile"]}\n')
     # get times from system and convert to Americas/Vancouver for printing
-    yvr_dt_end = (yvr_tz
-                  .normalize(datetime.now(local_tz)
-                             .astimezone(yvr_tz)))
     print(
         'Microservice started at: '
-        f'{yvr_dt_start.strftime("%Y-%m-%d %H:%M:%S%z (%Z)")}, '
-        f'ended at: {yvr_dt_end.strftime("%Y-%m-%d %H:%M:%S%z (%Z)")}, '
-        f'elapsing: {yvr_dt_end - yvr_dt_start}.\n')
+        f'{data["started"].strftime("%Y-%m-%d %H:%M:%S%z (%Z)")}, '
+        f'ended at: {data["ended"].strftime("%Y-%m-%d %H:%M:%S%z (%Z)")}, '
+        f'elapsing: {data["ended"] - data["started"]}.\n')
     print(f'Objects to process: {data["objects"]}')
     print(f'Objects successfully processed: {data["processed"]}')
     print(f'Objects that failed to process: {data["failed"]}')
     print(f'Objects output to \'processed/good\': {data["good"]}')
     print(f'Objects output to \'processed/bad\': {data["bad"]}')
     print(f'Objects loaded to Redshift: {data["loaded"]}')
-    print(f'Empty Objects: {data["empty"]}\n')
+    print(f'Empty Objects: {data["empty"]}')
+    print(f'Duplicate lines dropped: {data["duplicates"]}\n')
 
+    code = EX_OK
     if data['good_list']:
         print(
         "List of objects successfully fully ingested from S3, processed, "
         "loaded to S3 ('good'), and copied to Redshift:")
-        for i, meta in enumerate(data['good_list'], 1):
-            print(f"{i}: {meta.key}")
+        for i, key in enumerate(data['good_list'], 1):
+            print(f"{i}: {key}")
     if data['bad_list']:
         print('\nList of objects that failed to process:')
-        for i, meta in enumerate(data['bad_list']):
-            print(f"{i}: {meta.key}")
+        for i, key in enumerate(data['bad_list']):
+            print(f"{i}: {key}")
     if data['incomplete_list']:
         print('\nList of objects that were not processed due to early exit:')
-        for i, meta in enumerate(data['incomplete_list']):
-            print(f"{i}: {meta.key}")
-        clean_exit(EX_DATAERR, "Some objects were not processed due to early exit.")
+        for i, key in enumerate(data['incomplete_list']):
+            print(f"{i}: {key}")
+        logger.info('%s: Some objects were not processed due to early exit.',
+                    site['configfile'])
+        code = EX_DATAERR
     if data['empty_list']:
         print('\nList of empty objects:')
-        for i, meta in enumerate(data['empty_list']):
-            print(f"{i}: {meta.key}")
-        clean_exit(EX_DATAERR, "Some objects were empty.")
-
-
-# This bucket scan will find unprocessed objects.
-# objects_to_process will contain zero or one objects if truncate = True
-# objects_to_process will contain zero or more objects if truncate = False
-objects_to_process = []
-for object_summary in my_bucket.objects.filter(Prefix=source + "/"
-                                               + directory + "/"):
-    key = object_summary.key
-    # skip to next object if already processed
-    if is_processed(object_summary):
-        continue
+        for i, key in enumerate(data['empty_list']):
+            print(f"{i}: {key}")
+        logger.info('%s: Some objects were empty.', site['configfile'])
+        code = EX_DATAERR
+    if data['code'] != EX_OK:
+        code = data['code']
+    print()
+    return code
+
+
+def now_yvr():
+    '''returns the current time in America/Vancouver'''
+    return yvr_tz.normalize(datetime.now(local_tz).astimezone(yvr_tz))
+
+
+@lru_cache(maxsize=PARSER_CACHE_SIZE)
+def ua_columns(user_agent):
+    '''returns the os and browser columns parsed from a user agent string'''
+    parsed_ua = user_agent_parser.Parse(user_agent)
+
+    # Add OS family and version to user agent string
+    ua_string = '|' + parsed_ua['os']['family']
+    if parsed_ua['os']['major'] is not None:
+        ua_string += '|' + parsed_ua['os']['major']
+        if parsed_ua['os']['minor'] is not None:
+            ua_string += '.' + parsed_ua['os']['minor']
+        if parsed_ua['os']['patch'] is not None:
+            ua_string += '.' + parsed_ua['os']['patch']
     else:
-        # only review those matching our configued 'doc' regex pattern
-        if re.search(doc + '$', key):
-            # under truncate = True, we will keep list length to 1
-            # only adding the most recently modified file to objects_to_process
-            if truncate:
-                if len(objects_to_process) == 0:
-                    objects_to_process.append(object_summary)
-                    continue
-                else:
-                    # compare last modified dates of the latest and current obj
-                    if (object_summary.last_modified
-                            > objects_to_process[0].last_modified):
-                        objects_to_process[0] = object_summary
-            else:
-                # no truncate, so the list may exceed 1 element
-                objects_to_process.append(object_summary)
-
-# an object exists to be processed as a truncate copy to the table
-if truncate and len(objects_to_process) == 1:
-    logger.info(
-        'truncate is set. processing only one file: {0} (modified {1})'.format(
-            objects_to_process[0].key, objects_to_process[0].last_modified))
-
-# Reporting variables. Accumulates as the the loop below is traversed
-report_stats = {
-    'objects': 0,
-    'processed': 0,
-    'failed': 0,
-    'good': 0,
-    'bad': 0,
-    'loaded': 0,
-    'empty': 0,
-    'good_list': [],
-    'bad_list': [],
-    'empty_list': [],
-    'incomplete_list': []
-}
-
-report_stats['objects'] = len(objects_to_process)
-report_stats['incomplete_list'] = objects_to_process.copy()
-# list to keep track of objects
-good_objects = []
-path = ''
-
-
-# clean up the intermediate table
-bad_table_cleanup = r'''
-BEGIN;
--- clean up the intermediate table with bad data
-{truncate_intermediate_table}
-COMMIT;
-'''.format(truncate_intermediate_table=truncate_intermediate_table)
-
-# process the objects that were found during the earlier directory pass
-for object_summary in objects_to_process:
-    batchfile = destination + "/batch/" + object_summary.key
-    goodfile = destination + "/good/" + object_summary.key
-    badfile = destination + "/bad/" + object_summary.key
-    
-    spdb = RedShift.snowplow(batchfile) 
+        ua_string += '|'
 
-    # get the object from S3 and take its contents as body
-    obj = client.get_object(Bucket=bucket, Key=object_summary.key)
+    # Add Browser family and version to user agent string
+    ua_string += '|' + parsed_ua['user_agent']['family']
+    if parsed_ua['user_agent']['major'] is not None:
+        ua_string += '|' + parsed_ua['user_agent']['major']
+    else:
+        ua_string += '|' + 'NULL'
+    if parsed_ua['user_agent']['minor'] is not None:
+        ua_string += '.' + parsed_ua['user_agent']['minor']
+    if parsed_ua['user_agent']['patch'] is not None:
+        ua_string += '.' + parsed_ua['user_agent']['patch']
+    return ua_string
+
+
+@lru_cache(maxsize=PARSER_CACHE_SIZE)
+def referrer_columns(referrer_url, scheme_and_authority):
+    '''returns the referrer term and medium columns for a referrer url'''
+    parsed_referrer_url = Referer(referrer_url, scheme_and_authority)
+
+    # Add referrer term and medium to referrer string
+    referrer_string = ''
+    if parsed_referrer_url.referer is not None:
+        referrer_string += '|' + parsed_referrer_url.referer
+    else:
+        referrer_string += '|'
+    if parsed_referrer_url.medium is not None:
+        referrer_string += '|' + parsed_referrer_url.medium
+    else:
+        referrer_string += '|'
+    return referrer_string
 
-    # The file is an empty upload. Key to badfile and stop processing further.
-    if ((obj['ContentLength'] == 0) and (not empty_files_ok)):
-        logger.info('%s is empty, keying to badfile and no further processing.',
-                     object_summary.key)
-        outfile = badfile
-        #if there are any files in processed/good folder that were processed
-        #before this bad file was hit, then delete it
-        try:
-            if good_objects:
-                cleanup(good_objects, path)
-                report_stats['good'] = 0
-                report_stats['loaded'] = 0
-                report_stats['good_list'] = 0
-        except ClientError:
-            logger.exception("S3 delete failed")
-            clean_exit(EX_SOFTWARE, "Failed to delete good objects due to ClientError.")
-        
-        try:
-            client.copy_object(Bucket=f"{bucket}",
-                               CopySource=f"{bucket}/{object_summary.key}",
-                               Key=outfile)
-        except ClientError:
-            logger.exception("S3 transfer failed")
-        report_stats['empty'] += 1
-        report_stats['bad'] += 1
-        report_stats['bad_list'].append(object_summary)
-        report_stats['empty_list'].append(object_summary)
-        report_stats['incomplete_list'].remove(object_summary)
-
-        report(report_stats)
-        #clean up the intermediate table if bad file is hit
-        spdb.query(bad_table_cleanup)
-        spdb.close_connection()
-        clean_exit(EX_DATAERR, f'Bad file {object_summary.key} in objects to process, no further processing.')
-    elif((obj['ContentLength'] == 0) and (empty_files_ok)):
-        logger.info('%s is empty, but empty files are set to be ok.',
-                     object_summary.key)
-        report_stats['empty'] += 1
-        report_stats['empty_list'].append(object_summary)
 
-    body = obj['Body']
+def dedupe_prefix(site):
+    '''returns the S3 prefix holding a site's persisted line hashes'''
+    return (f"{site['destination']}/dedupe/{site['directory']}/"
+            f"{site['data']['asset_host']}/")
 
-    # Create an object to hold the data while parsing
-    csv_string = ''
 
-    # Perform apache access log parsing according to config, if defined
-    if 'access_log_parse' in data:
-        linefeed = ''
-        parsed_list = []
-        if(data['access_log_parse']['string_repl']):
-            inline_pattern = data['access_log_parse']['string_repl']['pattern']
-            inline_replace = data['access_log_parse']['string_repl']['replace']
-        body_stringified = body.read().decode('utf-8')
-        # perform regex replacements by line
-        for line in body_stringified.splitlines():
-            # Replace pipe char with encoded version, %7C
-            if(data['access_log_parse']['string_repl']):
-                line = line.replace(inline_pattern, inline_replace)
-            # The config contains regex's that correspond to the
-            # number of columns in the log entry.
-            # This is necessary because some log entries do not
-            # have the tenth column for server response time in ms.
-            # Check if there are 9 or 10 columns in access log entry by
-            # attempting to apply these regex's until finding one that parses.
-            for exp in data['access_log_parse']['regexs']:
-                parsed_line, num_subs = re.subn(
-                    exp['pattern'], exp['replace'], line)
-                # If a match for the replacement pattern is found,
-                # construct the parsed line
-                if num_subs:
-                    # Extract user_agent and referrer_url from log entry.
-                    # The field names referenced here are only for
-                    # use with the third party libraries. The field
-                    # names for the table are set in the config.
-                    user_agent = re.match(exp['pattern'], line).group(9)
-                    referrer_url = re.match(exp['pattern'], line).group(8)
-
-                    # Parse user_agent and referrer strings into lists
-                    parsed_ua = user_agent_parser.Parse(user_agent)
-                    parsed_referrer_url = Referer(referrer_url,
-                                                  data['asset_scheme_and_authority'])
-
-                    # Add OS family and version to user agent string
-                    ua_string = '|' + parsed_ua['os']['family']
-                    if parsed_ua['os']['major'] is not None:
-                        ua_string += '|' + parsed_ua['os']['major']
-                        if parsed_ua['os']['minor'] is not None:
-                            ua_string += '.' + parsed_ua['os']['minor']
-                        if parsed_ua['os']['patch'] is not None:
-                            ua_string += '.' + parsed_ua['os']['patch']
-                    else:
-                        ua_string += '|'
-
-                    # Add Browser family and version to user agent string
-                    ua_string += '|' + parsed_ua['user_agent']['family']
-                    if parsed_ua['user_agent']['major'] is not None:
-                        ua_string += '|' + parsed_ua['user_agent']['major']
-                    else:
-                        ua_string += '|' + 'NULL'
-                    if parsed_ua['user_agent']['minor'] is not None:
-                        ua_string += '.' + parsed_ua['user_agent']['minor']
-                    if parsed_ua['user_agent']['patch'] is not None:
-                        ua_string += '.' + parsed_ua['user_agent']['patch']
-
-                    # Add referrer term and medium to referrer string
-                    referrer_string = ''
-                    if parsed_referrer_url.referer is not None:
-                        referrer_string += '|' + parsed_referrer_url.referer
-                    else:
-                        referrer_string += '|'
-                    if parsed_referrer_url.medium is not None:
-                        referrer_string += '|' + parsed_referrer_url.medium
-                    else:
-                        referrer_string += '|'
-
-                    # Determine the end of line char:
-                    # Use linefeed if defined in config, or default "/r/n"
-                    if(data['access_log_parse']['linefeed']):
-                        linefeed = data['access_log_parse']['linefeed']
-                    else:
-                        linefeed = '\r\n'
-
-                    # Form the now parsed log entry line
-                    parsed_line += ua_string + referrer_string
-
-                    # Add the parsed log entry line to the list
-                    parsed_list.append(parsed_line)
-
-                    # Break after first match
-                    break
-
-        # Concatenate all the parsed lines together with the end of line char
-        csv_string = linefeed.join(parsed_list)
-        logger.info(object_summary.key + " parsed successfully")
-
-    # This is not an apache access log
-    if 'access_log_parse' not in data:
-        csv_string = body.read()
-
-    # Check that the file decodes as UTF-8. If it fails move to bad and end
-    if not isinstance(csv_string, str):
-        try:
-            csv_string = csv_string.decode('utf-8')
-        except UnicodeDecodeError as e:
-            report_stats['failed'] += 1
-            report_stats['bad'] += 1
-            report_stats['bad_list'].append(object_summary)
-            report_stats['incomplete_list'].remove(object_summary)
-            e_object = e.object.splitlines()
-            logger.exception(
-                ''.join((
-                    "Decoding UTF-8 failed for file {0}\n"
-                    .format(object_summary.key),
-                    "The input file stopped parsing after line {0}:\n{1}\n"
-                    .format(len(e_object), e_object[-1]),
-                    "Keying to badfile and skipping.\n")))
-            #if there are any files in processed/good folder that were processed
-            #before this bad file was hit, then delete it
+def seen_hashes(site, day):
+    '''returns the sorted array of line hashes seen for a day in an earlier
+    run or an earlier object of this run, reading the persisted hashes from S3
+    the first time the day is requested. Under truncate the table is replaced
+    by a single object, so earlier runs are not read.'''
+    if day not in site['seen']:
+        hashes = np.empty(0, dtype=np.uint64)
+        if not site['truncate']:
             try:
-                if good_objects:
-                    cleanup(good_objects, path)
-                    report_stats['good'] = 0
-                    report_stats['loaded'] = 0
-                    report_stats['good_list'] = 0
-                    
-            except ClientError:
-                logger.exception("S3 delete failed")
-                clean_exit(EX_SOFTWARE, "Failed to delete good objects due to ClientError.")
+                obj = client.get_object(Bucket=site['bucket'],
+                                        Key=dedupe_prefix(site) + day)
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'NoSuchKey':
+                    raise
+            else:
+                hashes = np.frombuffer(obj['Body'].read(), dtype=np.uint64)
+        site['seen'][day] = hashes
+    return site['seen'][day]
 
-            try:
-                client.copy_object(
-                    Bucket="sp-ca-bc-gov-131565110619-12-microservices",
-                    CopySource="sp-ca-bc-gov-131565110619-12-microservices/"
-                    + object_summary.key, Key=badfile)
-            except Exception as e:
-                logger.exception("S3 transfer failed.\n{0}".format(e.message))
-                clean_exit(EX_IOERR, "Failed to copy object to bad file.")
-            report(report_stats)
-            #clean up the intermediate table if bad file is hit
-            spdb.query(bad_table_cleanup)
-            spdb.close_connection()
-            clean_exit(EX_DATAERR, f'Bad file {object_summary.key} in objects to process, no further processing.')
-    else:
-        report_stats['processed'] += 1
 
-    # Check for an empty file. If it's empty, accept it as bad and skip
-    # to the next object to process
+@lru_cache(maxsize=1024)
+def log_day(timestamp):
+    '''returns the ISO day of an access log timestamp, or None if the
+    timestamp cannot be parsed'''
     try:
-        df = pd.read_csv(
-            StringIO(csv_string),
-            sep=delim,
-            index_col=False,
-            dtype=dtype_dic,
-            usecols=range(column_count),
-            names=columns)
-    except pandas.errors.EmptyDataError as _e:
-        report_stats['failed'] += 1
-        report_stats['bad'] += 1
-        report_stats['bad_list'].append(object_summary)
-        report_stats['incomplete_list'].remove(object_summary)
-        logger.exception('exception reading {0}'.format(object_summary.key))
-        if (str(_e) == "No columns to parse from file"):
-            logger.warning('File is empty, keying to badfile \
-                           and proceeding.')
-            outfile = badfile
-        else:
-            logger.warning('File not empty, keying to badfile \
-                           and proceeding.')
-            outfile = badfile
-
-        #if there are any files in processed/good folder that were processed
-        #before this bad file was hit, then delete it
-        try:
-            if good_objects:
-                cleanup(good_objects, path)
-                report_stats['good'] = 0
-                report_stats['loaded'] = 0
-                report_stats['good_list'] = 0
-        except ClientError:
-            logger.exception("S3 delete failed")
-            clean_exit(EX_SOFTWARE, "Failed to delete good objects due to ClientError.")
-
-        try:
-            client.copy_object(Bucket=f"{bucket}",
-                               CopySource=f"{bucket}/{object_summary.key}",
-                               Key=outfile)
-        except ClientError:
-            logger.exception("S3 transfer failed")
-            clean_exit(EX_IOERR, "Failed to copy object")
-        report(report_stats)
-        #clean up the intermediate table if bad file is hit
-        spdb.query(bad_table_cleanup)
-        spdb.close_connection()
-        clean_exit(EX_DATAERR, f'Bad file {object_summary.key} in objects to process, no further processing.')
+        return datetime.strptime(timestamp[:11], '%d/%b/%Y').strftime('%Y-%m-%d')
     except ValueError:
-        report_stats['failed'] += 1
-        report_stats['bad'] += 1
-        report_stats['bad_list'].append(object_summary)
-        report_stats['incomplete_list'].remove(object_summary)
-        logger.exception('ValueError exception reading %s', object_summary.key)
-        logger.warning('Keying to badfile and proceeding.')
-        outfile = badfile
-        #if there are any files in processed/good folder that were processed
-        #before this bad file was hit, then delete it
-        try:
-            if good_objects:
-                cleanup(good_objects, path)
-                report_stats['good'] = 0
-                report_stats['loaded'] = 0
-                report_stats['good_list'] = 0
-        except ClientError:
-            logger.exception("S3 delete failed")
-            clean_exit(EX_SOFTWARE, "Failed to delete good objects due to ClientError.")
+        return None
+
+
+def is_duplicate(site, line, timestamp):
+    '''returns True if a log line was seen in an earlier object, in this run
+    or an earlier one, for the day of its timestamp; otherwise records it
+    against the object being parsed. A line repeated within one object is
+    kept, since each repeat is a separate download.
+
+    A 64 bit hash of each line is kept exactly rather than in a Bloom filter,
+    since a Bloom filter's false positives would silently drop unique
+    downloads. The hashes of each day are held in a sorted numpy array, at
+    8 bytes a line, and looked up by binary search.'''
+    day = log_day(timestamp)
+    if day is None or day < site['dedupe_horizon']:
+        # lines older than the retention window are not deduplicated
+        return False
+    hashes = seen_hashes(site, day)
+    digest = int.from_bytes(
+        hashlib.blake2b(line.encode('utf-8'), digest_size=8).digest(), 'big')
+    position = np.searchsorted(hashes, np.uint64(digest))
+    if position < len(hashes) and hashes[position] == digest:
+        return True
+    site['object_seen'].setdefault(day, array('Q')).append(digest)
+    return False
 
-        try:
-            client.copy_object(Bucket=f"{bucket}",
-                               CopySource=f"{bucket}/{object_summary.key}",
-                               Key=outfile)
-        except ClientError:
-            logger.exception("S3 transfer failed")
-            clean_exit(EX_IOERR, "Failed to copy object")
-        report(report_stats)
-        #clean up the intermediate table if bad file is hit
-        spdb.query(bad_table_cleanup)
-        spdb.close_connection()
-        clean_exit(EX_DATAERR, f'Bad file {object_summary.key} in objects to process, no further processing.')
 
+def remember_object(site):
+    '''merges the line hashes of the object just staged into the hashes of
+    each day, so that its lines are dropped from later objects'''
+    for day, digests in site['object_seen'].items():
+        site['seen'][day] = np.union1d(
+            site['seen'][day], np.frombuffer(digests, dtype=np.uint64))
+        site['seen_changed'].add(day)
+    site['object_seen'] = {}
+
+
+def save_seen(site):
+    '''persists the line hashes of changed days and deletes the hashes of days
+    that have aged out of the retention window'''
+    prefix = dedupe_prefix(site)
+    for day in sorted(site['seen_changed']):
+        client.put_object(Bucket=site['bucket'], Key=prefix + day,
+                          Body=site['seen'][day].tobytes())
+    site['seen_changed'].clear()
+    expired = []
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=site['bucket'], Prefix=prefix):
+        for object_summary in page.get('Contents', []):
+            if object_summary['Key'][len(prefix):] < site['dedupe_horizon']:
+                expired.append(object_summary['Key'])
+    delete_keys(site['bucket'], expired)
+
+
+def open_body(key, body):
+    '''returns a buffered binary stream reading an S3 object body,
+    decompressing .gz, .bz2 and .zst objects as they stream'''
+    if key.endswith('.gz'):
+        return gzip.GzipFile(fileobj=body)
+    if key.endswith('.bz2'):
+        return bz2.BZ2File(body)
+    if key.endswith('.zst'):
+        if zstandard is None:
+            raise ValueError(
+                f'{key} is zstd compressed but zstandard is not installed.')
+        return BufferedReader(zstandard.ZstdDecompressor().stream_reader(body))
+    return BufferedReader(body)
+
+
+def open_text(key, body):
+    '''returns a text stream decoding an S3 object body as UTF-8. Compressed
+    and uncompressed objects are split into lines the same way, with
+    universal newlines.'''
+    return TextIOWrapper(open_body(key, body), encoding='utf-8')
+
+
+def object_lines(key, body):
+    '''yields the lines of an S3 object body as text. The body is decompressed
+    and decoded incrementally, so the whole file is never held in memory.'''
+    return (line.rstrip('\n') for line in open_text(key, body))
+
+
+def parse_access_log(site, key, body, report_stats):
+    '''parses an apache access log body into a delimited string'''
+    data = site['data']
+    linefeed = ''
+    parsed_list = []
+    if(data['access_log_parse']['string_repl']):
+        inline_pattern = data['access_log_parse']['string_repl']['pattern']
+        inline_replace = data['access_log_parse']['string_repl']['replace']
+    # forget the lines of an earlier object that was keyed to bad
+    site['object_seen'] = {}
+    line_number = 0
+    try:
+        for line in object_lines(key, body):
+            line_number += 1
+            # Replace pipe char with encoded version, %7C
+            if(data['access_log_parse']['string_repl']):
+                line = line.replace(inline_pattern, inline_replace)
+            parsed_line = parse_line(site, line, report_stats)
+            if parsed_line is not None:
+                parsed_list.append(parsed_line)
+    except UnicodeDecodeError:
+        logger.error('%s stopped parsing after line %s', key, line_number)
+        raise
+
+    # Determine the end of line char:
+    # Use linefeed if defined in config, or default "/r/n"
+    if parsed_list:
+        linefeed = data['access_log_parse']['linefeed'] or '\r\n'
+
+    # Concatenate all the parsed lines together with the end of line char
+    return linefeed.join(parsed_list)
+
+
+def parse_line(site, line, report_stats):
+    '''parses a single access log line, returning None if no configured
+    pattern matches it or it is a duplicate'''
+    # The config contains regex's that correspond to the
+    # number of columns in the log entry.
+    # This is necessary because some log entries do not
+    # have the tenth column for server response time in ms.
+    # Check if there are 9 or 10 columns in access log entry by
+    # attempting to apply these regex's until finding one that parses.
+    for pattern, replace in site['regexs']:
+        parsed_line, num_subs = pattern.subn(replace, line)
+        # If a match for the replacement pattern is found,
+        # construct the parsed line
+        if num_subs:
+            # Extract user_agent and referrer_url from log entry.
+            # The field names referenced here are only for
+            # use with the third party libraries. The field
+            # names for the table are set in the config.
+            match = pattern.match(line)
+
+            # Drop lines already loaded from an overlapping upload
+            if site['dedupe'] and is_duplicate(site, line, match.group(4)):
+                report_stats['duplicates'] += 1
+                return None
+
+            user_agent = match.group(9)
+            referrer_url = match.group(8)
+
+            # Parse user_agent and referrer strings. Results are cached
+            # across lines, objects and sites.
+            ua_string = ua_columns(user_agent)
+            referrer_string = referrer_columns(
+                referrer_url, site['data']['asset_scheme_and_authority'])
+
+            # Form the now parsed log entry line; only the first match is used
+            return parsed_line + ua_string + referrer_string
+    return None
+
+
+def transform(site, df, key):
+    '''applies the config's column transformations to a dataframe'''
+    data = site['data']
     # Truncate strings according to config set column string length limits
     if 'column_string_limit' in data:
-        for key, value in data['column_string_limit'].items():
+        for column, value in data['column_string_limit'].items():
             try:
-                df[key] = df[key].str.slice(0, value)
-                logger.info(f'Truncated {key} column to {value} characters')
+                df[column] = df[column].str.slice(0, value)
+                logger.info(f'Truncated {column} column to {value} characters')
             except AttributeError:
-                logger.debug(f'Could not enforce string limit on {df[key]} in {object_summary.key}.')
+                logger.debug(f'Could not enforce string limit on {df[column]} in {key}.')
 
     if 'drop_columns' in data:  # Drop any columns marked for dropping
-        df = df.drop(columns=drop_columns)
+        df = df.drop(columns=site['drop_columns'])
 
     # Run replace on some fields to clean the data up
     if 'replace' in data:
@@ -616,114 +587,390 @@ for object_summary in objects_to_process:
             df[thisfield['field']] = \
                 pd.to_datetime(df[thisfield['field']],
                                format=thisfield['format'])
+    return df
+
+
+def derive_query(site):
+    '''builds the derived table query for a site from build_derived_assets.sql'''
+    data = site['data']
+    with open(os.path.join(here, 'ddl', 'build_derived_assets.sql'), 'r') as file:
+        query = file.read()
+    return query.format(
+        schema_name=data['schema_name'],
+        asset_host=data['asset_host'],
+        asset_source=data['asset_source'],
+        asset_scheme_and_authority=data['asset_scheme_and_authority'],
+        truncate_intermediate_table=site['truncate_intermediate_table'])
+
+
+def find_objects(site):
+    '''scans the bucket for objects the site has not yet processed'''
+    # This bucket scan will find unprocessed objects.
+    # objects_to_process will contain zero or one objects if truncate = True
+    # objects_to_process will contain zero or more objects if truncate = False
+    objects_to_process = []
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(
+            Bucket=site['bucket'],
+            Prefix=site['source'] + "/" + site['directory'] + "/"):
+        for object_summary in page.get('Contents', []):
+            key = object_summary['Key']
+            # skip to next object if already processed
+            if is_processed(site, key):
+                continue
+            # only review those matching our configued 'doc' regex pattern
+            if re.search(site['doc'] + '$', key):
+                # under truncate = True, we will keep list length to 1
+                # only adding the most recently modified file to objects_to_process
+                if site['truncate']:
+                    if len(objects_to_process) == 0:
+                        objects_to_process.append(object_summary)
+                    # compare last modified dates of the latest and current obj
+                    elif (object_summary['LastModified']
+                            > objects_to_process[0]['LastModified']):
+                        objects_to_process[0] = object_summary
+                else:
+                    # no truncate, so the list may exceed 1 element
+                    objects_to_process.append(object_summary)
+
+    # an object exists to be processed as a truncate copy to the table
+    if site['truncate'] and len(objects_to_process) == 1:
+        logger.info(
+            'truncate is set. processing only one file: {0} (modified {1})'.format(
+                objects_to_process[0]['Key'],
+                objects_to_process[0]['LastModified']))
+    return [object_summary['Key'] for object_summary in objects_to_process]
+
+
+def key_to_bad(site, report_stats, key, failed=True):
+    '''copies an object to processed/bad and records the site as stopped'''
+    badfile = site['destination'] + "/bad/" + key
+    if failed:
+        report_stats['failed'] += 1
+    report_stats['bad'] += 1
+    report_stats['bad_list'].append(key)
+    report_stats['incomplete_list'].remove(key)
+    try:
+        client.copy_object(Bucket=site['bucket'],
+                           CopySource=f"{site['bucket']}/{key}",
+                           Key=badfile)
+    except ClientError:
+        logger.exception("S3 transfer failed")
+        report_stats['code'] = EX_IOERR
+    else:
+        report_stats['code'] = EX_DATAERR
+    logger.info('Bad file %s in objects to process, no further processing.', key)
 
-    # Put the full data set into a buffer and write it
-    # to a "|" delimited file in the batch directory
-    csv_buffer = StringIO()
-    df.to_csv(csv_buffer, header=True, index=False, sep="|")
-    resource.Bucket(bucket).put_object(Key=batchfile,
-                                       Body=csv_buffer.getvalue())
 
-    # prep database call to pull the batch file into redshift
-    query = copy_query(dbtable, batchfile, log=False)
-    logquery = copy_query(dbtable, batchfile, log=True)
+def stage_object(site, report_stats, key):
+    '''parses an object and writes its batch file to S3. Returns the batch
+    file key, or None if the object was keyed to bad.'''
+    batchfile = site['destination'] + "/batch/" + key
 
-    
+    # get the object from S3 and take its contents as body
+    obj = client.get_object(Bucket=site['bucket'], Key=key)
+
+    # The file is an empty upload. Key to badfile and stop processing further.
+    if ((obj['ContentLength'] == 0) and (not site['empty_files_ok'])):
+        logger.info('%s is empty, keying to badfile and no further processing.',
+                    key)
+        report_stats['empty'] += 1
+        report_stats['empty_list'].append(key)
+        return key_to_bad(site, report_stats, key, failed=False)
+    elif((obj['ContentLength'] == 0) and (site['empty_files_ok'])):
+        logger.info('%s is empty, but empty files are set to be ok.', key)
+        report_stats['empty'] += 1
+        report_stats['empty_list'].append(key)
+
+    body = obj['Body']
+
+    # Create an object to hold the data while parsing
+    csv_string = ''
 
+    # Perform apache access log parsing according to config, if defined
+    try:
+        if 'access_log_parse' in site['data']:
+            csv_string = parse_access_log(site, key, body, report_stats)
+            logger.info(key + " parsed successfully")
+        else:
+            # This is not an apache access log
+            csv_string = open_text(key, body).read()
+    except UnicodeDecodeError as e:
+        # Check that the file decodes as UTF-8. If it fails move to bad and end
+        e_object = e.object[:e.start].splitlines() or [b'']
+        logger.exception(
+            ''.join((
+                "Decoding UTF-8 failed for file {0}\n"
+                .format(key),
+                "The input file stopped parsing at:\n{0}\n"
+                .format(e_object[-1]),
+                "Keying to badfile and skipping.\n")))
+        return key_to_bad(site, report_stats, key)
+    except (OSError, EOFError, ValueError) as e:
+        # The object could not be decompressed. Move to bad and end
+        logger.exception('Reading %s failed: %s', key, e)
+        logger.warning('Keying to badfile and proceeding.')
+        return key_to_bad(site, report_stats, key)
+    report_stats['processed'] += 1
 
-    # if truncate is set to true, perform a transaction that will
-    # replace the existing table data with the new data in one commit
-    # if truncate is not true then the query remains as just the copy command
-    if (truncate):
-        scratch_start = """
+    # Check for an empty file. If it's empty, accept it as bad and skip
+    # to the next object to process
+    try:
+        df = pd.read_csv(
+            StringIO(csv_string),
+            sep=site['delim'],
+            index_col=False,
+            dtype=site['dtype_dic'],
+            usecols=range(site['column_count']),
+            names=site['columns'])
+    except pandas.errors.EmptyDataError as _e:
+        logger.exception('exception reading {0}'.format(key))
+        if (str(_e) == "No columns to parse from file"):
+            logger.warning('File is empty, keying to badfile \
+                           and proceeding.')
+        else:
+            logger.warning('File not empty, keying to badfile \
+                           and proceeding.')
+        return key_to_bad(site, report_stats, key)
+    except ValueError:
+        logger.exception('ValueError exception reading %s', key)
+        logger.warning('Keying to badfile and proceeding.')
+        return key_to_bad(site, report_stats, key)
+
+    df = transform(site, df, key)
+
+    batchfile = write_batch(site, df, batchfile)
+    if site['dedupe']:
+        remember_object(site)
+    return batchfile
+
+
+def write_batch(site, df, batchfile):
+    '''writes a dataframe to "|" delimited batch files and returns the key
+    that the Redshift COPY should load from.
+
+    When batch_parts is configured the rows are split into that many evenly
+    sized parts (or one per cluster slice, if set to "slices") listed in a
+    manifest, so that the COPY loads the parts in parallel across slices.'''
+    parts = site['data'].get('batch_parts', 1)
+    if parts == 'slices':
+        parts = slice_count()
+    parts = max(1, min(int(parts), len(df)))
+
+    if parts == 1:
+        # Put the full data set into a buffer and write it
+        # to a "|" delimited file in the batch directory
+        csv_buffer = StringIO()
+        df.to_csv(csv_buffer, header=True, index=False, sep="|")
+        client.put_object(Bucket=site['bucket'], Key=batchfile,
+                          Body=csv_buffer.getvalue())
+        return batchfile
+
+    entries = []
+    rows_per_part, remainder = divmod(len(df), parts)
+    start = 0
+    for part in range(parts):
+        end = start + rows_per_part + (1 if part < remainder else 0)
+        partfile = f'{batchfile}.{part:04d}'
+        csv_buffer = StringIO()
+        df.iloc[start:end].to_csv(csv_buffer, header=True, index=False, sep="|")
+        client.put_object(Bucket=site['bucket'], Key=partfile,
+                          Body=csv_buffer.getvalue())
+        entries.append({'url': f"s3://{site['bucket']}/{partfile}",
+                        'mandatory': True})
+        start = end
+
+    manifest = batchfile + '.manifest'
+    client.put_object(Bucket=site['bucket'], Key=manifest,
+                      Body=json.dumps({'entries': entries}))
+    logger.info('Wrote %s in %s parts listed in %s', batchfile, parts, manifest)
+    return manifest
+
+
+def staging_queries(site):
+    '''returns the queries that create, promote and drop a site's per-run
+    staging table'''
+    dbtable = site['dbtable']
+    staging_start = """
 BEGIN;
 -- Clean up from last run if necessary
-DROP TABLE IF EXISTS {0}_scratch;
+DROP TABLE IF EXISTS {0}_staging;
 DROP TABLE IF EXISTS {0}_old;
--- Create scratch table to copy new data into
-CREATE TABLE {0}_scratch (LIKE {0});
-ALTER TABLE {0}_scratch OWNER TO microservice;
+-- Create staging table to copy this run's batch files into
+CREATE TABLE {0}_staging (LIKE {0});
+ALTER TABLE {0}_staging OWNER TO microservice;
 -- Grant access to Looker and to Snowplow pipeline users
-GRANT SELECT ON {0}_scratch TO looker;\n
-GRANT SELECT ON {0}_scratch TO datamodeling;\n
+GRANT SELECT ON {0}_staging TO looker;\n
+GRANT SELECT ON {0}_staging TO datamodeling;\n
+COMMIT;
 """.format(dbtable)
 
-        scratch_copy = copy_query(
-            dbtable + "_scratch", batchfile, log=False)
-        scratch_copy_log = copy_query(
-            dbtable + "_scratch", batchfile, log=True)
-
-        scratch_cleanup = """
--- Replace main table with scratch table, clean up the old table
+    # if truncate is set to true, the staging table replaces the existing
+    # table; otherwise its rows are appended to the existing table
+    if (site['truncate']):
+        staging_promote = """
+BEGIN;
+-- Replace main table with staging table, clean up the old table
 ALTER TABLE {0} RENAME TO {1}_old;
-ALTER TABLE {0}_scratch RENAME TO {1};
+ALTER TABLE {0}_staging RENAME TO {1};
 DROP TABLE {0}_old;
 COMMIT;
-""".format(dbtable, table_name)
-
-       
-
-        query = scratch_start + scratch_copy + scratch_cleanup
-        logquery = scratch_start + scratch_copy_log + scratch_cleanup
-
-
-
-    # Execute the transaction against Redshift using the psycopg2 library
-    logger.info(logquery)
-    
-    if spdb.query(query):
-        outfile = goodfile
-        report_stats['loaded'] += 1
+""".format(dbtable, site['table_name'])
     else:
-        outfile = badfile
-
+        staging_promote = """
+BEGIN;
+-- Append the staged rows to the main table, clean up the staging table
+INSERT INTO {0} SELECT * FROM {0}_staging;
+DROP TABLE {0}_staging;
+COMMIT;
+""".format(dbtable)
 
-        
-    # copy the object to the S3 outfile (processed/good/ or processed/bad/)
-    try:
-        client.copy_object(
-            Bucket="sp-ca-bc-gov-131565110619-12-microservices",
-            CopySource="sp-ca-bc-gov-131565110619-12-microservices/"
-            + object_summary.key, Key=outfile)
-    except ClientError:
-        logger.exception("S3 transfer failed")
-        clean_exit(EX_IOERR, "Failed to copy object")
-    else:
-        if outfile == goodfile:
-            path = 'good'
-            good_objects.append(object_summary.key)
-    if outfile == badfile:
-        report_stats['failed'] += 1
-        report_stats['bad'] += 1
-        report_stats['bad_list'].append(object_summary)
-        report_stats['incomplete_list'].remove(object_summary)
-        report(report_stats)
-        #if there are any files in processed/good folder that were processed
-        #before this bad file was hit, then delete it
+    staging_drop = "DROP TABLE IF EXISTS {0}_staging;".format(dbtable)
+    return staging_start, staging_promote, staging_drop
+
+
+def load_site(site, report_stats, staged, derive):
+    '''loads a site's staged batch files into its staging table and promotes
+    them to the site's table in one transaction. A failure at any point is
+    rolled back by dropping the staging table.'''
+    staging_start, staging_promote, staging_drop = staging_queries(site)
+    spdb = redshift_connection(site['dbtable'])
+    if not spdb.query(staging_start):
+        report_stats['code'] = EX_SOFTWARE
+        return
+
+    for key, batchfile in staged:
+        # prep database call to pull the batch file into redshift
+        query = copy_query(
+            site['bucket'], site['dbtable'] + "_staging", batchfile, log=False)
+        logquery = copy_query(
+            site['bucket'], site['dbtable'] + "_staging", batchfile, log=True)
+
+        # Execute the copy against Redshift using the psycopg2 library
+        logger.info(logquery)
+        if not redshift_connection(batchfile).query(query):
+            spdb.query(staging_drop)
+            key_to_bad(site, report_stats, key)
+            return
+
+    # copy the objects to processed/good ahead of the promotion, so that the
+    # archive can be rolled back if the promotion fails
+    good_objects = []
+    for key, _batchfile in staged:
         try:
-            if good_objects:
-                cleanup(good_objects, path)
-                report_stats['good'] = 0
-                report_stats['loaded'] = 0
-                report_stats['good_list'] = 0
+            client.copy_object(
+                Bucket=site['bucket'],
+                CopySource=f"{site['bucket']}/{key}",
+                Key=site['destination'] + "/good/" + key)
         except ClientError:
-            logger.exception("S3 delete failed")
-            clean_exit(EX_SOFTWARE, "Failed to delete good objects due to ClientError.")
-        #clean up the intermediate table if bad file is hit
-        spdb.query(bad_table_cleanup)
-        spdb.close_connection()
-        clean_exit(EX_DATAERR, f'Bad file {object_summary.key} in objects to process, no further processing.')
-    report_stats['good'] += 1
-    report_stats['good_list'].append(object_summary)
-    report_stats['incomplete_list'].remove(object_summary)
-    logger.info("finished %s", object_summary.key)
-    logger.info("finished %s", object_summary.key)
-
-
+            logger.exception("S3 transfer failed")
+            cleanup(site, good_objects, 'good')
+            spdb.query(staging_drop)
+            report_stats['code'] = EX_IOERR
+            return
+        good_objects.append(key)
+
+    spdb.batchfile = site['dbtable']
+    if not spdb.query(staging_promote):
+        cleanup(site, good_objects, 'good')
+        spdb.query(staging_drop)
+        report_stats['code'] = EX_DATAERR
+        logger.info('%s: promoting the staging table failed.',
+                    site['configfile'])
+        return
+
+    for key in good_objects:
+        report_stats['loaded'] += 1
+        report_stats['good'] += 1
+        report_stats['good_list'].append(key)
+        report_stats['incomplete_list'].remove(key)
+        logger.info("finished %s", key)
+
+    # only remember the lines once they have been loaded, so that a
+    # failed run does not drop them as duplicates the next time
+    if site['dedupe'] and not site['truncate']:
+        save_seen(site)
+    if derive:
+        # build the derived table and truncate the intermediate table
+        # while this site still holds the lock
+        if not spdb.query(derive_query(site)):
+            report_stats['code'] = EX_DATAERR
+            logger.info('%s: building the derived table failed.',
+                        site['configfile'])
+
+
+def process_site(site, derive=False):
+    '''processes every unprocessed object for a site and returns its report
+    statistics. If derive is set, the site's derived table is built from the
+    intermediate table before the Redshift lock is released.'''
+    # Reporting variables. Accumulates as the the loop below is traversed
+    report_stats = {
+        'objects': 0,
+        'processed': 0,
+        'failed': 0,
+        'good': 0,
+        'bad': 0,
+        'loaded': 0,
+        'empty': 0,
+        'duplicates': 0,
+        'good_list': [],
+        'bad_list': [],
+        'empty_list': [],
+        'incomplete_list': [],
+        'code': EX_OK,
+        'started': now_yvr(),
+        'ended': None
+    }
+
+    if site['dedupe']:
+        retention = site['dedupe'].get('retention_days', DEDUPE_RETENTION_DAYS)
+        site['dedupe_horizon'] = (
+            report_stats['started'] - timedelta(days=retention)).strftime('%Y-%m-%d')
+
+    objects_to_process = find_objects(site)
+    report_stats['objects'] = len(objects_to_process)
+    report_stats['incomplete_list'] = objects_to_process.copy()
+
+    # Parse and stage each object's batch file. This runs concurrently with
+    # other sites; a bad object stops the site before anything is loaded.
+    staged = []
+    for key in objects_to_process:
+        batchfile = stage_object(site, report_stats, key)
+        if batchfile is None:
+            report_stats['ended'] = now_yvr()
+            return report_stats
+        staged.append((key, batchfile))
+
+    if not staged:
+        report_stats['ended'] = now_yvr()
+        return report_stats
+
+    # load the staged batch files; the intermediate table is shared between
+    # sites, so only one site at a time may work against it
+    with redshift_lock:
+        load_site(site, report_stats, staged, derive)
+
+    report_stats['ended'] = now_yvr()
+    return report_stats
+
+
+# In a multi-config run every site loads into the shared intermediate table,
+# so each site's derived table is built as part of that site's Redshift work.
+derive = len(sites) > 1
+with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(sites))) as executor:
+    results = list(executor.map(lambda site: process_site(site, derive), sites))
+
+# report each site in config order once every site has finished
+exit_codes = [report(site, stats) for site, stats in zip(sites, results)]
 
-report(report_stats)
 #this is to close spdb connection,if there are any objects were processed
 #this connection is never opened if no ojects were processed.
-if len(objects_to_process) >=1 :
+if spdb is not None:
     spdb.close_connection()
+
+failed_codes = [code for code in exit_codes if code not in (EX_OK, EX_NOINPUT)]
+if failed_codes:
+    clean_exit(failed_codes[0], 'Some objects were not processed cleanly.')
+if all(code == EX_NOINPUT for code in exit_codes):
+    clean_exit(EX_NOINPUT, "No objects to process.")
 clean_exit(EX_OK, 'Finished all processing cleanly.')
@@ -146,6 +146,10 @@ password = os.environ['pgpass']
 conn_string = (f"dbname='{dbname}' host='{host}' port='{port}' "
                f"user='{user}' password={password}")
 
+# One Redshift connection is shared by every query the microservice runs.
+# Keepalives hold it open through long stretches of API calls.
+conn = psycopg2.connect(conn_string, keepalives=1, keepalives_idle=60)
+
 
 # Google API Access requires a browser-based authentication step to create
 # the stored authorization .dat file. Forcing noauth_local_webserver to True
@@ -195,25 +199,17 @@ gmbBIso = build('mybusinessbusinessinformation', 'v1', http=http)
 # https://businessprofileperformance.googleapis.com/$discovery/rest?version=v1
 gmbv1 = build('businessprofileperformance', 'v1', http=http, static_discovery=False)
 
-# Check for a last loaded date in Redshift
-# Load the Redshift connection
-def last_loaded(dbtable, account, location_id):
-    last_loaded_date = None
-    con = psycopg2.connect(conn_string)
-    cursor = con.cursor()
-    loc_id = str(account) + "/" + str(location_id)
-    # query the latest date for any search data on this site loaded to redshift
-    query = ("SELECT MAX(Date) "
-             "FROM {0} "
-             "WHERE location_id = '{1}'").format(dbtable, loc_id)
-    cursor.execute(query)
-    # get the last loaded date
-    last_loaded_date = (cursor.fetchone())[0]
-    # close the redshift connection
-    cursor.close()
-    con.commit()
-    con.close()
-    return last_loaded_date
+# Check for the last loaded dates in Redshift
+def last_loaded_dates(dbtable):
+    """Return a dict of the last date loaded to Redshift for each location,
+    keyed on the location_id (as in "<account>/<location>"), read with a
+    single query. Locations with no data loaded are absent."""
+    with conn.cursor() as cursor:
+        cursor.execute(
+            f"SELECT location_id, MAX(date) FROM {dbtable} GROUP BY location_id")
+        dates = dict(cursor.fetchall())
+    conn.commit()
+    return dates
 
 def get_locations(gmbBIso, account_uri):
     """
@@ -373,6 +369,9 @@ for loc in config_locations:
             'No API access to %s. Excluding from insights query.', loc['name'])
         continue
 
+# query RedShift once for the dates already loaded for every location
+last_loaded = last_loaded_dates(config_dbtable)
+
 # iterate over ever location of every account
 for account in validated_accounts:
     # Create a dataframe with dates as rows and columns according to the table
@@ -408,7 +407,7 @@ for account in validated_accounts:
                 ).isoformat()
 
         # query RedShift to see if there is a date already loaded
-        last_loaded_date = last_loaded(config_dbtable, account_uri, location_uri)
+        last_loaded_date = last_loaded.get(f'{account_uri}/{location_uri}')
         if last_loaded_date is None:
             logger.info("first time loading %s: %s",
                         account['name'], loc['name'])
@@ -605,7 +604,7 @@ for account in validated_accounts:
         badfile = f"{config_destination}/bad/{object_key}"
 
         # Connect to Redshift and execute the query.
-        with psycopg2.connect(conn_string) as conn:
+        with conn:
             with conn.cursor() as curs:
                 try:
                     curs.execute(query)
@@ -84,4 +84,21 @@ WHERE
 
 ANALYZE cmslite.google_dt;
 
+-- record what the table was built from, for cmslite.google_dt_incremental.sql:
+-- the last date derived for each site, and the themes the pages were matched to
+DROP TABLE IF EXISTS cmslite.google_dt_sites;
+CREATE TABLE cmslite.google_dt_sites AS
+SELECT site, MAX(date) AS built_through
+FROM   google.googlesearch
+GROUP  BY site;
+ALTER TABLE cmslite.google_dt_sites OWNER TO microservice;
+
+DROP TABLE IF EXISTS cmslite.google_dt_themes;
+CREATE TABLE cmslite.google_dt_themes AS
+SELECT hr_url, node_id, title,
+       theme_id, subtheme_id, topic_id, subtopic_id, subsubtopic_id,
+       theme, subtheme, topic, subtopic, subsubtopic
+FROM   cmslite.themes;
+ALTER TABLE cmslite.google_dt_themes OWNER TO microservice;
+
 COMMIT;
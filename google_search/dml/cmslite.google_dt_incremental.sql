@@ -0,0 +1,207 @@
+-- Update cmslite.google_dt for what changed since it was last built by
+-- cmslite.google_dt.sql or by this query, instead of rebuilding all of it:
+--   * rows loaded into google.googlesearch after the last date derived for
+--     their site, as recorded in cmslite.google_dt_sites; and
+--   * pages whose entry in cmslite.themes was added, removed or changed since
+--     the snapshot in cmslite.google_dt_themes.
+-- Those rows are deleted from cmslite.google_dt and derived again.
+-- Changes to google.google_sites are not detected; run the full build then.
+-- perform this as a transaction.
+-- Either the whole query completes, or it leaves the old table intact
+BEGIN;
+
+-- the first date of new data for each site
+CREATE TEMP TABLE google_dt_new AS
+SELECT gs.site, MIN(gs.date) AS start_date
+FROM   google.googlesearch AS gs
+       LEFT JOIN cmslite.google_dt_sites AS built
+              ON gs.site = built.site
+WHERE  built.built_through IS NULL
+    OR gs.date > built.built_through
+GROUP  BY gs.site;
+
+-- the pages whose themes differ from those they were last derived with
+CREATE TEMP TABLE google_dt_changed_pages AS
+SELECT DISTINCT hr_url
+FROM   ((SELECT hr_url, node_id, title,
+                theme_id, subtheme_id, topic_id, subtopic_id, subsubtopic_id,
+                theme, subtheme, topic, subtopic, subsubtopic
+         FROM   cmslite.themes
+         EXCEPT
+         SELECT hr_url, node_id, title,
+                theme_id, subtheme_id, topic_id, subtopic_id, subsubtopic_id,
+                theme, subtheme, topic, subtopic, subsubtopic
+         FROM   cmslite.google_dt_themes)
+        UNION ALL
+        (SELECT hr_url, node_id, title,
+                theme_id, subtheme_id, topic_id, subtopic_id, subsubtopic_id,
+                theme, subtheme, topic, subtopic, subsubtopic
+         FROM   cmslite.google_dt_themes
+         EXCEPT
+         SELECT hr_url, node_id, title,
+                theme_id, subtheme_id, topic_id, subtopic_id, subsubtopic_id,
+                theme, subtheme, topic, subtopic, subsubtopic
+         FROM   cmslite.themes)) AS changed;
+
+DELETE FROM cmslite.google_dt
+USING  google_dt_new AS added
+WHERE  cmslite.google_dt.site = added.site
+   AND cmslite.google_dt.date >= added.start_date;
+
+-- the changed pages are joined, rather than matched in a subquery, and
+-- skipped outright when cmslite.themes is unchanged
+DELETE FROM cmslite.google_dt
+USING  google_dt_changed_pages AS changed
+WHERE  CASE
+         WHEN page = 'https://www2.gov.bc.ca/' THEN
+         'https://www2.gov.bc.ca/gov/content/home'
+         ELSE page
+       END = changed.hr_url
+   AND EXISTS (SELECT 1 FROM google_dt_changed_pages);
+
+-- the new rows of each site. The date range is a plain filter, rather than
+-- part of an OR with the changed pages, so that a sort key on date lets
+-- Redshift skip the blocks loaded before the earliest start date.
+INSERT INTO cmslite.google_dt
+SELECT gs.*,
+       COALESCE(themes.node_id, '') AS node_id,
+       SPLIT_PART(gs.page, '/', 3)  AS page_urlhost,
+       title,
+       theme_id,
+       subtheme_id,
+       topic_id,
+       subtopic_id,
+       subsubtopic_id,
+       theme,
+       subtheme,
+       topic,
+       subtopic,
+       subsubtopic
+FROM   google.googlesearch AS gs
+       LEFT JOIN google.google_sites r
+              ON gs.site = r.ref_site
+       -- fix for misreporting of redirected front page URL in Google search
+       LEFT JOIN cmslite.themes AS themes
+              ON CASE
+                   WHEN page = 'https://www2.gov.bc.ca/' THEN
+                   'https://www2.gov.bc.ca/gov/content/home'
+                   ELSE page
+                 END = themes.hr_url
+       JOIN google_dt_new AS added
+         ON gs.site = added.site
+        AND gs.date >= added.start_date
+WHERE (
+        gs.site NOT IN (
+            'sc-domain:gov.bc.ca',
+            'sc-domain:engage.gov.bc.ca'
+        )
+    -- Case where data collected by site and sc-domain overlaps
+        OR (
+            gs.site = 'sc-domain:gov.bc.ca'
+            AND page_urlhost = r.sc_urlhost
+            AND gs.DATE :: DATE < r.start_date :: DATE
+        )
+    -- All other sc-domain data, excluding sites collected directly
+        OR (
+            gs.site = 'sc-domain:gov.bc.ca'
+            AND r.sc_domain = 'f'
+            AND page_urlhost NOT IN (
+            SELECT
+                sc_urlhost
+            FROM
+                google.google_sites
+            WHERE
+                sc_urlhost IS NOT NULL
+            )
+    )
+    OR (gs.site = 'sc-domain:engage.gov.bc.ca'))
+    AND gs.date >= (SELECT MIN(start_date) FROM google_dt_new);
+
+-- the older rows of the changed pages; rows on or after their site's start
+-- date were inserted with the new rows above
+INSERT INTO cmslite.google_dt
+SELECT gs.*,
+       COALESCE(themes.node_id, '') AS node_id,
+       SPLIT_PART(gs.page, '/', 3)  AS page_urlhost,
+       title,
+       theme_id,
+       subtheme_id,
+       topic_id,
+       subtopic_id,
+       subsubtopic_id,
+       theme,
+       subtheme,
+       topic,
+       subtopic,
+       subsubtopic
+FROM   google.googlesearch AS gs
+       LEFT JOIN google.google_sites r
+              ON gs.site = r.ref_site
+       -- fix for misreporting of redirected front page URL in Google search
+       LEFT JOIN cmslite.themes AS themes
+              ON CASE
+                   WHEN page = 'https://www2.gov.bc.ca/' THEN
+                   'https://www2.gov.bc.ca/gov/content/home'
+                   ELSE page
+                 END = themes.hr_url
+       JOIN google_dt_changed_pages AS changed
+         ON CASE
+              WHEN page = 'https://www2.gov.bc.ca/' THEN
+              'https://www2.gov.bc.ca/gov/content/home'
+              ELSE page
+            END = changed.hr_url
+       LEFT JOIN google_dt_new AS added
+              ON gs.site = added.site
+WHERE (
+        gs.site NOT IN (
+            'sc-domain:gov.bc.ca',
+            'sc-domain:engage.gov.bc.ca'
+        )
+    -- Case where data collected by site and sc-domain overlaps
+        OR (
+            gs.site = 'sc-domain:gov.bc.ca'
+            AND page_urlhost = r.sc_urlhost
+            AND gs.DATE :: DATE < r.start_date :: DATE
+        )
+    -- All other sc-domain data, excluding sites collected directly
+        OR (
+            gs.site = 'sc-domain:gov.bc.ca'
+            AND r.sc_domain = 'f'
+            AND page_urlhost NOT IN (
+            SELECT
+                sc_urlhost
+            FROM
+                google.google_sites
+            WHERE
+                sc_urlhost IS NOT NULL
+            )
+    )
+    OR (gs.site = 'sc-domain:engage.gov.bc.ca'))
+    AND (added.start_date IS NULL OR gs.date < added.start_date)
+    AND EXISTS (SELECT 1 FROM google_dt_changed_pages);
+
+-- record the new last dates derived and the themes derived with
+DELETE FROM cmslite.google_dt_sites
+USING  google_dt_new AS added
+WHERE  cmslite.google_dt_sites.site = added.site;
+
+INSERT INTO cmslite.google_dt_sites
+SELECT gs.site, MAX(gs.date) AS built_through
+FROM   google.googlesearch AS gs
+       JOIN google_dt_new AS added
+         ON gs.site = added.site
+GROUP  BY gs.site;
+
+DELETE FROM cmslite.google_dt_themes;
+INSERT INTO cmslite.google_dt_themes
+SELECT hr_url, node_id, title,
+       theme_id, subtheme_id, topic_id, subtopic_id, subsubtopic_id,
+       theme, subtheme, topic, subtopic, subsubtopic
+FROM   cmslite.themes;
+
+DROP TABLE google_dt_new;
+DROP TABLE google_dt_changed_pages;
+
+ANALYZE cmslite.google_dt;
+
+COMMIT;
@@ -56,7 +56,10 @@
 
 import re
 from datetime import date, datetime, timedelta
-from time import sleep
+from time import sleep, monotonic
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import json
 import argparse
 import sys       # to read command line parameters
@@ -100,6 +103,33 @@ signal.signal(signal.SIGINT, signal_handler)
 logger = logging.getLogger(__name__)
 log.setup()
 
+# Limit each query to 20000 rows. If there are more than 20000 rows
+# in a given day, it will split the query up.
+ROW_LIMIT = 20000
+
+# The number of Search Console API requests in flight at once
+FETCH_WORKERS = 8
+
+# The sustained rate and burst size of Search Console API requests. The API
+# allows 1200 queries per minute per site and per user.
+REQUESTS_PER_SECOND = 10
+REQUEST_BURST = 10
+
+# Each HTTP 429 halves the request rate down to this floor, and each
+# successful request then restores this much of it until the rate is back
+# to REQUESTS_PER_SECOND
+MIN_REQUESTS_PER_SECOND = 0.5
+RATE_RECOVERY = 0.1
+
+# A request is attempted this many times when it is rate limited or fails
+# with a server error, waiting a random time up to an exponentially growing
+# limit between attempts
+MAX_TRIES = 10
+MAX_BACKOFF = 60
+
+# for now, we strip | and \\ from the keys of each row
+STRIP_KEYS = str.maketrans('', '', '|\\')
+
 
 def clean_exit(code, message):
     """Exits with a logger message and code"""
@@ -124,21 +154,208 @@ def giveup_hdlr(details):
     clean_exit(1, 'could not reach Google Search Console after backoff.')
 
 
-def last_loaded(_s):
-    """Check for a sites last loaded date in Redshift"""
-    # Load the Redshift connection
-    con = psycopg2.connect(conn_string)
-    cursor = con.cursor()
-    # query the latest date for any search data on this site loaded to redshift
-    _q = f"SELECT MAX(DATE) FROM {config_dbtable} WHERE site = '{_s}'"
-    cursor.execute(_q)
-    # get the last loaded date
-    lld = (cursor.fetchall())[0][0]
-    # close the redshift connection
-    cursor.close()
-    con.commit()
-    con.close()
-    return lld
+def last_loaded_dates(sites):
+    """Return a dict of the last date loaded to Redshift for each site, read
+    with a single query. Sites with no data loaded are absent."""
+    with conn.cursor() as cursor:
+        cursor.execute(
+            f"SELECT site, MAX(date) FROM {config_dbtable} "
+            "WHERE site IN %s GROUP BY site", (tuple(sites),))
+        dates = dict(cursor.fetchall())
+    conn.commit()
+    return dates
+
+
+class TokenBucket:
+    """A thread safe token bucket rate limiter. Tokens are added at a rate
+    that adapts to the API: it is halved on each rate limited request and
+    recovers on each successful one.
+
+    Attributes:
+        rate: The current number of tokens added per second.
+    """
+
+    def __init__(self, rate, capacity):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Block until a token is available, then take it"""
+        while True:
+            with self.lock:
+                self.refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            sleep(wait_time)
+
+    def throttled(self):
+        """Halve the rate and empty the bucket after a rate limited request"""
+        with self.lock:
+            self.refill()
+            self.rate = max(MIN_REQUESTS_PER_SECOND, self.rate / 2)
+            self.tokens = 0
+            logger.warning('Rate limited; request rate reduced to %.2f/s',
+                           self.rate)
+
+    def succeeded(self):
+        """Recover part of the rate after a successful request"""
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.refill()
+                self.rate = min(self.max_rate, self.rate + RATE_RECOVERY)
+
+
+rate_limiter = TokenBucket(REQUESTS_PER_SECOND, REQUEST_BURST)
+
+# httplib2 is not thread safe, so each fetch thread authorizes its own Http
+thread_data = threading.local()
+
+
+def thread_http():
+    """Return the authorized Http object of the calling thread"""
+    if not hasattr(thread_data, 'http'):
+        thread_data.http = credentials.authorize(httplib2.Http())
+    return thread_data.http
+
+
+def retryable(error):
+    """Rate limits and server errors are retried; other errors, like a
+    site that is not verified, are not"""
+    return error.resp.status == 429 or error.resp.status >= 500
+
+
+def daterange(start_date, end_date):
+    """yields a generator of all dates from startDate to endDate"""
+    logger.info("daterange called with startDate: %s and endDate: %s",
+                start_date, end_date)
+    assert end_date >= start_date, (f'start_date: {start_date} '
+                                    'cannot exceed end_date: '
+                                    f'{end_date} in '
+                                    'daterange generator')
+    for _n in range(int((end_date - start_date).days) + 1):
+        yield start_date + timedelta(_n)
+
+
+def fetch_page(site_name, day, page):
+    """Query one page of search analytics rows for a site on a day.
+
+    Each attempt waits for a token from the rate limiter. Rate limited
+    requests and server errors are retried up to MAX_TRIES times.
+
+    Args:
+        site_name: The Search Console property to query.
+        day: The date to query.
+        page: The page of ROW_LIMIT rows to return, starting from 0.
+
+    Returns:
+        The list of rows in the response, empty if there are none.
+
+    Raises:
+        GoogleHttpError: The request failed and could not be retried.
+    """
+    logger.info('%s %s %s', site_name, str(day), page)
+
+    # The order of the values in the dimensions[] block of this
+    #  Google Search API query determines the order of the keys[]
+    #  values in the response body.
+    # IMPORTANT: logic is tied to the current order; any change
+    #  to the current order will require refactoring this script.
+    bodyvar = {
+        "aggregationType": 'auto',
+        "startDate": str(day),
+        "endDate": str(day),
+        "dimensions": [
+            "date",
+            "query",
+            "country",
+            "device",
+            "page"],
+        "rowLimit": ROW_LIMIT,
+        "startRow": page * ROW_LIMIT}
+
+    for tries in range(1, MAX_TRIES + 1):
+        rate_limiter.acquire()
+        try:
+            response = service.searchanalytics()\
+                .query(siteUrl=site_name, body=bodyvar)\
+                .execute(http=thread_http())
+        except GoogleHttpError as error:
+            if not retryable(error) or tries == MAX_TRIES:
+                raise
+            if error.resp.status == 429:
+                rate_limiter.throttled()
+            wait_time = random.uniform(0, min(MAX_BACKOFF, 0.5 * 2 ** tries))
+            logger.warning(
+                "retrying site %s on %s page %s: %s with wait time %.1fs",
+                site_name, str(day), page, tries, wait_time)
+            sleep(wait_time)
+        else:
+            rate_limiter.succeeded()
+            return response.get('rows', [])
+
+
+def fetch_rows(site_name, start_dt, end_dt):
+    """Fetch the search analytics rows for a site over a range of days.
+
+    The first page of every day is requested at once, up to FETCH_WORKERS
+    at a time, and the next page of a day is requested whenever a full page
+    comes back. If any request fails, the requests not yet started are
+    cancelled and the error is raised.
+
+    Returns:
+        The rows ordered by day, then by page.
+    """
+    pages = {}
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        pending = {
+            executor.submit(fetch_page, site_name, day, 0): (day, 0)
+            for day in daterange(start_dt, end_dt)}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                day, page = pending.pop(future)
+                try:
+                    rows = future.result()
+                except GoogleHttpError:
+                    for other in pending:
+                        other.cancel()
+                    raise
+                pages[(day, page)] = rows
+                # a full page may be followed by more rows on the next one
+                if len(rows) == ROW_LIMIT:
+                    pending[executor.submit(
+                        fetch_page, site_name, day, page + 1)] = (day, page + 1)
+    return [row for key in sorted(pages) for row in pages[key]]
+
+
+def write_rows(stream, site_name, rows):
+    """Write Search Console rows to a stream as pipe delimited lines of the
+    site, the keys, position, clicks, ctr and impressions.
+
+    Returns:
+        The latest date in the rows, or '0' if there are none.
+    """
+    prefix = site_name + '|'
+    stream.writelines(
+        prefix
+        + '|'.join([key.translate(STRIP_KEYS) for key in row['keys']])
+        + f"|{row['position']}|{int(row['clicks'])}"
+        f"|{row['ctr']}|{int(row['impressions'])}\n"
+        for row in rows)
+    # keys[0] contains the date value.
+    return max((row['keys'][0] for row in rows), default='0')
 
 
 # the latest available Google API data is two less than the query date (today)
@@ -151,6 +368,8 @@ parser = argparse.ArgumentParser(
 parser.add_argument('-o', '--cred', help='OAuth Credentials JSON file.')
 parser.add_argument('-a', '--auth', help='Stored authorization dat file.')
 parser.add_argument('-c', '--conf', help='Microservice configuration file.')
+parser.add_argument('-r', '--rebuild', action='store_true',
+                    help='Rebuild the derived table in full.')
 flags = parser.parse_args()
 flags.noauth_local_webserver = True
 
@@ -230,6 +449,9 @@ config_dbtable = config['dbtable']
 config_source = config['source']
 config_directory = config['directory']
 dml_file = config['dml']
+# if dml_incremental option is missing, always rebuild the derived table
+dml_incremental = \
+    None if 'dml_incremental' not in config else config['dml_incremental']
 
 # Create S3 client and resouce
 client = boto3.client('s3')
@@ -248,6 +470,10 @@ conn_string = (
     f"user='{pguser}' "
     f"password={pgpass}")
 
+# One Redshift connection is shared by every query the microservice runs.
+# Keepalives hold it open through long stretches of API calls.
+conn = psycopg2.connect(conn_string, keepalives=1, keepalives_idle=60)
+
 """ Used to clean report list printing"""
 def print_list(report_string, report_list):
     print('\n' + report_string)
@@ -328,15 +554,18 @@ report_stats['retrieved'] = len(config_sites)  # Minus 1 if failure occurs
 for site_item in config_sites:
     report_stats['failed_api_call'].append(site_item['name'])
 
+# get the last loaded date of every site.
+# a site is missing if it has not previously been loaded into Redshift
+last_loaded = last_loaded_dates(site_item['name'] for site_item in config_sites)
+
 # each site in the config list of sites gets processed in this loop
 for site_item in config_sites:  # noqa: C901
     # read the config for the site name and default start date if specified
     site_name = site_item['name']
-    site_okay = True
     
     # get the last loaded date.
     # may be None if this site has not previously been loaded into Redshift
-    last_loaded_date = last_loaded(site_name)
+    last_loaded_date = last_loaded.get(site_name)
 
     # if the last load is 2 days old, there will be no new data in Google
     if last_loaded_date is not None and last_loaded_date >= latest_date:
@@ -357,9 +586,6 @@ for site_item in config_sites:  # noqa: C901
     # Load 30 days at a time until the data in Redshift has
     # caught up to the most recently available data from Google
     while last_loaded_date is None or last_loaded_date <= latest_date:
-        if not site_okay:
-            break
-
         # if there isn't data in Redshift for this site,
         # start at the start_date_default set earlier
         if last_loaded_date is None:
@@ -376,130 +602,31 @@ for site_item in config_sites:  # noqa: C901
         # (up to) 1 month ahead of start_dt OR (up to) two days before now.
         end_dt = min(start_dt + timedelta(days=30), latest_date)
 
-        # prepare stream with header
-        stream = io.StringIO("site|date|query|country|device|"
-                             "page|position|clicks|ctr|impressions\n")
-
-        # Limit each query to 20000 rows. If there are more than 20000 rows
-        # in a given day, it will split the query up.
-        rowlimit = 20000
-        index = 0
-
-        def daterange(start_date, end_date):
-            """yields a generator of all dates from startDate to endDate"""
-            logger.info("daterange called with startDate: %s and endDate: %s",
-                        start_date, end_date)
-            assert end_date >= start_date, (f'start_date: {start_date} '
-                                            'cannot exceed end_date: '
-                                            f'{end_date} in '
-                                            'daterange generator')
-            for _n in range(int((end_date - start_date).days) + 1):
-                yield start_date + timedelta(_n)
-
-        search_analytics_response = ''
-
-        # loops on each date from start date to the end date, inclusive
-        # initializing date_in_range avoids pylint [undefined-loop-variable]
-        date_in_range = ()
-        max_date_in_data = '0'
-        for date_in_range in daterange(start_dt, end_dt):
-            if not site_okay:
-                break
-            # A wait time of 250ms each query reduces chance of HTTP 429 error
-            # "Rate Limit Exceeded", handled below
-            wait_time = 0.25
-            sleep(wait_time)
+        # fetch every row for the site over the date range, stopping with
+        # this site if the API cannot be queried for it
+        try:
+            rows = fetch_rows(site_name, start_dt, end_dt)
+        except GoogleHttpError:
+            logger.exception("Failing with HTTP error on %s", site_name)
+            report_stats['failed_verification'].append(site_name)
+            report_stats['failed_api'] += 1
+            report_stats['retrieved'] -= 1
+            logger.info('Site: %s  not verified. Skipping to next site.', site_name)
+            break
 
-            index = 0
-            while (index == 0 or ('rows' in search_analytics_response)):
-                logger.info('%s %s', str(date_in_range), index)
-
-                # The order of the values in the dimensions[] block of this
-                #  Google Search API query determines the order of the keys[]
-                #  values in the response body.
-                # IMPORTANT: logic is tied to the current order; any change
-                #  to the current order will require refactoring this script.
-                bodyvar = {
-                    "aggregationType": 'auto',
-                    "startDate": str(date_in_range),
-                    "endDate": str(date_in_range),
-                    "dimensions": [
-                        "date",
-                        "query",
-                        "country",
-                        "device",
-                        "page"],
-                    "rowLimit": rowlimit,
-                    "startRow": index * rowlimit}
-
-                # This query to the Google Search API may eventually yield an
-                # HTTP response code of 429, "Rate Limit Exceeded".
-                # The handling attempt below will increase the wait time on
-                # each re-attempt up to 10 times.
-
-                # As a scheduled job, ths microservice will restart after the
-                # last successful load to Redshift.
-                retry = 1
-                while True:
-                    try:
-                        search_analytics_response = service.searchanalytics()\
-                            .query(siteUrl=site_name, body=bodyvar).execute()
-                    except GoogleHttpError:
-                        if retry == 11:
-                            logger.error(("Failing with HTTP error after 10 "
-                                          "retries with query time easening."))
-                            report_stats['failed_verification'].append(site_name)
-                            report_stats['failed_api'] += 1
-                            report_stats['retrieved'] -= 1
-                            # Break out of this loop
-                            break  
-                        
-                        wait_time = wait_time * 2
-                        logger.warning(
-                            "retrying site %s: %s with wait time %s",
-                            site_name, retry, wait_time)
-                        retry = retry + 1
-                        sleep(wait_time)
-                    else:
-                        break
-
-                # Check to see if we were able to reach the site
-                if retry ==  11:
-                    # if not go to the next site.
-                    logger.info('Site: %s  not verified. Skipping to next site.', site_name)
-                    site_okay = False
-                    index = index + 1
-                    break
-
-                index = index + 1
-
-                if 'rows' in search_analytics_response:
-                    for row in search_analytics_response['rows']:
-                        outrow = site_name + "|"
-                        for i, key in enumerate(row['keys']):
-                            # keys[0] contains the date value.
-                            if i == 0:
-                                # Find max date in data to use in filename.
-                                max_date_in_data = max(max_date_in_data, key)
-                            # for now, we strip | from searches
-                            key = re.sub(r'\|', '', key)
-                            # for now, we strip \\ from searches
-                            key = re.sub('\\\\', '', key)
-                            outrow = outrow + key + "|"
-                        outrow = \
-                            outrow + str(row['position']) + "|" + \
-                            re.sub(r'\.0', '', str(row['clicks'])) + "|" + \
-                            str(row['ctr']) + "|" + \
-                            re.sub(r'\.0', '', str(row['impressions'])) + "\n"
-                        stream.write(outrow)
+        # prepare stream with header
+        stream = io.StringIO()
+        stream.write("site|date|query|country|device|"
+                     "page|position|clicks|ctr|impressions\n")
+        max_date_in_data = write_rows(stream, site_name, rows)
 
         if max_date_in_data < str(end_dt):
             logger.info('The date range in the request spanned %s - %s, '
                         'but the max date in the data retrieved was: %s',
                         str(start_dt), str(end_dt), str(max_date_in_data))
 
-        # check if the stream contains no data
-        if stream.tell() == 0:
+        # check if the response contained no data
+        if not rows:
             logger.warning('No data retrieved for %s over date request range '
                            '%s - %s. Skipping s3 object creation and '
                            'Redshift load steps.',
@@ -542,16 +669,16 @@ for site_item in config_sites:  # noqa: C901
             logger.info(logquery)
 
             # Load into Redshift
-            with psycopg2.connect(conn_string) as conn:
+            with conn:
                 with conn.cursor() as curs:
                     try:
                         curs.execute(query)
                     # if the DB call fails, print error and place file in /bad
                     except psycopg2.Error:
                         logger.exception(
-                            "FAILURE loading %s (%s index) over date range "
+                            "FAILURE loading %s (%s rows) over date range "
                             "%s to %s into %s. Object key %s.", site_name,
-                            str(index), str(start_dt), str(end_dt),
+                            str(len(rows)), str(start_dt), str(end_dt),
                             config_dbtable, object_key.split('/')[-1])
                         report_stats['failed_rs'] += 1
                         clean_exit(1, 'Could not load to redshift.')
@@ -560,9 +687,9 @@ for site_item in config_sites:  # noqa: C901
                         if max_date_in_data != str(0):
                             report_stats['processed'].append(s3_file_path)
                             logger.info(
-                                "SUCCESS loading %s (%s index) over date "
+                                "SUCCESS loading %s (%s rows) over date "
                                 "range %s to %s into %s. Object key %s.",
-                                site_name, str(index), str(start_dt),
+                                site_name, str(len(rows)), str(start_dt),
                                 str(end_dt), config_dbtable,
                                 object_key.split('/')[-1])
                         else:
@@ -588,12 +715,18 @@ yvr_dt_start = (yvr_tz
 
 # This query will INSERT INTO cmslite.google_dt
 # cmslite.google_dt, a derived table built from google.googlesearch
-# Get sql for dt build form dml folder
-query = open('dml/{}'.format(dml_file), 'r').read()
+# Get sql for dt build form dml folder: the full rebuild when requested or
+# when no incremental build is configured, otherwise the incremental build
+if flags.rebuild or dml_incremental is None:
+    logger.info("Rebuilding Google Search DT in full")
+    query = open('dml/{}'.format(dml_file), 'r').read()
+else:
+    logger.info("Updating Google Search DT incrementally")
+    query = open('dml/{}'.format(dml_incremental), 'r').read()
 
 # Execute the query and log the outcome
 logger.info(query)
-with psycopg2.connect(conn_string) as conn:
+with conn:
     with conn.cursor() as curs:
         try:
             curs.execute(query)
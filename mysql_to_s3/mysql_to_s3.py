@@ -20,15 +20,18 @@ import sys
 import argparse
 import json
 import re
-from io import StringIO
+import zlib
 from datetime import datetime, date, timedelta
 from tzlocal import get_localzone
 from pytz import timezone
 import pymysql
 import pandas as pd
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 from sqlalchemy import create_engine
+from sqlalchemy.exc import DBAPIError
 import warnings
 here = os.path.dirname(os.path.abspath(__file__))
 branch_root = os.path.abspath(os.path.join(here, ".."))
@@ -43,6 +46,27 @@ boto3.compat.filter_python_deprecation_warnings()
 logger = logging.getLogger(__name__)
 log.setup()
 
+# The number of objects copied to the storage and archive folders at once
+COPY_WORKERS = 8
+
+# Objects larger than a single copy_object request allows (5 GB) are copied
+# in parts
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=5 * 1024 ** 3)
+
+# The size of each part of a multipart upload of the results; S3 requires
+# every part but the last to be at least 5 MB
+UPLOAD_PART_SIZE = 8 * 1024 ** 2
+
+# The number of rows serialized to csv text at a time; a part can grow past
+# maxfilesize by at most the size of this many rows
+SERIALIZE_ROWS = 10000
+
+# The suffix added to the name of every object in these compression formats
+SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+
+# The units maxfilesize can be given in
+SIZE_UNITS = {'MB': 1024 ** 2, 'GB': 1024 ** 3}
+
 # Get script start time
 local_tz = get_localzone()
 yvr_tz = timezone('America/Vancouver')
@@ -103,6 +127,33 @@ quoting = '0' if 'quoting' not in config else config['quoting']
 # if quotechar option is missing, default to use double quotes "
 quotechar = '"' if 'quotechar' not in config else config['quotechar']
 
+# if chunksize option is missing, read the whole result at once
+chunksize = None if 'chunksize' not in config else config['chunksize']
+
+# if compression option is missing, write uncompressed objects
+compression = \
+    False if 'compression' not in config else config['compression'].lower()
+if compression == 'zstd':
+    try:
+        import zstandard  # only required when zstd compression is configured
+    except ImportError:
+        clean_exit(1, 'zstd compression requires the zstandard package.')
+elif compression and compression != 'gzip':
+    clean_exit(1, f'Unsupported compression: {compression}.')
+suffix = SUFFIXES.get(compression, '')
+
+# if maxfilesize option is missing, write the result as a single object
+maxfilesize = False
+if 'maxfilesize' in config:
+    size = re.fullmatch(
+        r'\s*(\d+(?:\.\d+)?)\s*(MB|GB)\s*', config['maxfilesize'], re.IGNORECASE)
+    if not size:
+        clean_exit(1, f'Unsupported maxfilesize: {config["maxfilesize"]}.')
+    maxfilesize = int(float(size.group(1)) * SIZE_UNITS[size.group(2).upper()])
+
+# if manifest option is missing, do not write a manifest
+manifest = False if 'manifest' not in config else config['manifest']
+
 # Get required environment variables
 mysqluser = os.environ['mysqluser']
 mysqlpass = os.environ['mysqlpass']
@@ -262,6 +313,108 @@ def get_unprocessed_objects():
     return objects_to_process
 
 
+def copy_key(from_key, to_key):
+    '''copy an object within the bucket, using a multipart copy for objects
+    larger than a single copy_object request allows'''
+    client.copy(
+        CopySource={'Bucket': bucket, 'Key': from_key},
+        Bucket=bucket,
+        Key=to_key,
+        Config=TRANSFER_CONFIG)
+
+
+def storage_key(key):
+    '''return the client storage key for a batch object'''
+    if 'extension' in config:
+        # if an extension was set in the config, add it to the end of the file,
+        # ahead of the compression suffix (as in .csv.gz)
+        extension = config['extension']
+        filename_with_extension = (
+            f"{key[:len(key) - len(suffix)]}{extension}{suffix}")
+        logger.info('File extension set in %s as "%s"', config_file, extension)
+    else:
+        filename_with_extension = key
+        logger.info('File extension not set in %s', config_file)
+
+    # final storage path that includes the filename and optional extension, removes the batch part of the prefix and leaves the client
+    return filename_with_extension.replace(f'{archive}/batch/', '', 1)
+
+
+def store_object(key):
+    """Copy a batch object to the client storage folder, then archive it to
+    the good folder, or to the bad folder if it could not be stored.
+
+    Args:
+        key: The key of the object in the batch folder.
+
+    Returns:
+        A tuple of the batch key, the key the object was stored to (None if it
+        was not stored), and the key it was archived to (None if archiving
+        failed).
+    """
+    # final paths that include the filenames
+    copy_good_prefix = key.replace(f'{archive}/batch/', f'{archive}/good/', 1)
+    copy_bad_prefix = key.replace(f'{archive}/batch/', f'{archive}/bad/', 1)
+    copy_from_prefix = key
+
+    copy_to_prefix = storage_key(key)
+    try:
+        logger.info('Copying to s3 /client ...')
+        copy_key(copy_from_prefix, copy_to_prefix)
+    except ClientError:
+        logger.exception('Exception copying from s3://%s/%s', bucket, copy_from_prefix)
+        logger.exception('to s3://%s/%s', bucket, copy_to_prefix)
+        copy_to_prefix = None
+        archive_prefix = copy_bad_prefix
+        logger.info('Copying to s3 /bad ...')
+    else:
+        logger.info('Copied from s3://%s/%s', bucket, copy_from_prefix)
+        logger.info('Copied to s3://%s/%s', bucket, copy_to_prefix)
+        archive_prefix = copy_good_prefix
+        logger.info('Copying to s3 /good ...')
+
+    try:
+        copy_key(copy_from_prefix, archive_prefix)
+    except ClientError:
+        logger.exception('Exception copying from s3://%s/%s', bucket, copy_from_prefix)
+        logger.exception('to s3://%s/%s', bucket, archive_prefix)
+        return key, copy_to_prefix, None
+    logger.info('Copied from s3://%s/%s', bucket, copy_from_prefix)
+    logger.info('Copied to s3://%s/%s', bucket, archive_prefix)
+    return key, copy_to_prefix, archive_prefix
+
+
+def store_objects(objects):
+    """Store and archive batch objects concurrently, then record the outcome
+    for each object in report_stats in order.
+
+    Returns:
+        True if every object was stored and archived, otherwise False.
+    """
+    with ThreadPoolExecutor(max_workers=COPY_WORKERS) as executor:
+        results = list(executor.map(
+            store_object, [object_summary.key for object_summary in objects]))
+
+    succeeded = True
+    for key, stored_key, archived_key in results:
+        if stored_key:
+            report_stats['stored_objects'] += 1
+            report_stats['stored_objects_list'].append(stored_key)
+        else:
+            succeeded = False
+            report_stats['unstored_objects'] += 1
+            report_stats['unstored_objects_list'].append(key)
+        if archived_key is None:
+            succeeded = False
+        elif stored_key:
+            report_stats['good_objects'] += 1
+            report_stats['good_objects_list'].append(archived_key)
+        else:
+            report_stats['bad_objects'] += 1
+            report_stats['bad_objects_list'].append(archived_key)
+    return succeeded
+
+
 # MySQL connection to the database
 connection_string = "mysql+pymysql://{}:{}@{}:{}/{}".format(
     mysqluser, 
@@ -294,110 +447,225 @@ except ClientError:
 # the _substantive_ query, one that users expect to see as output in S3.
 request_query = open('dml/{}'.format(dml_file), 'r').read()
 
+def query_chunks():
+    '''yield the result of the request query as dataframes: all at once, or
+    when a chunksize is configured, in chunks of that many rows fetched from
+    a server side cursor as they are needed'''
+    if not chunksize:
+        logger.info('executing query and storing results in a dataframe')
+        yield pd.read_sql(request_query, engine)
+        return
+    logger.info('executing query and streaming results in chunks of %s rows',
+                chunksize)
+    # stream_results makes SQLAlchemy use a pymysql SSCursor
+    with engine.connect().execution_options(stream_results=True) as connection:
+        yield from pd.read_sql(request_query, connection, chunksize=chunksize)
+
+
+def to_csv_text(df, chunk_header):
+    '''return a dataframe as csv text, formatted using settings in config'''
+    return df.to_csv(
+        path_or_buf=None,           # return the csv data as a string
+        sep=sep,                    # delimiter used
+        header=chunk_header,        # should there be a header
+        escapechar=escapechar,      # escape character used
+        quoting=quoting,            # type of quoting used
+        quotechar=quotechar,        # quote character used
+        index=False)                # removing the row number
+
+
+def new_compressor():
+    '''return a streaming compressor for one object, or None if the output
+    is not compressed'''
+    if compression == 'gzip':
+        # wbits=31 writes the gzip header and trailer around the deflate data
+        return zlib.compressobj(wbits=31)
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor().compressobj()
+    return None
+
+
+class PartUpload:
+    """An S3 object written as a stream of text. The text is compressed if
+    compression is configured and buffered until UPLOAD_PART_SIZE bytes are
+    ready, which are then sent as a part of a multipart upload. Objects
+    smaller than one part are sent with a single put_object.
+
+    Attributes:
+        key: The key of the object being written.
+        size: The number of bytes written to the object so far.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.size = 0
+        self.upload_id = None
+        self.parts = []
+        self.buffer = b''
+        self.compressor = new_compressor()
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        if self.compressor:
+            data = self.compressor.compress(data)
+        self.buffer += data
+        self.size += len(data)
+        if len(self.buffer) >= UPLOAD_PART_SIZE:
+            self.upload_buffer()
+
+    def upload_buffer(self):
+        if self.upload_id is None:
+            self.upload_id = client.create_multipart_upload(
+                Bucket=bucket, Key=self.key)['UploadId']
+        response = client.upload_part(
+            Bucket=bucket, Key=self.key, UploadId=self.upload_id,
+            PartNumber=len(self.parts) + 1, Body=self.buffer)
+        self.parts.append(
+            {'ETag': response['ETag'], 'PartNumber': len(self.parts) + 1})
+        self.buffer = b''
+
+    def close(self):
+        if self.compressor:
+            data = self.compressor.flush()
+            self.buffer += data
+            self.size += len(data)
+        if self.upload_id is None:
+            client.put_object(Bucket=bucket, Key=self.key, Body=self.buffer)
+            return
+        if self.buffer:
+            self.upload_buffer()
+        client.complete_multipart_upload(
+            Bucket=bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': self.parts})
+
+    def abort(self):
+        if self.upload_id is not None:
+            client.abort_multipart_upload(
+                Bucket=bucket, Key=self.key, UploadId=self.upload_id)
+
+
+def part_name(object_key, number):
+    '''the name of an output object, relative to the batch prefix'''
+    if maxfilesize:
+        return f'{object_key}_part{number:03}{suffix}'
+    return f'{object_key}{suffix}'
+
+
+def write_parts(object_key, frames):
+    """Write the query result to the batch folder as one object, or when
+    maxfilesize is configured, as parts that are each closed once they reach
+    that size. Every part is a complete file on its own: it begins with the
+    header row if header is set, and is a complete compressed stream if
+    compression is set. If writing fails, the parts already written are
+    deleted so that a partial result is never stored.
+
+    Args:
+        object_key: The key the output objects are named after.
+        frames: An iterable of dataframes holding the query result, in order.
+
+    Returns:
+        The names of the objects written, relative to the batch prefix.
+    """
+    header_text = ''
+    names = []
+    upload = None
+
+    def open_part():
+        part = PartUpload(
+            '{}/{}'.format(batch_prefix, part_name(object_key, len(names))))
+        part.write(header_text)
+        return part
+
+    try:
+        for i, df in enumerate(frames):
+            if i == 0 and header:
+                header_text = to_csv_text(df.head(0), True)
+            for start in range(0, len(df), SERIALIZE_ROWS):
+                if upload is None:
+                    upload = open_part()
+                upload.write(
+                    to_csv_text(df.iloc[start:start + SERIALIZE_ROWS], False))
+                if maxfilesize and upload.size >= maxfilesize:
+                    upload.close()
+                    names.append(part_name(object_key, len(names)))
+                    upload = None
+        # an empty result is still delivered, as a file with only the header
+        if upload is None and not names:
+            upload = open_part()
+        if upload is not None:
+            upload.close()
+            names.append(part_name(object_key, len(names)))
+            upload = None
+    except BaseException:
+        if upload is not None:
+            upload.abort()
+        if names:
+            client.delete_objects(
+                Bucket=bucket,
+                Delete={'Objects': [
+                    {'Key': '{}/{}'.format(batch_prefix, name)}
+                    for name in names]})
+        raise
+    return names
+
+
+def write_manifest(object_key, names):
+    '''write a manifest listing the stored parts to the storage folder, in
+    the format used by the Redshift COPY command, and return its key'''
+    manifest = {'entries': [
+        {'url': 's3://{}/{}'.format(
+            bucket, storage_key('{}/{}'.format(batch_prefix, name))),
+         'mandatory': True}
+        for name in names]}
+    key = '{}/{}.manifest'.format(storage_prefix, object_key)
+    client.put_object(
+        Bucket=bucket, Key=key, Body=json.dumps(manifest, indent=2))
+    return key
+
+
+object_key = object_key_builder(object_prefix)
 try:
-    csv_buffer = StringIO()
-    logger.info('executing query and storing results in a dataframe')
-    df = pd.read_sql(request_query, engine)
-except pymysql.OperationalError as e:
-    logger.error("An error occurred. Error number {0}: {1}.".format(e.args[0],e.args[1]))
-    logger.error('unable to execute query found in: {}'.format(dml_file))
+    logger.info('dml file used: {}'.format(dml_file))
+    logger.info(request_query)
+
+    # Put the file, or its parts, into S3 batch folder
+    part_names = write_parts(object_key, query_chunks())
+except (pymysql.Error, DBAPIError):
+    logger.exception('unable to execute query found in: {}'.format(dml_file))
     logger.error(request_query)
-else: 
-    try:
-        logger.info('dml file used: {}'.format(dml_file))
-        logger.info(request_query)
-            
-        # creating the format of the csv using settings in cofig
-        df.to_csv(
-            path_or_buf=csv_buffer,     # store csv data in the buffer
-            sep=sep,                    # delimiter used
-            header=header,              # should there be a header
-            escapechar=escapechar,      # escape character used
-            quoting=quoting,            # type of quoting used
-            quotechar=quotechar,        # quote character used
-            index=False)                # removing the row number
-        logger.info('writing results into buffer')
-
-        # Put the file into S3 batch folder
-        object_key = object_key_builder(object_prefix)
-        resource.Object(bucket, '{}/{}'.format(batch_prefix, object_key)).put(Body=csv_buffer.getvalue())
-    except ClientError:
-        logger.error(('Upload of the results from %s execution to S3 failed.'
-                          'Quitting with error code 1'), dml_file)
-        report_stats['failed_unloads'] += 1
-        report_stats['failed_unloads_list'].append(object_key)
-        report(report_stats)
-        clean_exit(1,'Failed pymysql query attempt.')
-    else:
+    report_stats['failed_unloads'] += 1
+    report_stats['failed_unloads_list'].append(object_key)
+    report(report_stats)
+    clean_exit(1,'Failed pymysql query attempt.')
+except ClientError:
+    logger.error(('Upload of the results from %s execution to S3 failed.'
+                      'Quitting with error code 1'), dml_file)
+    report_stats['failed_unloads'] += 1
+    report_stats['failed_unloads_list'].append(object_key)
+    report(report_stats)
+    clean_exit(1,'Failed boto3 upload attempt.')
+else:
+    for part in part_names:
         logger.info(
             'Boto3 upload to S3 successful. Object prefix is %s/%s/%s',
-            bucket, batch_prefix, object_key)
+            bucket, batch_prefix, part)
         report_stats['successful_unloads'] += 1
-        report_stats['successful_unloads_list'].append(object_key)
-            
-        # optionally add the file extension and transfer to storage folders
-        objects = get_unprocessed_objects()
-
-        for object in objects:
-            key = object.key # aka the batch prefix of the object
-            filename = key[key.rfind('/')+1:]  # get the filename (after the last '/')
-
-            # final paths that include the filenames
-            copy_good_prefix = key.replace(f'{archive}/batch/', f'{archive}/good/', 1)
-            copy_bad_prefix = key.replace(f'{archive}/batch/', f'{archive}/bad/', 1)
-            copy_from_prefix = key 
-                    
-            if 'extension' in config:
-                # if an extension was set in the config, add it to the end of the file
-                extension = config['extension']
-                filename_with_extension = f"{key}{extension}"
-                logger.info('File extension set in %s as "%s"', config_file, extension)
-            else:
-                filename_with_extension = key 
-                logger.info('File extension not set in %s', config_file)
-                
-            try:
-                # final storage path that includes the filename and optional extension, removes the batch part of the prefix and leaves the client
-                copy_to_prefix = filename_with_extension.replace(f'{archive}/batch/', '', 1)
-                    
-                logger.info('Copying to s3 /client ...')
-                client.copy_object(
-                    Bucket=bucket,
-                    CopySource='{}/{}'.format(bucket, copy_from_prefix),
-                    Key=copy_to_prefix)
-            except ClientError:
-                logger.exception('Exception copying from s3://%s/%s', bucket, copy_from_prefix)
-                logger.exception('to s3://%s/%s', bucket, copy_to_prefix)
-                report_stats['unstored_objects'] += 1
-                report_stats['unstored_objects_list'].append(copy_from_prefix)
-                    
-                logger.info('Copying to s3 /bad ...')
-                client.copy_object(
-                    Bucket=bucket,
-                    CopySource='{}/{}'.format(bucket, copy_from_prefix),
-                    Key=copy_bad_prefix)
-                logger.info('Copied from s3://%s/%s', bucket, copy_from_prefix)
-                logger.info('Copied to s3://%s/%s', bucket, copy_bad_prefix)
-                report_stats['bad_objects_list'].append(copy_bad_prefix)
-                report_stats['bad_objects'] += 1
-                    
-                report(report_stats)
-                clean_exit(1,'Failed boto3 copy_object attempt.')
-            else:
-                logger.info('Copied from s3://%s/%s', bucket, copy_from_prefix)
-                logger.info('Copied to s3://%s/%s', bucket, copy_to_prefix)
-                report_stats['stored_objects'] += 1
-                report_stats['stored_objects_list'].append(copy_to_prefix)
-                    
-                logger.info('Copying to s3 /good ...')
-                client.copy_object(
-                    Bucket=bucket,
-                    CopySource='{}/{}'.format(bucket, copy_from_prefix),
-                    Key=copy_good_prefix)
-                logger.info('Copied from s3://%s/%s', bucket, copy_from_prefix)
-                logger.info('Copied to s3://%s/%s', bucket, copy_good_prefix)
-                report_stats['good_objects'] += 1
-                report_stats['good_objects_list'].append(copy_good_prefix)
+        report_stats['successful_unloads_list'].append(part)
 
+    # transfer the objects to storage folders and archive them
+    if not store_objects(get_unprocessed_objects()):
         report(report_stats)
-        clean_exit(0,'Finished succesfully.')
+        clean_exit(1,'Failed boto3 copy attempt.')
+
+    # list the stored parts in a manifest for parallel loading downstream
+    if manifest:
+        try:
+            manifest_key = write_manifest(object_key, part_names)
+        except ClientError:
+            logger.exception('Exception writing the manifest for %s', object_key)
+            report(report_stats)
+            clean_exit(1,'Failed boto3 manifest upload attempt.')
+        logger.info('Wrote manifest to s3://%s/%s', bucket, manifest_key)
+
+    report(report_stats)
+    clean_exit(0,'Finished succesfully.')
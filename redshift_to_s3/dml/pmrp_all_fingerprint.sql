@@ -0,0 +1,40 @@
+SELECT
+	COUNT(*),
+	MAX(locations.date),
+	-- one total per delivered metric, so that changes cannot cancel out
+	-- between metrics and a null in one does not hide the others
+	SUM(COALESCE(locations.queries_direct, 0)),
+	SUM(COALESCE(locations.queries_indirect, 0)),
+	SUM(COALESCE(locations.views_maps, 0)),
+	SUM(COALESCE(locations.views_search, 0)),
+	SUM(COALESCE(locations.actions_website, 0)),
+	SUM(COALESCE(locations.actions_phone, 0)),
+	SUM(COALESCE(locations.actions_driving_directions, 0)),
+	SUM(COALESCE(locations.local_post_views_search, 0)),
+	SUM(COALESCE(locations.photos_count_customers, 0)),
+	SUM(COALESCE(locations.photos_count_merchant, 0)),
+	SUM(COALESCE(locations.photos_views_customers, 0)),
+	SUM(COALESCE(locations.photos_views_merchant, 0)),
+	-- a checksum of every delivered column of every row, which changes when
+	-- a grouping column is restated or a metric moves between rows
+	SUM(STRTOL(LEFT(MD5(
+		COALESCE(locations.date::VARCHAR, '') || '|' ||
+		COALESCE(locations.location, '') || '|' ||
+		COALESCE(locations.office_id::VARCHAR, '') || '|' ||
+		COALESCE(locations.office_site, '') || '|' ||
+		COALESCE(locations.area_number::VARCHAR, '') || '|' ||
+		COALESCE(locations.queries_direct::VARCHAR, '') || '|' ||
+		COALESCE(locations.queries_indirect::VARCHAR, '') || '|' ||
+		COALESCE(locations.views_maps::VARCHAR, '') || '|' ||
+		COALESCE(locations.views_search::VARCHAR, '') || '|' ||
+		COALESCE(locations.actions_website::VARCHAR, '') || '|' ||
+		COALESCE(locations.actions_phone::VARCHAR, '') || '|' ||
+		COALESCE(locations.actions_driving_directions::VARCHAR, '') || '|' ||
+		COALESCE(locations.local_post_views_search::VARCHAR, '') || '|' ||
+		COALESCE(locations.photos_count_customers::VARCHAR, '') || '|' ||
+		COALESCE(locations.photos_count_merchant::VARCHAR, '') || '|' ||
+		COALESCE(locations.photos_views_customers::VARCHAR, '') || '|' ||
+		COALESCE(locations.photos_views_merchant::VARCHAR, '')), 8), 16))
+FROM google.google_mybusiness_servicebc_derived AS locations
+  WHERE locations.client = 'servicebc'
+  AND locations.date BETWEEN {pmrp_date_range}
@@ -12,6 +12,7 @@
 #               : export pgpass=<<database_password>>
 #
 # Usage         : python redshift_to_s3.py -c config.d/config.json
+#               : python redshift_to_s3.py -c config.d/a.json config.d/b.json
 #
 import os
 import logging
@@ -19,6 +20,8 @@ import warnings
 import argparse
 import json
 import sys
+import hashlib
+from io import StringIO
 here = os.path.dirname(os.path.abspath(__file__))
 branch_root = os.path.abspath(os.path.join(here, ".."))
 if branch_root not in sys.path:
@@ -28,7 +31,10 @@ from tzlocal import get_localzone
 from pytz import timezone
 import psycopg2
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
+from psycopg2.pool import ThreadedConnectionPool
+from concurrent.futures import ThreadPoolExecutor
 import lib.logs as log
 from lib.redshift import RedShift
 import re
@@ -36,12 +42,8 @@ import re
 logger = logging.getLogger(__name__)
 log.setup()
 
-# Get script start time
 local_tz = get_localzone()
 yvr_tz = timezone('America/Vancouver')
-yvr_dt_start = (yvr_tz
-    .normalize(datetime.now(local_tz)
-    .astimezone(yvr_tz)))
 
 def clean_exit(code, message):
     """Exits with a logger message and code"""
@@ -52,50 +54,12 @@ def clean_exit(code, message):
 # Command line arguments
 parser = argparse.ArgumentParser(
     description='GDX Analytics ETL utility for PRMP.')
-parser.add_argument('-c', '--conf', help='Microservice configuration file.',)
+parser.add_argument('-c', '--conf', nargs='+',
+                    help='Microservice configuration file(s).',)
 parser.add_argument('-d', '--debug', help='Run in debug mode.',
                     action='store_true')
 flags = parser.parse_args()
 
-config = flags.conf
-config_file = sys.argv[2]
-
-# Load configuration json file as a dictionary
-with open(config) as f:
-    config = json.load(f)
-
-bucket = config['bucket']
-storage = config['storage']
-archive = config['archive']
-directory = config['directory']
-
-object_prefix = config['object_prefix']
-
-# creates the paths to the objects in s3 but does not have the object names
-batch_prefix = f"{archive}/batch/{config['storage']}/{config['directory']}" # where the data is temporarly stored when unloaded from redshift
-storage_prefix = f'{storage}/{directory}'                                   # where the final file for the client is stored
-good_prefix = f"{archive}/good/{config['storage']}/{config['directory']}"   # where the unloaded data is archived if the storage is successful
-bad_prefix = f"{archive}/bad/{config['storage']}/{config['directory']}"     # where the unloaded data is archived if the storage is unsuccessful
-
-dml_file = config['dml']
-header = config['header']
-
-sql_parse_key = \
-    False if 'sql_parse_key' not in config else config['sql_parse_key']
-
-# if escape option is missing from the config, set as disabled
-escape = False if 'escape' not in config else config['escape']
-
-# if delimiter option is missing from the config, set as disabled
-delimiter = False if 'delimiter' not in config else config['delimiter']
-
-# if addquotes option is missing from the config, set as enabled
-# even with this option enabled Excel will break when in a value a " appears before a delimiter character
-addquotes = True if 'addquotes' not in config else config['addquotes']
-
-if 'date_list' in config:
-    dates = config['date_list']
-
 # Get required environment variables
 pguser = os.environ['pguser']
 pgpass = os.environ['pgpass']
@@ -114,306 +78,628 @@ with warnings.catch_warnings():
     warnings.filterwarnings("ignore",category=Warning)
     # set up S3 connection
     client = boto3.client('s3')  # low-level functional API
-    resource = boto3.resource('s3')  # high-level object-oriented API
-    
-res_bucket = resource.Bucket(bucket)  # resource bucket object
-bucket_name = res_bucket.name
+
+# The smallest part S3 accepts in a multipart upload, other than the last part
+MIN_PART_SIZE = 5 * 1024 ** 2
+
+# The largest part that can be copied with a single UploadPartCopy request
+MAX_COPY_PART_SIZE = 5 * 1024 ** 3
+
+# The number of objects copied to the storage and archive folders at once
+COPY_WORKERS = 8
+
+# Objects larger than a single copy_object request allows are copied in parts
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=MAX_COPY_PART_SIZE)
+
+# The number of configuration files run at once, each on its own connection,
+# kept low so that concurrent UNLOADs do not fill the WLM queue
+UNLOAD_WORKERS = 3
+
+# UNLOAD appends a suffix to the name of every file it writes in these formats
+SUFFIXES = {'gzip': '.gz', 'zstd': '.zst', 'parquet': '.parquet'}
+
 
 def raise_(ex):
     '''to raise generic exceptions'''
     raise ex
 
 
-# returns the pmrp_date_range SQL statement to return a BETWEEN clause on date
-def pmrp_date_range():
-    '''generate a SQL DML string for a date type BETWEEN clause'''
-    between = "''{}'' AND ''{}''".format(start_date, end_date)
-    logger.info('date clause will be between %s', between)
-    return between
-
-
-def pmrp_qdata_dates():
-    '''generate a SQL DML string for a date list'''
-    date_list = ''
-    query = ''
-    for date in dates:
-        query += date_list.join(
-        "((cfms_poc.welcome_time >= (TIMESTAMP " + "''" + date + "''" + ")) AND "
-        "(cfms_poc.welcome_time < ((DATEADD(day,1, TIMESTAMP " + "''" + date + "''" + "))))) OR ")
-    last_or_index = query.rfind("OR")
-    query_string = query[:last_or_index]
-    return query_string
-
-
-# IMPORTANT
-# setup a list of known SQL Parse Keys; when adding new configs requiring
-# SQL request queries that contain a unique sql_parse_key keywords to format,
-# this dictionary must be updated to reference both the expected keyword and
-# a function name which will return the value for that keyword when called.
-SQLPARSE = {
-    'pmrp_date_range': pmrp_date_range,
-    'pmrp_qdata_dates': pmrp_qdata_dates,
-    }
+def run(config_file, conn, output):
+    """Create an object in S3 from the query and options in a configuration
+    file, ending with clean_exit().
 
+    Args:
+        config_file: The path of the configuration file.
+        conn: The Redshift connection to run the queries and UNLOAD on.
+        output: The text stream the run's report is written to.
+    """
+    # Get the run's start time; configs in a batch start at different times
+    yvr_dt_start = (yvr_tz
+        .normalize(datetime.now(local_tz)
+        .astimezone(yvr_tz)))
 
-def return_query(local_query):
-    '''returns the response from a query on redshift'''
-    with psycopg2.connect(conn_string) as local_conn:
-        with local_conn.cursor() as local_curs:
-            try:
-                local_curs.execute(local_query)
-            except psycopg2.Error:
-                logger.exception("psycopg2.Error:")
-                report_stats['failed_redshift_queries'] += 1
-                clean_exit(1, 'Failed psycopg2 query attempt.')
+    # Load configuration json file as a dictionary
+    with open(config_file) as f:
+        config = json.load(f)
+
+    bucket = config['bucket']
+    storage = config['storage']
+    archive = config['archive']
+    directory = config['directory']
+
+    object_prefix = config['object_prefix']
+
+    # creates the paths to the objects in s3 but does not have the object names
+    batch_prefix = f"{archive}/batch/{config['storage']}/{config['directory']}" # where the data is temporarly stored when unloaded from redshift
+    storage_prefix = f'{storage}/{directory}'                                   # where the final file for the client is stored
+    good_prefix = f"{archive}/good/{config['storage']}/{config['directory']}"   # where the unloaded data is archived if the storage is successful
+    state_prefix = f"{archive}/state/{config['storage']}/{config['directory']}"  # where small objects recording past runs are kept
+    last_sent_key = f'{state_prefix}/last_sent.json'       # records the end date of the last extract sent
+    fingerprint_key = f'{state_prefix}/fingerprint.json'   # records the fingerprint of the last extract sent
+
+    dml_file = config['dml']
+    header = config['header']
+
+    sql_parse_key = \
+        False if 'sql_parse_key' not in config else config['sql_parse_key']
+
+    # if escape option is missing from the config, set as disabled
+    escape = False if 'escape' not in config else config['escape']
+
+    # if delimiter option is missing from the config, set as disabled
+    delimiter = False if 'delimiter' not in config else config['delimiter']
+
+    # if parallel option is missing from the config, unload through a single slice
+    parallel = False if 'parallel' not in config else config['parallel']
+
+    # if compression option is missing from the config, unload uncompressed files
+    compression = \
+        False if 'compression' not in config else config['compression'].lower()
+
+    # if format option is missing from the config, unload delimited text
+    unload_format = 'text' if 'format' not in config else config['format'].lower()
+
+    # if maxfilesize option is missing from the config, use the UNLOAD default
+    maxfilesize = False if 'maxfilesize' not in config else config['maxfilesize']
+
+    if compression and compression not in ('gzip', 'zstd'):
+        clean_exit(1, f'Unsupported compression: {compression}.')
+    if unload_format not in ('text', 'parquet'):
+        clean_exit(1, f'Unsupported format: {unload_format}.')
+    if unload_format == 'parquet' and compression:
+        clean_exit(1, 'Parquet files are compressed by UNLOAD; '
+                      'compression cannot also be set.')
+    # the header row of a compressed part cannot be skipped by byte range
+    if parallel and header and compression:
+        clean_exit(1, 'A header cannot be merged from parallel compressed parts.')
+
+    suffix = SUFFIXES.get(compression or unload_format, '')
+
+    # if addquotes option is missing from the config, set as enabled
+    # even with this option enabled Excel will break when in a value a " appears before a delimiter character
+    addquotes = True if 'addquotes' not in config else config['addquotes']
+
+    if 'date_list' in config:
+        dates = config['date_list']
+
+    # boto3 resources are not thread safe, so each run creates its own
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore",category=Warning)
+        resource = boto3.session.Session().resource('s3')  # high-level object-oriented API
+    res_bucket = resource.Bucket(bucket)  # resource bucket object
+
+    # returns the pmrp_date_range SQL statement to return a BETWEEN clause on date
+    def pmrp_date_range():
+        '''generate a SQL DML string for a date type BETWEEN clause'''
+        between = "''{}'' AND ''{}''".format(start_date, end_date)
+        logger.info('date clause will be between %s', between)
+        return between
+
+
+    def pmrp_qdata_dates():
+        '''generate a SQL DML string for a date list'''
+        # coalesce the requested days into runs of consecutive days, so that
+        # each run is a single range on welcome_time
+        days = sorted({datetime.strptime(day.replace('-', ''), '%Y%m%d').date()
+                       for day in dates})
+        ranges = []
+        for day in days:
+            if ranges and day == ranges[-1][1]:
+                ranges[-1][1] = day + timedelta(days=1)
             else:
-                response = local_curs.fetchone()[0]
-                logger.info("returned: %s", response)
-                report_stats['good_redshift_queries'] += 1
-    return response
-
-
-def last_modified_object_key(prefix):
-    '''return last modified object key'''
-    # extract the list of objects
-    list_objs = client.list_objects_v2(Bucket=bucket, Prefix=prefix)
-
-    if list_objs['IsTruncated']:
-        logger.warning('The list of objects in: %s/%s was truncated.',
-                       bucket, prefix)
-    if list_objs['KeyCount'] == 0:
-        logger.warning('No objects found in %s/%s', bucket, prefix)
-        return None
-
-    # https://stackoverflow.com/questions/45375999/how-to-download-the-latest-file-of-an-s3-bucket-using-boto3
-    def last_modified_sorter(obj):
-        '''a sorter key method'''
-        return int(obj['LastModified'].strftime('%s'))
-
-    objs = list_objs['Contents']
-    last_added = [obj['Key'] for obj in sorted(
-        objs, key=last_modified_sorter, reverse=True)][0]
-    return last_added
-
-
-def unsent():
-    '''determine the start date'''
-    last_file = last_modified_object_key(good_prefix)
-    # default start date to three days ago if no objects present
-    if last_file is None:
-        logger.info("No previous files to extract start date key from")
-        return (date.today() - timedelta(days=3)).strftime('%Y%m%d')
-    # extract a start date based on the end date of the last uploaded file
-    logger.info("setting startdate to 1 after end date of last file: %s",
-                 last_file)
-    # 3rd from last index on split contains the file's end date as YYYYMMDD
-    return (datetime.strptime(last_file.split("_")[-3], '%Y%m%d')
-            + timedelta(days=1)).strftime('%Y%m%d')
-
-
-def get_date(date_selector):
-    '''return the SQL query for a date selector type'''
-    select = (f"SELECT to_char({date_selector}(date), 'YYYYMMDD') FROM "
-              "google.google_mybusiness_servicebc_derived")
-    return return_query(select)
-
-
-def object_key_builder(key_prefix, *args):
-    """Construct an Object Key string based on a prefix followed by any number
-    of optional positional arguemnts and suffixed by the localized timestamp.
+                ranges.append([day, day + timedelta(days=1)])
+        query_string = '(' + ' OR '.join(
+            f"(cfms_poc.welcome_time >= TIMESTAMP ''{start}'' AND "
+            f"cfms_poc.welcome_time < TIMESTAMP ''{end}'')"
+            for start, end in ranges) + ')'
+        logger.info('%s dates requested as %s ranges', len(days), len(ranges))
+        return query_string
+
+
+    # IMPORTANT
+    # setup a list of known SQL Parse Keys; when adding new configs requiring
+    # SQL request queries that contain a unique sql_parse_key keywords to format,
+    # this dictionary must be updated to reference both the expected keyword and
+    # a function name which will return the value for that keyword when called.
+    SQLPARSE = {
+        'pmrp_date_range': pmrp_date_range,
+        'pmrp_qdata_dates': pmrp_qdata_dates,
+        }
+
+
+    def return_query(local_query):
+        '''returns the response from a query on redshift'''
+        return return_row(local_query)[0]
+
+
+    def return_row(local_query):
+        '''returns the first row of the response from a query on redshift'''
+        with conn as local_conn:
+            with local_conn.cursor() as local_curs:
+                try:
+                    local_curs.execute(local_query)
+                except psycopg2.Error:
+                    logger.exception("psycopg2.Error:")
+                    report_stats['failed_redshift_queries'] += 1
+                    clean_exit(1, 'Failed psycopg2 query attempt.')
+                else:
+                    response = local_curs.fetchone()
+                    logger.info("returned: %s", response)
+                    report_stats['good_redshift_queries'] += 1
+        return response
+
+
+    def last_modified_object_key(prefix):
+        '''return last modified object key'''
+        # page through every object under the prefix, keeping the latest one
+        last_added = None
+        paginator = client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                if last_added is None or obj['LastModified'] > last_added['LastModified']:
+                    last_added = obj
+
+        if last_added is None:
+            logger.warning('No objects found in %s/%s', bucket, prefix)
+            return None
+        return last_added['Key']
+
+
+    def read_state(key):
+        '''return the state recorded in a small JSON object, or None if it has not
+        been written or cannot be read'''
+        try:
+            body = client.get_object(Bucket=bucket, Key=key)['Body']
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchKey':
+                logger.exception('Exception reading s3://%s/%s', bucket, key)
+            return None
+        return json.loads(body.read())
+
+
+    def write_state(key, state):
+        '''record state in a small JSON object'''
+        client.put_object(Bucket=bucket, Key=key, Body=json.dumps(state))
+        logger.info('Recorded %s in s3://%s/%s', state, bucket, key)
+
+
+    def read_last_sent():
+        '''return the end date of the last extract sent, as recorded in the index,
+        or None if no index has been written for this config'''
+        last_sent = read_state(last_sent_key)
+        return None if last_sent is None else last_sent['end_date']
+
+
+    def write_last_sent(end_date):
+        '''record the end date of the extract just sent in the index'''
+        write_state(last_sent_key, {'end_date': end_date, 'object_key': object_key})
+
+
+    def unsent():
+        '''determine the start date'''
+        last_end_date = read_last_sent()
+        if last_end_date is None:
+            # fall back to the end date in the key of the last archived file
+            last_file = last_modified_object_key(good_prefix)
+            # default start date to three days ago if no objects present
+            if last_file is None:
+                logger.info("No previous files to extract start date key from")
+                return (date.today() - timedelta(days=3)).strftime('%Y%m%d')
+            logger.info("setting startdate to 1 after end date of last file: %s",
+                         last_file)
+            # 3rd from last index on split contains the file's end date as YYYYMMDD
+            last_end_date = last_file.split("_")[-3]
+        else:
+            logger.info("setting startdate to 1 after last sent end date: %s",
+                        last_end_date)
+        # extract a start date based on the end date of the last uploaded file
+        return (datetime.strptime(last_end_date, '%Y%m%d')
+                + timedelta(days=1)).strftime('%Y%m%d')
+
+
+    def get_date(date_selector):
+        '''return the SQL query for a date selector type'''
+        select = (f"SELECT to_char({date_selector}(date), 'YYYYMMDD') FROM "
+                  "google.google_mybusiness_servicebc_derived")
+        return return_query(select)
+
+
+    def manifest_keys(manifest_key):
+        '''return the keys of the part objects listed in an UNLOAD manifest'''
+        manifest = json.loads(
+            client.get_object(Bucket=bucket, Key=manifest_key)['Body'].read())
+        return [entry['url'].replace(f's3://{bucket}/', '', 1)
+                for entry in manifest['entries']]
+
+
+    def header_length(key):
+        '''return the length in bytes of the header row of a part object'''
+        head = client.get_object(
+            Bucket=bucket, Key=key, Range='bytes=0-65535')['Body'].read()
+        return head.find(b'\n') + 1
+
+
+    def merge_parts(part_keys, merged_key, skip_header):
+        """Assemble part objects into a single object with a multipart upload.
+
+        Parts are copied server side with UploadPartCopy. Since every part of a
+        multipart upload but the last must be at least MIN_PART_SIZE, runs of
+        smaller parts are read and uploaded together as one part.
+
+        Args:
+            part_keys: The keys of the parts, in order.
+            merged_key: The key of the object to create.
+            skip_header: If true, the header row of every part after the first is
+                left out of the merged object.
+        """
+        # (key, first byte, end byte) of each part's content to be merged
+        segments = []
+        for index, key in enumerate(part_keys):
+            size = client.head_object(Bucket=bucket, Key=key)['ContentLength']
+            start = header_length(key) if skip_header and index and size else 0
+            if size > start:
+                segments.append((key, start, size))
+
+        upload_id = client.create_multipart_upload(
+            Bucket=bucket, Key=merged_key)['UploadId']
+        parts = []
+        buffer = b''
+
+        def upload_buffer():
+            response = client.upload_part(
+                Bucket=bucket, Key=merged_key, UploadId=upload_id,
+                PartNumber=len(parts) + 1, Body=buffer)
+            parts.append({'ETag': response['ETag'], 'PartNumber': len(parts) + 1})
 
-    Args:
-        key_prefix: A required prefix for this object's key
-        *args: Variable length argument list.
+        try:
+            for index, (key, start, end) in enumerate(segments):
+                last = index == len(segments) - 1
+                while start < end:
+                    if not buffer and (end - start >= MIN_PART_SIZE or last):
+                        # copy as much of this part as UploadPartCopy allows
+                        stop = min(end, start + MAX_COPY_PART_SIZE)
+                        response = client.upload_part_copy(
+                            Bucket=bucket, Key=merged_key, UploadId=upload_id,
+                            PartNumber=len(parts) + 1,
+                            CopySource={'Bucket': bucket, 'Key': key},
+                            CopySourceRange=f'bytes={start}-{stop - 1}')
+                        parts.append({
+                            'ETag': response['CopyPartResult']['ETag'],
+                            'PartNumber': len(parts) + 1})
+                    else:
+                        # too small to be a part by itself; read it into the
+                        # buffer until the buffer is large enough to upload
+                        stop = min(end, start + MIN_PART_SIZE - len(buffer))
+                        buffer += client.get_object(
+                            Bucket=bucket, Key=key,
+                            Range=f'bytes={start}-{stop - 1}')['Body'].read()
+                        if len(buffer) >= MIN_PART_SIZE:
+                            upload_buffer()
+                            buffer = b''
+                    start = stop
+            # upload what remains, or an empty part if there was no content
+            if buffer or not parts:
+                upload_buffer()
+            client.complete_multipart_upload(
+                Bucket=bucket, Key=merged_key, UploadId=upload_id,
+                MultipartUpload={'Parts': parts})
+        except ClientError:
+            client.abort_multipart_upload(
+                Bucket=bucket, Key=merged_key, UploadId=upload_id)
+            raise
+
+
+    def delete_keys(keys):
+        '''delete objects from the bucket in batches of up to 1000 keys'''
+        for i in range(0, len(keys), 1000):
+            client.delete_objects(
+                Bucket=bucket,
+                Delete={'Objects': [{'Key': key} for key in keys[i:i + 1000]],
+                        'Quiet': True})
+
+
+    def merge_unload():
+        """Merge the files of a parallel UNLOAD into the single object that an
+        UNLOAD with PARALLEL OFF would have written, then remove the parts and
+        manifest from the batch folder. If the merge fails the parts are archived
+        to the bad folder and the microservice exits.
+
+        Parquet files cannot be concatenated, so they are left to be stored as
+        they are, and only the manifest is removed."""
+        manifest_key = f'{batch_prefix}/{object_key}_partmanifest'
+        merged_key = f'{batch_prefix}/{object_key}_part000{suffix}'
+        if unload_format == 'parquet':
+            delete_keys([manifest_key])
+            return
+        part_keys = []
+        try:
+            part_keys = manifest_keys(manifest_key)
+            logger.info('Merging %s unloaded parts into s3://%s/%s',
+                        len(part_keys), bucket, merged_key)
+            merge_parts(part_keys, merged_key, skip_header=header)
+        except ClientError:
+            logger.exception('Exception merging the parts listed in s3://%s/%s',
+                             bucket, manifest_key)
+            for key in part_keys + [manifest_key]:
+                bad_key = key.replace(f'{archive}/batch/', f'{archive}/bad/', 1)
+                copy_key(key, bad_key)
+                report_stats['bad_objects_list'].append(bad_key)
+                report_stats['bad_objects'] += 1
+            report(report_stats)
+            clean_exit(1, 'Failed to merge the unloaded parts.')
+        delete_keys(part_keys + [manifest_key])
+
+
+    def query_fingerprint():
+        """Return a fingerprint of the request query and its result.
+
+        The result is represented by the row returned from the cheap query in the
+        configured "fingerprint" DML file, such as a row count and latest
+        timestamp of the source tables. It is formatted with the same SQL Parse Key
+        value as the request query.
+        """
+        fingerprint_query = open('dml/{}'.format(config['fingerprint']), 'r').read()
+        if sql_parse_key:
+            # the fingerprint query is not wrapped in an UNLOAD, so its quotes are
+            # not doubled
+            fingerprint_query = fingerprint_query.format(
+                **{sql_parse_key: sql_parse_value.replace("''", "'")})
+        row = return_row(fingerprint_query)
+        return hashlib.sha256(
+            json.dumps([request_query, row], default=str).encode()).hexdigest()
+
+
+    def object_key_builder(key_prefix, *args):
+        """Construct an Object Key string based on a prefix followed by any number
+        of optional positional arguemnts and suffixed by the localized timestamp.
+
+        Args:
+            key_prefix: A required prefix for this object's key
+            *args: Variable length argument list.
+
+        Returns:
+            The complete object key string.
+        """
+        nowtime = datetime.now().strftime('%Y%m%dT%H%M%S')
+        key_parts = [key_prefix]
+        if args:
+            key_parts.extend(list(args))
+        key_parts.append(nowtime)
+        object_key = '_'.join(str(part) for part in key_parts)
+        return object_key
+
+    # Will run at end of script to print out accumulated report_stats
+    def report(data):
+        '''reports out the data from the main program loop'''
+        def out(*args):
+            '''print to this run's report'''
+            print(*args, file=output)
+
+        if data['failed_redshift_queries'] or data['failed_unloads'] or data['unstored_objects'] or data['bad_objects']:
+            out(f'\n*** ATTN: The microservice ran unsuccessfully. Please investigate logs/{__file__} ***\n') 
+        else:
+            out(f'\n***The microservice ran successfully***\n')
+
+        out(f'Report: {__file__}\n')
+        out(f'Config: {config_file}\n')
+        out(f'DML: {dml_file}\n')
+
+        if 'start_date' and 'end_date' in config:
+            out(f'Requested Dates: {start_date} to {end_date}\n')
+        # Get times from system and convert to Americas/Vancouver for printing
+        yvr_dt_end = (yvr_tz
+            .normalize(datetime.now(local_tz)
+            .astimezone(yvr_tz)))
+        out(
+        	f'Microservice started at: '
+            f'{yvr_dt_start.strftime("%Y-%m-%d %H:%M:%S%z (%Z)")}, '
+            f'ended at: {yvr_dt_end.strftime("%Y-%m-%d %H:%M:%S%z (%Z)")}, '
+            f'elapsing: {yvr_dt_end - yvr_dt_start}.\n')
+
+        if data['unchanged']:
+            out('The query result is unchanged since the last delivery; '
+                  'nothing was unloaded.\n')
+
+        out(f'\nObjects loaded to S3 /batch: {data["successful_unloads"]}/{data["successful_unloads"]+data["failed_unloads"]}')
+
+        #Print additional messages to standardize reports
+
+        if data["successful_unloads"]:
+            out(f'Objects successfully loaded to S3 /batch: {data["successful_unloads"]}')
+            out("\nList of objects successfully loaded to S3 /batch")
+            for i, item in enumerate(data['successful_unloads_list'], 1):
+                out(f"{i}.",f'{batch_prefix}/{item}')
+
+        if data["failed_unloads"]:
+            out(f'\nObjects unsuccessfully loaded to S3 /batch: {data["failed_unloads"]}')
+            out("\nList of objects unsuccessfully loaded to S3 /batch:")
+            for i, item in enumerate(data['failed_unloads_list'], 1):
+                 out(f"{i}.",f'{batch_prefix}/{item}')
+
+        out(f'\n\nObjects to store: {data["unprocessed_objects"]}')
+
+        # Print all objects loaded into s3/client
+        if data["stored_objects"]:
+            out(f'Objects stored to s3 /client: {data["stored_objects"]}')
+            out(f'\nList of objects stored to S3 /client:')
+            if data['stored_objects_list']:
+                for i, item in enumerate(data['stored_objects_list'], 1):
+                    out(f"{i}: {item}")
+
+        # Print all objects not loaded into s3/client
+        if data["unstored_objects"]:
+            out(f'Objects not stored to s3 /client: {data["unstored_objects"]}')
+            out(f'\nList of objects not stored to S3 /client:')
+            if data['unstored_objects_list']:
+                for i, item in enumerate(data['unstored_objects_list'], 1):
+                    out(f"{i}: {item}")
+
+        out(f'\n\nObjects to process: {data["unprocessed_objects"]}')
+
+        # Print all objects loaded into s3/good
+        if data["good_objects"]:
+            out(f'Objects processed to s3 /good: {data["good_objects"]}')
+            out(f'\nList of objects processed to S3 /good:')
+            if data['good_objects_list']:
+                for i, item in enumerate(data['good_objects_list'], 1):
+                    out(f"{i}: {item}")
+
+        # Print all objects loaded into s3/bad
+        if data["bad_objects"]:
+            out(f'Objects processed to s3 /bad: {data["bad_objects"]}')
+            out(f'\nList of objects processed to S3 /bad:')
+            if data['bad_objects_list']:
+                for i, item in enumerate(data['bad_objects_list'], 1):
+                    out(f"{i}: {item}")
+
+    # Reporting variables. Accumulates as the the loop below is traversed
+    report_stats = {
+        'redshift_queries': 0,
+        'failed_redshift_queries':0,
+        'good_redshift_queries':0,
+        'successful_unloads':0,
+        'successful_unloads_list': [],
+        'failed_unloads':0,
+        'failed_unloads_list': [],
+        'unprocessed_objects': 0,
+        'stored_objects': 0,
+        'stored_objects_list': [],
+        'unstored_objects': 0,
+        'unstored_objects_list': [],
+        'good_objects': 0,
+        'good_objects_list': [],
+        'bad_objects': 0,
+        'bad_objects_list' : [],
+        'unchanged': False
+    }
+
+    if 'start_date' in config and 'end_date' in config:
+        # set start and end dates, defaulting to min/max if not defined
+        start_date = config['start_date']
+        end_date = config['end_date']
+
+        # set start_date if not a YYYYMMDD value
+        if any(start_date == pick for pick in ['min', 'max']):
+            start_date = get_date(start_date)
+
+        # determine unsent value for start date
+        if start_date == 'unsent':
+            start_date = unsent()
+            logger.info("unsent start date set to: %s", start_date)
+
+        # set end_date if not a YYYYMMDD value
+        if any(end_date == pick for pick in ['min', 'max', 'unsent']):
+            if end_date == 'unsent':
+                end_date = 'max'
+            end_date = get_date(end_date)
+
+        if start_date > end_date:
+            clean_exit(1, f'Start_date: {start_date} cannot be greater '
+                       'than end_date: {end_date}.')
+
+        object_key = object_key_builder(object_prefix,start_date,end_date)
+
+    elif 'date_list' in config:
+        # set dates requested in date_list
+        date_key = "_".join(dates)
+        temp_key = object_key_builder(object_prefix, date_key)
+        # restrict object name length
+        object_key = temp_key[:255] if len(temp_key) > 255 else temp_key
 
-    Returns:
-        The complete object key string.
-    """
-    nowtime = datetime.now().strftime('%Y%m%dT%H%M%S')
-    key_parts = [key_prefix]
-    if args:
-        key_parts.extend(list(args))
-    key_parts.append(nowtime)
-    object_key = '_'.join(str(part) for part in key_parts)
-    return object_key
-
-# Will run at end of script to print out accumulated report_stats
-def report(data):
-    '''reports out the data from the main program loop'''
-    if data['failed_redshift_queries'] or data['failed_unloads'] or data['unstored_objects'] or data['bad_objects']:
-        print(f'\n*** ATTN: The microservice ran unsuccessfully. Please investigate logs/{__file__} ***\n') 
     else:
-        print(f'\n***The microservice ran successfully***\n')
- 
-    print(f'Report: {__file__}\n')
-    print(f'Config: {config_file}\n')
-    print(f'DML: {dml_file}\n')
-
-    if 'start_date' and 'end_date' in config:
-        print(f'Requested Dates: {start_date} to {end_date}\n')
-    # Get times from system and convert to Americas/Vancouver for printing
-    yvr_dt_end = (yvr_tz
-        .normalize(datetime.now(local_tz)
-        .astimezone(yvr_tz)))
-    print(
-    	f'Microservice started at: '
-        f'{yvr_dt_start.strftime("%Y-%m-%d %H:%M:%S%z (%Z)")}, '
-        f'ended at: {yvr_dt_end.strftime("%Y-%m-%d %H:%M:%S%z (%Z)")}, '
-        f'elapsing: {yvr_dt_end - yvr_dt_start}.\n')
-
-    print(f'\nObjects loaded to S3 /batch: {data["successful_unloads"]}/{data["successful_unloads"]+data["failed_unloads"]}')
-
-    #Print additional messages to standardize reports
-
-    if data["successful_unloads"]:
-        print(f'Objects successfully loaded to S3 /batch: {data["successful_unloads"]}')
-        print("\nList of objects successfully loaded to S3 /batch")
-        for i, item in enumerate(data['successful_unloads_list'], 1):
-            print(f"{i}.",f'{batch_prefix}/{item}')
-
-    if data["failed_unloads"]:
-        print(f'\nObjects unsuccessfully loaded to S3 /batch: {data["failed_unloads"]}')
-        print("\nList of objects unsuccessfully loaded to S3 /batch:")
-        for i, item in enumerate(data['failed_unloads_list'], 1):
-             print(f"{i}.",f'{batch_prefix}/{item}')
-    
-    print(f'\n\nObjects to store: {data["unprocessed_objects"]}')
-
-    # Print all objects loaded into s3/client
-    if data["stored_objects"]:
-        print(f'Objects stored to s3 /client: {data["stored_objects"]}')
-        print(f'\nList of objects stored to S3 /client:')
-        if data['stored_objects_list']:
-            for i, item in enumerate(data['stored_objects_list'], 1):
-                print(f"{i}: {item}")
-
-    # Print all objects not loaded into s3/client
-    if data["unstored_objects"]:
-        print(f'Objects not stored to s3 /client: {data["unstored_objects"]}')
-        print(f'\nList of objects not stored to S3 /client:')
-        if data['unstored_objects_list']:
-            for i, item in enumerate(data['unstored_objects_list'], 1):
-                print(f"{i}: {item}")
-
-    print(f'\n\nObjects to process: {data["unprocessed_objects"]}')
-
-    # Print all objects loaded into s3/good
-    if data["good_objects"]:
-        print(f'Objects processed to s3 /good: {data["good_objects"]}')
-        print(f'\nList of objects processed to S3 /good:')
-        if data['good_objects_list']:
-            for i, item in enumerate(data['good_objects_list'], 1):
-                print(f"{i}: {item}")
-
-    # Print all objects loaded into s3/bad
-    if data["bad_objects"]:
-        print(f'Objects processed to s3 /bad: {data["bad_objects"]}')
-        print(f'\nList of objects processed to S3 /bad:')
-        if data['bad_objects_list']:
-            for i, item in enumerate(data['bad_objects_list'], 1):
-                print(f"{i}: {item}")
-
-# Reporting variables. Accumulates as the the loop below is traversed
-report_stats = {
-    'redshift_queries': 0,
-    'failed_redshift_queries':0,
-    'good_redshift_queries':0,
-    'successful_unloads':0,
-    'successful_unloads_list': [],
-    'failed_unloads':0,
-    'failed_unloads_list': [],
-    'unprocessed_objects': 0,
-    'stored_objects': 0,
-    'stored_objects_list': [],
-    'unstored_objects': 0,
-    'unstored_objects_list': [],
-    'good_objects': 0,
-    'good_objects_list': [],
-    'bad_objects': 0,
-    'bad_objects_list' : []
-}
-
-if 'start_date' in config and 'end_date' in config:
-    # set start and end dates, defaulting to min/max if not defined
-    start_date = config['start_date']
-    end_date = config['end_date']
-
-    # set start_date if not a YYYYMMDD value
-    if any(start_date == pick for pick in ['min', 'max']):
-        start_date = get_date(start_date)
-
-    # determine unsent value for start date
-    if start_date == 'unsent':
-        start_date = unsent()
-        logger.info("unsent start date set to: %s", start_date)
-
-    # set end_date if not a YYYYMMDD value
-    if any(end_date == pick for pick in ['min', 'max', 'unsent']):
-        if end_date == 'unsent':
-            end_date = 'max'
-        end_date = get_date(end_date)
-
-    if start_date > end_date:
-        clean_exit(1, f'Start_date: {start_date} cannot be greater '
-                   'than end_date: {end_date}.')
-
-    object_key = object_key_builder(object_prefix,start_date,end_date)
-
-elif 'date_list' in config:
-    # set dates requested in date_list
-    date_key = "_".join(dates)
-    temp_key = object_key_builder(object_prefix, date_key)
-    # restrict object name length
-    object_key = temp_key[:255] if len(temp_key) > 255 else temp_key
-
-else:
-    object_key = object_key_builder(object_prefix)
-
-# the _substantive_ query, one that users expect to see as output in S3.
-request_query = open('dml/{}'.format(dml_file), 'r').read()
-
-# If an SQL Parse Key was configured modify the request_query according to
-# the value of the set parse
-if sql_parse_key:
-    # Check to see if the SQL Parse Key configured is known
-    try:
-        # derive the sql_parse_value based on the sql_parse_key
-        sql_parse_value = SQLPARSE.get(
-            sql_parse_key, lambda: raise_(Exception(LookupError)))()
-    except KeyError:
-        clean_exit(1,'The SQL Parse Key configured has not been implemented.')
-
-    # Set the config defined sql_parse_key value as the key
-    # in a dict with the computed sql_parse_value as that key's value
-    keyword_dict = {config['sql_parse_key']: sql_parse_value}
-    # pass the keyword_dict to the request query formatter
-    request_query = request_query.format(**keyword_dict)
-
-# If escape was enabled, create string needed to be added to UNLOAD command 
-# else adds a blank string
-if escape:
-    escape_string = "ESCAPE"
-else:
-    escape_string = ""
-
-# If delimiter was enabled, create string needed to be added to UNLOAD command 
-# else adds a blank string
-if delimiter:
-    delimiter_string = "delimiter '{delimiter}'".format(delimiter=delimiter)
-else:
-    delimiter_string = ""
-
-# If addquotes was enabled, create string needed to be added to UNLOAD command 
-# else adds a blank string
-if addquotes:
-    addquotes_string = "ADDQUOTES"
-else:
-    addquotes_string = ""
-
-# The UNLOAD query to support S3 loading direct from a Redshift query
-# ref: https://docs.aws.amazon.com/redshift/latest/dg/r_UNLOAD.html
-# This UNLOAD inserts into the S3 BATCH path
-log_query = '''
+        object_key = object_key_builder(object_prefix)
+
+    # the _substantive_ query, one that users expect to see as output in S3.
+    request_query = open('dml/{}'.format(dml_file), 'r').read()
+
+    # If an SQL Parse Key was configured modify the request_query according to
+    # the value of the set parse
+    if sql_parse_key:
+        # Check to see if the SQL Parse Key configured is known
+        try:
+            # derive the sql_parse_value based on the sql_parse_key
+            sql_parse_value = SQLPARSE.get(
+                sql_parse_key, lambda: raise_(Exception(LookupError)))()
+        except KeyError:
+            clean_exit(1,'The SQL Parse Key configured has not been implemented.')
+
+        # Set the config defined sql_parse_key value as the key
+        # in a dict with the computed sql_parse_value as that key's value
+        keyword_dict = {config['sql_parse_key']: sql_parse_value}
+        # pass the keyword_dict to the request query formatter
+        request_query = request_query.format(**keyword_dict)
+
+    # If a fingerprint query was configured, skip the UNLOAD and delivery when
+    # the fingerprint matches the one recorded for the last delivery
+    if 'fingerprint' in config:
+        fingerprint = query_fingerprint()
+        last_delivery = read_state(fingerprint_key)
+        if last_delivery and last_delivery['fingerprint'] == fingerprint:
+            logger.info('Fingerprint %s matches the delivery of %s',
+                        fingerprint, last_delivery['object_key'])
+            report_stats['unchanged'] = True
+            report(report_stats)
+            clean_exit(0, 'Query result unchanged since the last delivery.')
+
+    # If escape was enabled, create string needed to be added to UNLOAD command 
+    # else adds a blank string
+    if escape:
+        escape_string = "ESCAPE"
+    else:
+        escape_string = ""
+
+    # If delimiter was enabled, create string needed to be added to UNLOAD command 
+    # else adds a blank string
+    if delimiter:
+        delimiter_string = "delimiter '{delimiter}'".format(delimiter=delimiter)
+    else:
+        delimiter_string = ""
+
+    # If addquotes was enabled, create string needed to be added to UNLOAD command 
+    # else adds a blank string
+    if addquotes:
+        addquotes_string = "ADDQUOTES"
+    else:
+        addquotes_string = ""
+
+    # Parquet files carry their own schema and encoding, so the delimited text
+    # options do not apply
+    if unload_format == 'parquet':
+        escape_string = delimiter_string = addquotes_string = ""
+        format_string = "FORMAT AS PARQUET"
+    else:
+        format_string = compression.upper() if compression else ""
+
+    # If maxfilesize was set, limit the size of each file UNLOAD writes
+    if maxfilesize:
+        maxfilesize_string = "MAXFILESIZE AS {}".format(maxfilesize)
+    else:
+        maxfilesize_string = ""
+
+    # The UNLOAD query to support S3 loading direct from a Redshift query
+    # ref: https://docs.aws.amazon.com/redshift/latest/dg/r_UNLOAD.html
+    # This UNLOAD inserts into the S3 BATCH path
+    log_query = '''
 UNLOAD ('{request_query}')
 TO 's3://{bucket}/{batch_prefix}/{object_key}_part'
 credentials 'aws_access_key_id={aws_access_key_id};\
@@ -421,148 +707,276 @@ aws_secret_access_key={aws_secret_access_key}'
 {escape_string}
 {delimiter_string}
 {addquotes_string}
-PARALLEL OFF
+{format_string}
+{maxfilesize_string}
+{parallel_string}
 {header}
 '''.format(
-    request_query=request_query,
-    bucket=bucket,
-    batch_prefix=batch_prefix,
-    object_key=object_key,
-    aws_access_key_id='{aws_access_key_id}',
-    aws_secret_access_key='{aws_secret_access_key}',
-    escape_string=escape_string,
-    delimiter_string=delimiter_string,
-    addquotes_string=addquotes_string,
-    header='HEADER' if header else '')
-
-query = log_query.format(
-    aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
-    aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'])
-
-def get_unprocessed_objects():
-    # This bucket scan will find unprocessed objects matching on the object prefix
-    # objects_to_process will contain zero or one objects if truncate = True
-    # objects_to_process will contain zero or more objects if truncate = False
-    filename_regex = fr'^{object_prefix}'
-    objects_to_process = []
-    for object_summary in res_bucket.objects.filter(Prefix=f'{batch_prefix}/'):
-        key = object_summary.key # aka the batch prefix of the object
-        filename = key[key.rfind('/')+1:]  # get the filename (after the last '/')
-        
-        # replaces the batch part of the key with good/bad
-        goodfile = key.replace(f'{archive}/batch/', f'{archive}/good/', 1)
-        badfile = key.replace(f'{archive}/batch/', f'{archive}/bad/', 1)
-
-        def is_processed():
-            '''Check to see if the file has been processed already'''
-            try:
-                client.head_object(Bucket=bucket, Key=goodfile)
-            except ClientError:
-                pass  # this object does not exist under the good destination path
+        request_query=request_query,
+        bucket=bucket,
+        batch_prefix=batch_prefix,
+        object_key=object_key,
+        aws_access_key_id='{aws_access_key_id}',
+        aws_secret_access_key='{aws_secret_access_key}',
+        escape_string=escape_string,
+        delimiter_string=delimiter_string,
+        addquotes_string=addquotes_string,
+        format_string=format_string,
+        maxfilesize_string=maxfilesize_string,
+        parallel_string='PARALLEL ON\nMANIFEST' if parallel else 'PARALLEL OFF',
+        header='HEADER' if header and unload_format == 'text' else '')
+
+    query = log_query.format(
+        aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+        aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'])
+
+    def get_unprocessed_objects():
+        # This bucket scan will find unprocessed objects matching on the object prefix
+        # objects_to_process will contain zero or one objects if truncate = True
+        # objects_to_process will contain zero or more objects if truncate = False
+        filename_regex = fr'^{object_prefix}'
+        objects_to_process = []
+        for object_summary in res_bucket.objects.filter(Prefix=f'{batch_prefix}/'):
+            key = object_summary.key # aka the batch prefix of the object
+            filename = key[key.rfind('/')+1:]  # get the filename (after the last '/')
+
+            # replaces the batch part of the key with good/bad
+            goodfile = key.replace(f'{archive}/batch/', f'{archive}/good/', 1)
+            badfile = key.replace(f'{archive}/batch/', f'{archive}/bad/', 1)
+
+            def is_processed():
+                '''Check to see if the file has been processed already'''
+                try:
+                    client.head_object(Bucket=bucket, Key=goodfile)
+                except ClientError:
+                    pass  # this object does not exist under the good destination path
+                else:
+                    logger.info("%s was processed as good already.", filename)
+                    return True
+                try:
+                    client.head_object(Bucket=bucket, Key=badfile)
+                except ClientError:
+                    pass  # this object does not exist under the bad destination path
+                else:
+                    logger.info("%s was processed as bad already.", filename)
+                    return True
+                logger.info("%s has not been processed.", filename)
+                return False
+
+            # skip to next object if already processed
+            if is_processed():
+                continue
+            if re.search(filename_regex, filename):
+                objects_to_process.append(object_summary)
+                logger.info('added %a for processing', filename)
+                report_stats['unprocessed_objects'] += 1
+        return objects_to_process
+
+    def copy_key(from_key, to_key):
+        '''copy an object within the bucket, using a multipart copy for objects
+        larger than a single copy_object request allows'''
+        client.copy(
+            CopySource={'Bucket': bucket, 'Key': from_key},
+            Bucket=bucket,
+            Key=to_key,
+            Config=TRANSFER_CONFIG)
+
+
+    def store_object(key):
+        """Copy a batch object to the client storage folder, then archive it to
+        the good folder, or to the bad folder if it could not be stored.
+
+        Args:
+            key: The key of the object in the batch folder.
+
+        Returns:
+            A tuple of the batch key, the key the object was stored to (None if it
+            was not stored), and the key it was archived to (None if archiving
+            failed).
+        """
+        # final paths that include the filenames
+        copy_good_prefix = key.replace(f'{archive}/batch/', f'{archive}/good/', 1)
+        copy_bad_prefix = key.replace(f'{archive}/batch/', f'{archive}/bad/', 1)
+        copy_from_prefix = key
+
+        if 'extension' in config and unload_format == 'text':
+            # if an extension was set in the config, add it to the end of the file,
+            # ahead of the suffix UNLOAD adds to compressed files (as in .csv.gz)
+            extension = config['extension']
+            filename_with_extension = (
+                f"{key[:len(key) - len(suffix)]}{extension}{suffix}")
+            logger.info('File extension set in %s as "%s"', config_file, extension)
+        else:
+            filename_with_extension = key
+            logger.info('File extension not set in %s', config_file)
+
+        # final storage path that includes the filename and optional extension, removes the batch part of the prefix and leaves the client
+        copy_to_prefix = filename_with_extension.replace(f'{archive}/batch/', '', 1)
+        try:
+            logger.info('Copying to s3 /client ...')
+            copy_key(copy_from_prefix, copy_to_prefix)
+        except ClientError:
+            logger.exception('Exception copying from s3://%s/%s', bucket, copy_from_prefix)
+            logger.exception('to s3://%s/%s', bucket, copy_to_prefix)
+            copy_to_prefix = None
+            archive_prefix = copy_bad_prefix
+            logger.info('Copying to s3 /bad ...')
+        else:
+            logger.info('Copied from s3://%s/%s', bucket, copy_from_prefix)
+            logger.info('Copied to s3://%s/%s', bucket, copy_to_prefix)
+            archive_prefix = copy_good_prefix
+            logger.info('Copying to s3 /good ...')
+
+        try:
+            copy_key(copy_from_prefix, archive_prefix)
+        except ClientError:
+            logger.exception('Exception copying from s3://%s/%s', bucket, copy_from_prefix)
+            logger.exception('to s3://%s/%s', bucket, archive_prefix)
+            return key, copy_to_prefix, None
+        logger.info('Copied from s3://%s/%s', bucket, copy_from_prefix)
+        logger.info('Copied to s3://%s/%s', bucket, archive_prefix)
+        return key, copy_to_prefix, archive_prefix
+
+
+    def store_objects(objects):
+        """Store and archive batch objects concurrently, then record the outcome
+        for each object in report_stats in order.
+
+        Returns:
+            True if every object was stored and archived, otherwise False.
+        """
+        with ThreadPoolExecutor(max_workers=COPY_WORKERS) as executor:
+            results = list(executor.map(
+                store_object, [object_summary.key for object_summary in objects]))
+
+        succeeded = True
+        for key, stored_key, archived_key in results:
+            if stored_key:
+                report_stats['stored_objects'] += 1
+                report_stats['stored_objects_list'].append(stored_key)
+            else:
+                succeeded = False
+                report_stats['unstored_objects'] += 1
+                report_stats['unstored_objects_list'].append(key)
+            if archived_key is None:
+                succeeded = False
+            elif stored_key:
+                report_stats['good_objects'] += 1
+                report_stats['good_objects_list'].append(archived_key)
             else:
-                logger.info("%s was processed as good already.", filename)
-                return True
+                report_stats['bad_objects'] += 1
+                report_stats['bad_objects_list'].append(archived_key)
+        return succeeded
+
+
+    with conn:
+        with conn.cursor() as curs:
             try:
-                client.head_object(Bucket=bucket, Key=badfile)
-            except ClientError:
-                pass  # this object does not exist under the bad destination path
+                logger.info("executing query")
+                curs.execute(query)
+                logger.info(log_query)
+            except psycopg2.Error:
+                logger.exception("psycopg2.Error:")
+                logger.error(('UNLOAD transaction on %s failed.'
+                              'Quitting with error code 1'), dml_file)
+                report_stats['failed_unloads'] += 1
+                report_stats['failed_unloads_list'].append(object_key)
+                report(report_stats)
+                clean_exit(1,'Failed psycopg2 query attempt.')
             else:
-                logger.info("%s was processed as bad already.", filename)
-                return True
-            logger.info("%s has not been processed.", filename)
-            return False
-
-        # skip to next object if already processed
-        if is_processed():
-            continue
-        if re.search(filename_regex, filename):
-            objects_to_process.append(object_summary)
-            logger.info('added %a for processing', filename)
-            report_stats['unprocessed_objects'] += 1
-    return objects_to_process
-
-with psycopg2.connect(conn_string) as conn:
-    with conn.cursor() as curs:
-        try:
-            logger.info("executing query")
-            curs.execute(query)
-            logger.info(log_query)
-        except psycopg2.Error:
-            logger.exception("psycopg2.Error:")
-            logger.error(('UNLOAD transaction on %s failed.'
-                          'Quitting with error code 1'), dml_file)
-            report_stats['failed_unloads'] += 1
-            report_stats['failed_unloads_list'].append(object_key)
-            report(report_stats)
-            clean_exit(1,'Failed psycopg2 query attempt.')
-        else:
-            logger.info(
-                'UNLOAD successful. Object prefix is %s/%s/%s',
-                bucket, storage_prefix, object_key)
-            report_stats['successful_unloads'] += 1
-            report_stats['successful_unloads_list'].append(object_key)
-
-            # optionally add the file extension and transfer to storage folders
-            objects = get_unprocessed_objects()
-            for object in objects:
-                key = object.key # aka the batch prefix of the object
-                filename = key[key.rfind('/')+1:]  # get the filename (after the last '/')
-
-                # final paths that include the filenames
-                copy_good_prefix = key.replace(f'{archive}/batch/', f'{archive}/good/', 1)
-                copy_bad_prefix = key.replace(f'{archive}/batch/', f'{archive}/bad/', 1)
-                copy_from_prefix = key 
-                
-                if 'extension' in config:
-                    # if an extension was set in the config, add it to the end of the file
-                    extension = config['extension']
-                    filename_with_extension = f"{key}{extension}"
-                    logger.info('File extension set in %s as "%s"', config_file, extension)
-                else:
-                    filename_with_extension = key 
-                    logger.info('File extension not set in %s', config_file)
+                logger.info(
+                    'UNLOAD successful. Object prefix is %s/%s/%s',
+                    bucket, storage_prefix, object_key)
+                report_stats['successful_unloads'] += 1
+                report_stats['successful_unloads_list'].append(object_key)
+
+                # a parallel UNLOAD writes one file per slice; merge them into
+                # the single object the client expects
+                if parallel:
+                    merge_unload()
+
+                # transfer the objects to storage folders and archive them
+                if not store_objects(get_unprocessed_objects()):
+                    report(report_stats)
+                    clean_exit(1,'Failed boto3 copy attempt.')
+
+                # record the end date sent, for the next run's unsent start date,
+                # and the fingerprint of what was sent
                 try:
-                    # final storage path that includes the filename and optional extension, removes the batch part of the prefix and leaves the client
-                    copy_to_prefix = filename_with_extension.replace(f'{archive}/batch/', '', 1)
-                    
-                    logger.info('Copying to s3 /client ...')
-                    client.copy_object(
-                        Bucket=bucket,
-                        CopySource='{}/{}'.format(bucket, copy_from_prefix),
-                        Key=copy_to_prefix)
+                    if 'start_date' in config and 'end_date' in config:
+                        write_last_sent(end_date)
+                    if 'fingerprint' in config:
+                        write_state(fingerprint_key, {
+                            'fingerprint': fingerprint, 'object_key': object_key})
                 except ClientError:
-                    logger.exception('Exception copying from s3://%s/%s', bucket, copy_from_prefix)
-                    logger.exception('to s3://%s/%s', bucket, copy_to_prefix)
-                    report_stats['unstored_objects'] += 1
-                    report_stats['unstored_objects_list'].append(copy_from_prefix)
-                    
-                    logger.info('Copying to s3 /bad ...')
-                    client.copy_object(
-                        Bucket=bucket,
-                        CopySource='{}/{}'.format(bucket, copy_from_prefix),
-                        Key=copy_bad_prefix)
-                    logger.info('Copied from s3://%s/%s', bucket, copy_from_prefix)
-                    logger.info('Copied to s3://%s/%s', bucket, copy_bad_prefix)
-                    report_stats['bad_objects_list'].append(copy_bad_prefix)
-                    report_stats['bad_objects'] += 1
-                    
-                    report(report_stats)
-                    clean_exit(1,'Failed boto3 copy_object attempt.')
-                else:
-                    logger.info('Copied from s3://%s/%s', bucket, copy_from_prefix)
-                    logger.info('Copied to s3://%s/%s', bucket, copy_to_prefix)
-                    report_stats['stored_objects'] += 1
-                    report_stats['stored_objects_list'].append(copy_to_prefix)
-                    
-                    logger.info('Copying to s3 /good ...')
-                    client.copy_object(
-                        Bucket=bucket,
-                        CopySource='{}/{}'.format(bucket, copy_from_prefix),
-                        Key=copy_good_prefix)
-                    logger.info('Copied from s3://%s/%s', bucket, copy_from_prefix)
-                    logger.info('Copied to s3://%s/%s', bucket, copy_good_prefix)
-                    report_stats['good_objects'] += 1
-                    report_stats['good_objects_list'].append(copy_good_prefix)
+                    logger.exception('Exception recording the delivery state')
 
-            report(report_stats)
-            clean_exit(0,'Finished succesfully.')
+                report(report_stats)
+                clean_exit(0,'Finished succesfully.')
+
+
+def run_config(config_file, pool):
+    """Run a configuration file on a connection from the pool.
+
+    A run ends by calling clean_exit(), which raises SystemExit; in a batch
+    this ends only that run, and its code is kept as the run's exit code.
+
+    Returns:
+        A tuple of the run's exit code and its report.
+    """
+    output = StringIO()
+    conn = pool.getconn()
+    try:
+        run(config_file, conn, output)
+    except SystemExit as e:
+        code = e.code
+    except Exception:
+        logger.exception('Exception running %s', config_file)
+        code = 1
+    else:
+        code = 0
+    finally:
+        pool.putconn(conn)
+    return code, output.getvalue()
+
+
+def batch_report(results):
+    '''reports out the outcome of every configuration file in a batch'''
+    failed = [(config_file, code) for config_file, (code, _) in results if code]
+    print(f'\n\nBatch report: {__file__}\n')
+    print(f'Configs run: {len(results)}')
+    print(f'Configs run successfully: {len(results) - len(failed)}')
+    if failed:
+        print(f'Configs run unsuccessfully: {len(failed)}')
+        print('\nList of configs run unsuccessfully:')
+        for i, (config_file, code) in enumerate(failed, 1):
+            print(f"{i}: {config_file} (exit code {code})")
+
+
+config_files = flags.conf
+
+# Configs in a batch run concurrently, so each must have its own batch folder
+directories = []
+for config_file in config_files:
+    with open(config_file) as f:
+        config = json.load(f)
+    directories.append((config['archive'], config['storage'], config['directory']))
+if len(set(directories)) < len(directories):
+    clean_exit(1, 'Configs in a batch must not share a directory.')
+
+# Runs share a pool of connections, up to one for each concurrent run
+workers = min(UNLOAD_WORKERS, len(config_files))
+pool = ThreadedConnectionPool(1, workers, conn_string)
+with ThreadPoolExecutor(max_workers=workers) as executor:
+    results = list(zip(config_files, executor.map(
+        lambda config_file: run_config(config_file, pool), config_files)))
+pool.closeall()
+
+# print each run's report in the order the configs were given
+for config_file, (code, output) in results:
+    print(output, end='')
+if len(results) > 1:
+    batch_report(results)
+
+exit_code = next((code for config_file, (code, _) in results if code), 0)
+clean_exit(exit_code, 'Finished all configs.')